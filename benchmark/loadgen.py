@@ -0,0 +1,328 @@
+# Copyright 2020 - 2023 Alexander Visca. All rights reserved
+"""
+Pipeline Benchmark
+
+Simulates devices posting temperature and environment readings to the
+receiver at a fixed rate and measures the pipeline end to end:
+- receiver accept latency, per request
+- storage ingest rate and latency, from the rows' creation times
+- processing stats freshness, and how long stats take to catch up
+
+Requests are sent open-loop: each one has an intended send time on a
+fixed schedule and its latency is measured from that time, so a slow
+receiver delays the measurement instead of the load (no coordinated
+omission). The report is written as JSON, and can be compared with a
+baseline report to fail on regressions.
+
+Usage
+python3 loadgen.py --devices 50 --rate 200 --duration 60 --report report.json
+python3 loadgen.py --rate 200 --duration 60 --baseline baseline.json --tolerance 0.2
+"""
+import argparse
+import json
+import logging
+import logging.config
+import random
+import requests
+import sys
+import time
+import uuid
+import yaml
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from os import environ
+from requests.adapters import HTTPAdapter
+from threading import Event, Lock, Thread, local
+
+# Constants
+DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+PERCENTILES = (50, 90, 99, 99.9)
+
+# Environment config
+if 'TARGET_ENV' in environ and environ['TARGET_ENV'] == 'prod':
+    app_conf_file = '/config/app_conf.yml'
+    log_conf_file = '/config/log_conf.yml'
+else:
+    app_conf_file = 'app_conf.yml'
+    log_conf_file = 'log_conf.yml'
+
+# Logging config
+with open(log_conf_file, mode='r') as file:
+    log_config = yaml.safe_load(file.read())
+    logging.config.dictConfig(log_config)
+
+logger = logging.getLogger('benchmark')
+
+# application config
+with open(app_conf_file, mode='r') as file:
+    app_config = yaml.safe_load(file.read())
+
+RECEIVER_URL = app_config['targets']['receiver']
+STORAGE_URL = app_config['targets']['storage']
+PROCESSING_URL = app_config['targets']['processing']
+REQUEST_TIMEOUT = app_config['connection']['request_timeout']
+LOCATIONS = app_config['devices']['locations']
+
+THREAD_STATE = local()
+
+
+def session() -> requests.Session:
+    # one keep-alive session per sender thread
+    if not hasattr(THREAD_STATE, 'session'):
+        THREAD_STATE.session = requests.Session()
+        THREAD_STATE.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=1))
+    return THREAD_STATE.session
+
+
+# devices
+class Device:
+    def __init__(self, location: str) -> None:
+        self.device_id = str(uuid.uuid4())
+        self.location = location
+        self.temperature = random.uniform(18, 24)
+
+    def reading(self, kind: str) -> dict:
+        body = {
+            'trace_id': str(uuid.uuid4()),
+            'device_id': self.device_id,
+            'location': self.location,
+            'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
+        }
+        if kind == 'temperature':
+            self.temperature += random.uniform(-0.2, 0.2)
+            body['temperature'] = round(self.temperature, 1)
+        else:
+            body['environment'] = {'pm2_5': random.randint(5, 60), 'co_2': random.randint(400, 1400)}
+        return body
+
+
+# load generation
+class Recorder:
+    def __init__(self) -> None:
+        self.samples = list()  # (kind, trace_id, intended, completed, status)
+        self.lock = Lock()
+
+    def add(self, sample: tuple) -> None:
+        with self.lock:
+            self.samples.append(sample)
+
+
+def send(recorder: Recorder, kind: str, body: dict, intended: float) -> None:
+    try:
+        res = session().post(f"{RECEIVER_URL}/{kind}", json=body, timeout=REQUEST_TIMEOUT)
+        status = res.status_code
+    except requests.exceptions.RequestException as e:
+        logger.debug("Request failed - %s", e)
+        status = 0
+    recorder.add((kind, body['trace_id'], intended, time.time(), status))
+
+def run_load(devices: list, rate: float, duration: float, env_ratio: float, senders: int, poisson: bool) -> tuple:
+    """Sends readings on an open-loop schedule, returns the samples and the schedule start and end"""
+    recorder = Recorder()
+    total = int(rate * duration)
+    start = time.time() + 0.5
+    intended = start
+    with ThreadPoolExecutor(max_workers=senders, thread_name_prefix='sender') as pool:
+        for number in range(total):
+            # the schedule does not wait for responses, late requests queue in the pool
+            delay = intended - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            device = devices[number % len(devices)]
+            kind = 'environment' if random.random() < env_ratio else 'temperature'
+            pool.submit(send, recorder, kind, device.reading(kind), intended)
+            intended += random.expovariate(rate) if poisson else 1 / rate
+    end = time.time()
+    logger.info("Sent %s readings in %.1fs", total, end - start)
+    return recorder.samples, start, end
+
+
+# pipeline probes
+def parse_created(value: str) -> float:
+    return datetime.fromisoformat(str(value).rstrip('Z')).timestamp()
+
+class StorageProbe(Thread):
+    """Pages new storage rows during the run and records when each reading was stored"""
+    def __init__(self, start: float, interval: float) -> None:
+        super().__init__(daemon=True)
+        self.start_timestamp = datetime.fromtimestamp(start - 1).strftime(DATETIME_FORMAT)
+        self.interval = interval
+        self.cursors = {'temperature': None, 'environment': None}
+        self.created = dict()  # trace_id -> creation time (epoch seconds)
+        self.stopped = Event()
+
+    def poll(self, table: str) -> None:
+        while True:
+            if self.cursors[table] is None:
+                # rows since the run started, then a cursor from the first one seen
+                params = {'start_timestamp': self.start_timestamp,
+                    'end_timestamp': datetime.now().strftime(DATETIME_FORMAT)}
+            else:
+                params = {'after_id': self.cursors[table]}
+            res = session().get(f"{STORAGE_URL}/{table}", params=params, timeout=REQUEST_TIMEOUT)
+            res.raise_for_status()
+            rows = res.json()
+            for row in rows:
+                self.created[row['trace_id']] = parse_created(row['date_created'])
+            if not rows:
+                return
+            self.cursors[table] = rows[-1]['id']
+            if 'after_id' not in params:
+                return
+
+    def run(self) -> None:
+        while not self.stopped.wait(self.interval):
+            for table in self.cursors:
+                try:
+                    self.poll(table)
+                except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+                    logger.warning("Storage probe failed - %s", e)
+
+class ProcessingProbe(Thread):
+    """Polls processing stats and records their age and reading count"""
+    def __init__(self, interval: float) -> None:
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.samples = list()  # (polled, last_updated, count)
+        self.stopped = Event()
+
+    def poll(self) -> tuple:
+        res = session().get(f"{PROCESSING_URL}/stats", timeout=REQUEST_TIMEOUT)
+        res.raise_for_status()
+        stats = res.json()
+        updated = datetime.strptime(stats['last_updated'], DATETIME_FORMAT).timestamp()
+        return time.time(), updated, stats['count']
+
+    def run(self) -> None:
+        while not self.stopped.wait(self.interval):
+            try:
+                self.samples.append(self.poll())
+            except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+                logger.warning("Processing probe failed - %s", e)
+
+
+# report
+def summarize(values: list, scale: float = 1) -> dict:
+    if not values:
+        return {'count': 0}
+    values = sorted(value * scale for value in values)
+    summary = {'count': len(values), 'mean': sum(values) / len(values), 'max': values[-1]}
+    for percentile in PERCENTILES:
+        # nearest rank
+        rank = max(1, -(-len(values) * percentile // 100))
+        summary[f'p{percentile:g}'] = values[int(rank) - 1]
+    return summary
+
+def build_report(args, samples: list, start: float, end: float, storage: StorageProbe, processing: ProcessingProbe, baseline_count: int) -> dict:
+    accepted = [sample for sample in samples if 200 <= sample[4] < 300]
+    sent_at = {sample[1]: sample[2] for sample in accepted}
+    stored = [created for trace_id, created in storage.created.items() if trace_id in sent_at]
+    ingest = [storage.created[trace_id] - intended for trace_id, intended in sent_at.items() if trace_id in storage.created]
+    stored_span = (max(stored) - min(stored)) if len(stored) > 1 else 0
+
+    temperatures = sum(1 for sample in accepted if sample[0] == 'temperature')
+    freshness = [polled - updated for polled, updated, _ in processing.samples if polled >= start]
+    caught_up = [polled for polled, _, count in processing.samples
+        if polled >= end and baseline_count is not None and count - baseline_count >= temperatures]
+
+    return {
+        'started': datetime.fromtimestamp(start).strftime(DATETIME_FORMAT),
+        'config': {
+            'devices': args.devices, 'rate': args.rate, 'duration': args.duration,
+            'env_ratio': args.env_ratio, 'senders': args.senders, 'poisson': args.poisson
+        },
+        'receiver': {
+            'sent': len(samples),
+            'accepted': len(accepted),
+            'errors': len(samples) - len(accepted),
+            'achieved_rate': len(samples) / (end - start) if end > start else 0,
+            'latency_ms': summarize([completed - intended for _, _, intended, completed, _ in samples], 1000)
+        },
+        'storage': {
+            'stored': len(stored),
+            'missing': len(accepted) - len(stored),
+            'ingest_rate': len(stored) / stored_span if stored_span else 0,
+            'ingest_latency_ms': summarize(ingest, 1000)
+        },
+        'processing': {
+            'freshness_sec': summarize(freshness),
+            'catch_up_sec': (caught_up[0] - end) if caught_up else None
+        }
+    }
+
+def compare(report: dict, baseline: dict, tolerance: float) -> list:
+    """Regressions against a baseline report, as messages"""
+    checks = (
+        ('receiver', 'latency_ms', 'p99', True),
+        ('storage', 'ingest_latency_ms', 'p99', True),
+        ('storage', 'ingest_rate', None, False),
+        ('processing', 'freshness_sec', 'p99', True)
+    )
+    regressions = list()
+    for section, metric, percentile, lower_is_better in checks:
+        current, previous = report[section][metric], baseline[section][metric]
+        if percentile is not None:
+            current, previous = current.get(percentile), previous.get(percentile)
+        if current is None or not previous:
+            continue
+        change = (current - previous) / previous
+        if (change > tolerance) if lower_is_better else (change < -tolerance):
+            label = f"{section}.{metric}" + (f".{percentile}" if percentile else "")
+            regressions.append(f"{label}: {previous:.2f} -> {current:.2f} ({change:+.0%})")
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--devices', type=int, default=app_config['devices']['count'], help="simulated devices")
+    parser.add_argument('--rate', type=float, default=app_config['load']['rate'], help="readings per second, all devices")
+    parser.add_argument('--duration', type=float, default=app_config['load']['duration_sec'], help="seconds of load")
+    parser.add_argument('--env-ratio', type=float, default=app_config['load']['env_ratio'], help="share of environment readings")
+    parser.add_argument('--senders', type=int, default=app_config['load']['senders'], help="concurrent requests")
+    parser.add_argument('--poisson', action='store_true', help="exponential instead of fixed gaps between readings")
+    parser.add_argument('--drain', type=float, default=app_config['load']['drain_sec'], help="seconds to wait for the pipeline after the load")
+    parser.add_argument('--report', help="report file, printed if not set")
+    parser.add_argument('--baseline', help="report to compare against, exits 1 on a regression")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed change against the baseline")
+    args = parser.parse_args()
+
+    devices = [Device(LOCATIONS[number % len(LOCATIONS)]) for number in range(args.devices)]
+    probe_interval = app_config['probes']['interval_sec']
+    processing = ProcessingProbe(probe_interval)
+    try:
+        baseline_count = processing.poll()[2]
+    except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+        logger.warning("Processing unavailable, catch-up will not be measured - %s", e)
+        baseline_count = None
+    processing.start()
+    storage = StorageProbe(time.time(), probe_interval)
+    storage.start()
+
+    samples, start, end = run_load(devices, args.rate, args.duration, args.env_ratio, args.senders, args.poisson)
+    logger.info("Waiting %ss for the pipeline to drain", args.drain)
+    time.sleep(args.drain)
+    storage.stopped.set()
+    processing.stopped.set()
+    storage.join()
+    processing.join()
+
+    report = build_report(args, samples, start, end, storage, processing, baseline_count)
+    output = json.dumps(report, indent=2)
+    if args.report:
+        with open(args.report, mode='w') as file:
+            file.write(output + '\n')
+        logger.info("Report written to %s", args.report)
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline, mode='r') as file:
+            regressions = compare(report, json.load(file), args.tolerance)
+        for regression in regressions:
+            logger.error("Regression - %s", regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
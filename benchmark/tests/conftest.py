@@ -0,0 +1,61 @@
+"""
+Runs the benchmark's probes and report against stubbed HTTP responses
+
+    cd benchmark
+    python -m pytest tests
+"""
+import os
+import shutil
+import sys
+import pytest
+
+BENCHMARK = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BENCHMARK)
+
+
+class StubResponse:
+    def __init__(self, body) -> None:
+        self.body = body
+
+    def raise_for_status(self) -> None:
+        pass
+
+    def json(self):
+        return self.body
+
+
+class StubSession:
+    """Answers every GET with the next body, and records the URLs requested"""
+    def __init__(self, bodies: list) -> None:
+        self.bodies = list(bodies)
+        self.urls = list()
+
+    def get(self, url: str, **kwargs) -> StubResponse:
+        self.urls.append(url)
+        return StubResponse(self.bodies.pop(0))
+
+
+@pytest.fixture(scope='session')
+def loadgen(tmp_path_factory):
+    directory = tmp_path_factory.mktemp('benchmark')
+    for name in ('app_conf.yml', 'log_conf.yml'):
+        shutil.copy(os.path.join(BENCHMARK, name), directory)
+
+    # config files are read from the working directory on import
+    cwd = os.getcwd()
+    os.environ['TARGET_ENV'] = 'test'
+    os.chdir(directory)
+    try:
+        import loadgen
+    finally:
+        os.chdir(cwd)
+    return loadgen
+
+
+@pytest.fixture()
+def stub_session(loadgen, monkeypatch):
+    def stub_session(*bodies) -> StubSession:
+        stub = StubSession(bodies)
+        monkeypatch.setattr(loadgen, 'session', lambda: stub)
+        return stub
+    return stub_session
@@ -0,0 +1,54 @@
+import time
+from argparse import Namespace
+from datetime import datetime
+
+
+def stats_body(count: int, updated: float) -> dict:
+    # the body of GET /processing/stats
+    return {
+        'count': count,
+        'max_temp': 24.1,
+        'min_temp': 19.3,
+        'avg_temp': 21.9,
+        'max_pm2_5': 12,
+        'max_co_2': 640,
+        'quantiles': {},
+        'last_updated': datetime.fromtimestamp(updated).strftime('%Y-%m-%dT%H:%M:%SZ')
+    }
+
+
+def test_processing_probe_reads_the_stats_body(loadgen, stub_session):
+    updated = int(time.time()) - 5
+    stub = stub_session(stats_body(1200, updated))
+
+    polled, last_updated, count = loadgen.ProcessingProbe(1).poll()
+
+    assert stub.urls == [f'{loadgen.PROCESSING_URL}/stats']
+    assert last_updated == updated
+    assert count == 1200
+    assert polled >= updated + 5
+
+
+def test_report_measures_catch_up_from_the_probe(loadgen, stub_session):
+    start = int(time.time()) - 10
+    end = start + 4
+    stub_session(stats_body(100, start), stats_body(102, end + 1), stats_body(103, end + 2))
+    probe = loadgen.ProcessingProbe(1)
+    baseline_count = probe.poll()[2]
+    # polled times are pinned so the catch-up time does not depend on the clock
+    probe.samples = [(end + offset, updated, count) for offset, (_, updated, count) in zip((1, 3), (probe.poll(), probe.poll()))]
+    samples = [
+        ('temperature', 'a', start, start + 0.01, 201),
+        ('temperature', 'b', start + 1, start + 1.01, 201),
+        ('temperature', 'c', start + 2, start + 2.01, 201),
+        ('environment', 'd', start + 3, start + 3.01, 201)
+    ]
+    args = Namespace(devices=1, rate=1, duration=4, env_ratio=0.25, senders=1, poisson=False)
+
+    report = loadgen.build_report(args, samples, start, end, loadgen.StorageProbe(start, 1), probe, baseline_count)
+
+    assert report['receiver']['accepted'] == 4
+    # three temperature readings, processed once the count reaches 103
+    assert report['processing']['catch_up_sec'] == 3
+    assert report['processing']['freshness_sec']['max'] == 1
+    assert report['processing']['freshness_sec']['count'] == 2
@@ -0,0 +1,128 @@
+"""
+Response encodings
+
+Bulk reads are encoded here rather than by connexion, whose encoder
+indents its output and calls back into Python for every Decimal and
+datetime. Rows are returned in the representation the client accepts:
+- application/json:                       array of rows (default)
+- application/vnd.openatmos.columns+json: struct of arrays, one array per field
+- application/msgpack:                    array of rows, if msgpack is installed
+
+Responses are compressed with zstd or gzip, whichever the client
+accepts (zstd only if zstandard is installed). Compression runs after
+connexion has validated the response, and streamed responses are
+compressed as they are written.
+"""
+import json
+import zlib
+from datetime import datetime
+from decimal import Decimal
+from flask import Response, request
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+JSON = 'application/json'
+COLUMNS = 'application/vnd.openatmos.columns+json'
+MSGPACK = 'application/msgpack'
+NDJSON = 'application/x-ndjson'
+ENCODINGS = ('zstd', 'gzip') if zstandard is not None else ('gzip',)
+
+
+def default(value):
+    # the same representation as connexion's encoder, naive times are UTC
+    if isinstance(value, datetime):
+        return value.isoformat('T') + ('Z' if value.tzinfo is None else '')
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not serializable")
+
+
+def dumps(value) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(value, default=default, option=orjson.OPT_PASSTHROUGH_DATETIME)
+    return json.dumps(value, default=default, separators=(',', ':')).encode('utf-8')
+
+
+def packb(value) -> bytes:
+    return msgpack.packb(value, default=default)
+
+
+def to_columns(rows: list) -> dict:
+    """Struct of arrays, nested objects become nested columns and missing fields are None"""
+    keys = dict.fromkeys(key for row in rows for key in row)
+    columns = dict()
+    for key in keys:
+        values = [row.get(key) for row in rows]
+        if any(isinstance(value, dict) for value in values):
+            columns[key] = to_columns([value or dict() for value in values])
+        else:
+            columns[key] = values
+    return columns
+
+
+def accepted(media_types: tuple, fallback: str = JSON) -> str:
+    """Media type the client prefers, of those offered"""
+    if msgpack is None:
+        media_types = tuple(media_type for media_type in media_types if media_type != MSGPACK)
+    return request.accept_mimetypes.best_match(media_types, default=fallback)
+
+
+def rows_response(rows: list, status: int = 200) -> Response:
+    media_type = accepted((JSON, COLUMNS, MSGPACK))
+    if media_type == MSGPACK:
+        body = packb(rows)
+    elif media_type == COLUMNS:
+        body = dumps({'count': len(rows), 'columns': to_columns(rows)})
+    else:
+        body = dumps(rows)
+    return Response(body, status=status, mimetype=media_type)
+
+
+def compressor(encoding: str, levels: dict):
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=levels['zstd_level']).compressobj()
+    # wbits 31 writes a gzip header and trailer
+    return zlib.compressobj(levels['gzip_level'], zlib.DEFLATED, 31)
+
+
+def compress_stream(chunks, compressobj):
+    for chunk in chunks:
+        data = compressobj.compress(chunk)
+        if data:
+            yield data
+    yield compressobj.flush()
+
+
+def compress(flask_app, config: dict) -> None:
+    """Compresses responses of at least min_bytes, and every streamed response"""
+    @flask_app.after_request
+    def compress_response(response):
+        response.vary.add('Accept-Encoding')
+        if response.status_code != 200 or 'Content-Encoding' in response.headers:
+            return response
+        if response.mimetype == 'text/event-stream':
+            return response
+        encoding = request.accept_encodings.best_match(ENCODINGS)
+        if encoding is None:
+            return response
+        if response.is_streamed:
+            response.response = compress_stream(response.response, compressor(encoding, config))
+            response.headers.pop('Content-Length', None)
+        else:
+            data = response.get_data()
+            if len(data) < config['min_bytes']:
+                return response
+            compressobj = compressor(encoding, config)
+            response.set_data(compressobj.compress(data) + compressobj.flush())
+        response.headers['Content-Encoding'] = encoding
+        return response
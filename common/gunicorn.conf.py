@@ -0,0 +1,43 @@
+"""
+Gunicorn configuration
+
+Production entry point, copied into each image from common/ and run
+from the service directory:
+
+    gunicorn --config gunicorn.conf.py app:application
+
+Workers and threads per worker come from the `http` section of
+app_conf.yml. Services with Server-Sent Events streams set
+`worker_class: gevent`: a streaming client then holds a greenlet for
+as long as it is connected instead of one of a few threads, so a
+worker serves many idle streams alongside its polling requests. The
+app is imported by each worker after the fork, so
+database engines, consumers and connection pools are never shared
+between workers, and each worker then starts itself. The background
+work runs only in the worker elected leader.
+"""
+import yaml
+from os import environ
+
+if 'TARGET_ENV' in environ and environ['TARGET_ENV'] == 'prod':
+    app_conf_file = '/config/app_conf.yml'
+else:
+    app_conf_file = 'app_conf.yml'
+
+with open(app_conf_file, mode='r') as file:
+    http = yaml.safe_load(file.read())['http']
+
+bind = f"0.0.0.0:{http['port']}"
+workers = http['workers']
+worker_class = http.get('worker_class', 'gthread')
+if worker_class == 'gthread':
+    threads = http['threads']
+else:
+    worker_connections = http['worker_connections']
+timeout = http['timeout_sec']
+preload_app = False
+
+
+def post_worker_init(worker):
+    import app
+    app.start_worker()
@@ -0,0 +1,88 @@
+"""
+Leader election
+
+Run by gunicorn, a service has several worker processes, but its
+background work (consumers, scheduled jobs) has to run once per pod.
+Workers wait on an exclusive lock on a file and the worker holding it
+runs the background work. The lock is released by the kernel when its
+holder exits, so another worker takes over. The other workers follow
+the state the leader persists.
+
+Locks are polled rather than waited on, as a blocking flock would
+stall every greenlet of a gevent worker, not just the one waiting.
+"""
+import fcntl
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+from threading import Event, Thread
+
+logger = logging.getLogger(__name__)
+
+# seconds between attempts to take a lock held by another worker
+LOCK_POLL_SEC = 0.5
+
+
+class Leader:
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.elected = Event()
+        self.file = None
+
+    @property
+    def is_leader(self) -> bool:
+        return self.elected.is_set()
+
+    def campaign(self, on_elected) -> None:
+        """Waits for the lock in the background and calls on_elected once it is held"""
+        Thread(target=self._campaign, args=(on_elected,), name='leader', daemon=True).start()
+
+    def _campaign(self, on_elected) -> None:
+        # kept open for the life of the process, closing it would release the lock
+        self.file = open(self.path, mode='a')
+        acquire(self.file)
+        logger.info("Worker %s elected leader", os.getpid())
+        self.elected.set()
+        on_elected()
+
+
+def acquire(file, poll_sec: float = LOCK_POLL_SEC) -> None:
+    """Takes an exclusive lock on a file, sleeping between attempts while another process holds it"""
+    while True:
+        try:
+            fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return
+        except BlockingIOError:
+            time.sleep(poll_sec)
+
+
+@contextmanager
+def file_lock(path: str):
+    """Runs a block in one worker at a time, eg. creating a database"""
+    with open(path, mode='a') as file:
+        acquire(file, poll_sec=0.05)
+        try:
+            yield
+        finally:
+            fcntl.flock(file, fcntl.LOCK_UN)
+
+
+def save_state(path: str, state) -> None:
+    """Saves state for the workers that follow the leader, replacing the file at once"""
+    temp = f'{path}.tmp'
+    with open(temp, mode='w') as file:
+        json.dump(state, file)
+    os.replace(temp, path)
+
+
+def load_state(path: str, max_age_sec: float = None):
+    """State the leader saved, or None if there is none or it was saved more than max_age_sec ago"""
+    try:
+        if max_age_sec is not None and time.time() - os.path.getmtime(path) > max_age_sec:
+            return None
+        with open(path, mode='r') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
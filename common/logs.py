@@ -0,0 +1,113 @@
+"""
+Logging
+
+Applies log_conf.yml, then puts a bounded queue in front of the
+handlers of each logger. Records are formatted and written to the
+console and files by a listener thread, so a request or a consumed
+message never waits on log I/O. A record that does not fit the queue
+is dropped instead.
+
+Lines at or below the sample level (info by default) are rate limited
+per call site with a token bucket, so a line logged for every message
+is kept at up to per_second lines, after a burst. Warnings and errors
+are never sampled. Log with %-style arguments, not f-strings, so the
+message of a sampled or filtered line is never formatted.
+
+Dropped lines are counted by logger and reason (sampled, queue_full).
+The `queue` section of log_conf.yml, all optional:
+
+    queue:
+      size: 10000           records waiting for the listener
+      sample_level: INFO    highest level that is sampled
+      per_second: 10        lines per second per call site
+      burst: 100            lines let through before sampling starts
+"""
+import atexit
+import copy
+import logging
+import logging.config
+import time
+from logging.handlers import QueueHandler, QueueListener
+from metrics import Counter
+from queue import Full, Queue
+from threading import Lock
+
+DROPPED = Counter('log_lines_dropped_total', "Log lines dropped before reaching a handler", ('logger', 'reason'))
+LISTENERS = list()
+
+
+class DroppingQueueHandler(QueueHandler):
+    def prepare(self, record):
+        # only the message is resolved here, while the args still hold their values at the call.
+        # The handlers format the line, time and traceback in the listener thread
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record) -> None:
+        # the default put blocks or raises when the queue is full
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            DROPPED.inc(record.name, 'queue_full')
+
+
+class Sampler(logging.Filter):
+    """Token bucket per call site for records at or below a level"""
+    def __init__(self, level: int, per_second: float, burst: int) -> None:
+        super().__init__()
+        self.level = level
+        self.per_second = per_second
+        self.burst = burst
+        self.buckets = dict()  # (pathname, lineno) -> [tokens, last refill]
+        self.lock = Lock()
+
+    def filter(self, record) -> bool:
+        if record.levelno > self.level:
+            return True
+        site = (record.pathname, record.lineno)
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(site)
+            if bucket is None:
+                bucket = self.buckets[site] = [self.burst, now]
+            tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.per_second)
+            bucket[1] = now
+            if tokens < 1:
+                bucket[0] = tokens
+                DROPPED.inc(record.name, 'sampled')
+                return False
+            bucket[0] = tokens - 1
+        return True
+
+
+def configure(log_config: dict) -> None:
+    """Applies a logging config, then moves the handlers of each logger behind a queue"""
+    settings = log_config.get('queue') or dict()
+    logging.config.dictConfig(log_config)
+    sampler = Sampler(
+        logging.getLevelName(settings.get('sample_level', 'INFO')),
+        settings.get('per_second', 10),
+        settings.get('burst', 100)
+    )
+    loggers = [logging.getLogger()] + [logging.getLogger(name) for name in log_config.get('loggers', dict())]
+    for logger in loggers:
+        handlers = list(logger.handlers)
+        if not handlers:
+            continue
+        queue = Queue(settings.get('size', 10000))
+        for handler in handlers:
+            logger.removeHandler(handler)
+        logger.addHandler(DroppingQueueHandler(queue))
+        logger.addFilter(sampler)
+        listener = QueueListener(queue, *handlers, respect_handler_level=True)
+        listener.start()
+        LISTENERS.append(listener)
+    atexit.register(stop)
+
+
+def stop() -> None:
+    """Writes out the queued records"""
+    while LISTENERS:
+        LISTENERS.pop().stop()
@@ -0,0 +1,176 @@
+"""
+Metrics
+
+Counters and fixed-bucket histograms exposed in the Prometheus text
+format. Each thread updates its own cells, so recording an event takes
+no lock; cells are only summed when /metrics is scraped. The cells of
+threads that have exited are folded into per-metric totals and dropped,
+so a server starting a thread per request does not accumulate them.
+"""
+import time
+from bisect import bisect_left
+from threading import Lock, current_thread, local
+
+# seconds, from 100us to 10s
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# cells held before those of exited threads are first folded into the totals
+RETIRE_AT = 64
+
+
+class Metric:
+    def __init__(self, name: str, help: str, kind: str) -> None:
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.cells = list()  # (thread, labels, cell), one per live thread and labels
+        self.retired = dict()  # labels -> summed cells of exited threads
+        self.retire_at = RETIRE_AT
+        self.local = local()
+        self.lock = Lock()  # only taken when a thread first records a set of labels
+
+    def _cell(self, labels: tuple):
+        cells = getattr(self.local, 'cells', None)
+        if cells is None:
+            cells = self.local.cells = dict()
+        cell = cells.get(labels)
+        if cell is None:
+            cell = cells[labels] = self._new_cell()
+            with self.lock:
+                self.cells.append((current_thread(), labels, cell))
+                if len(self.cells) >= self.retire_at:
+                    self._retire()
+                    # live cells are rescanned only once as many again have been added
+                    self.retire_at = max(RETIRE_AT, 2 * len(self.cells))
+        return cell
+
+    def _retire(self) -> None:
+        """Folds the cells of exited threads into the retired totals, called with the lock held"""
+        live = list()
+        for thread, labels, cell in self.cells:
+            if thread.is_alive():
+                live.append((thread, labels, cell))
+            else:
+                self.retired[labels] = add_cells(self.retired.get(labels), cell)
+        self.cells = live
+
+    def _totals(self) -> dict:
+        with self.lock:
+            self._retire()
+            cells = [(labels, cell) for _, labels, cell in self.cells]
+            totals = {labels: list(total) for labels, total in self.retired.items()}
+        for labels, cell in cells:
+            totals[labels] = add_cells(totals.get(labels), cell)
+        return totals
+
+
+class Counter(Metric):
+    def __init__(self, name: str, help: str, labels: tuple = ()) -> None:
+        super().__init__(name, help, 'counter')
+        self.labels = labels
+
+    def _new_cell(self) -> list:
+        return [0]
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        self._cell(labels)[0] += amount
+
+    def collect(self) -> list:
+        return [sample(self.name, self.labels, labels, total[0]) for labels, total in self._totals().items()]
+
+
+class Histogram(Metric):
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> None:
+        super().__init__(name, help, 'histogram')
+        self.labels = labels
+        self.buckets = buckets
+
+    def _new_cell(self) -> list:
+        # bucket counts, +Inf count, then the sum
+        return [0] * (len(self.buckets) + 1) + [0.0]
+
+    def observe(self, value: float, *labels) -> None:
+        cell = self._cell(labels)
+        cell[bisect_left(self.buckets, value)] += 1
+        cell[-1] += value
+
+    def time(self, *labels):
+        return Timer(self, labels)
+
+    def collect(self) -> list:
+        lines = list()
+        for labels, total in self._totals().items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), total[:-1]):
+                cumulative += count
+                lines.append(sample(f'{self.name}_bucket', self.labels + ('le',), labels + (bound,), cumulative))
+            lines.append(sample(f'{self.name}_sum', self.labels, labels, total[-1]))
+            lines.append(sample(f'{self.name}_count', self.labels, labels, cumulative))
+        return lines
+
+
+class Timer:
+    def __init__(self, histogram: Histogram, labels: tuple) -> None:
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.histogram.observe(time.perf_counter() - self.started, *self.labels)
+
+
+def add_cells(total: list, cell: list) -> list:
+    return list(cell) if total is None else [a + b for a, b in zip(total, cell)]
+
+
+def sample(name: str, names: tuple, values: tuple, value: float) -> str:
+    if not names:
+        return f'{name} {value}'
+    labels = ','.join(f'{label}="{value}"' for label, value in zip(names, values))
+    return f'{name}{{{labels}}} {value}'
+
+
+class Registry:
+    def __init__(self, prefix: str) -> None:
+        self.prefix = prefix
+        self.metrics = list()
+
+    def counter(self, name: str, help: str, labels: tuple = ()) -> Counter:
+        return self.add(Counter(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        return self.add(Histogram(name, help, labels, buckets))
+
+    def add(self, metric: Metric) -> Metric:
+        """Registers a metric under the prefix, eg. one created before the registry"""
+        metric.name = f'{self.prefix}_{metric.name}'
+        self.metrics.append(metric)
+        return metric
+
+    def exposition(self) -> str:
+        lines = list()
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(metric.collect())
+        return '\n'.join(lines) + '\n'
+
+    def instrument(self, flask_app) -> None:
+        """Request latency by operationId for every endpoint"""
+        from flask import g, request
+        requests = self.histogram('request_seconds', "Request latency by operation", ('operation', 'status'))
+
+        @flask_app.before_request
+        def start_timer():
+            g.metrics_started = time.perf_counter()
+
+        @flask_app.after_request
+        def record_latency(response):
+            started = getattr(g, 'metrics_started', None)
+            if started is not None and request.endpoint is not None:
+                # connexion names endpoints after the operationId, eg. app_get_stats
+                operation = request.endpoint.rsplit('.', 1)[-1]
+                requests.observe(time.perf_counter() - started, operation, str(response.status_code))
+            return response
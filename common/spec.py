@@ -0,0 +1,99 @@
+"""
+OpenAPI spec cache
+
+Parsing the YAML spec and validating it against the OpenAPI schema is
+most of the time a service takes to start. The parsed spec is cached
+next to its source, keyed on a digest of the source, and a cached spec
+was validated when it was written, so a replica starting from it skips
+both steps. This module is shared by the services and copied into each
+image from common/, where the cache is built:
+
+    python3 spec.py openapi openapi.yml
+
+A missing or stale cache falls back to parsing and validating the
+source, and rewrites the cache.
+"""
+import logging
+import os
+import pickle
+import sys
+import yaml
+from contextlib import contextmanager
+from hashlib import sha1
+
+logger = logging.getLogger(__name__)
+
+
+def cache_path(specification_dir: str, filename: str) -> str:
+    return os.path.join(specification_dir, f'.{filename}.cache')
+
+
+def load(specification_dir: str, filename: str) -> tuple:
+    """Parsed spec, and whether it comes from the cache"""
+    with open(os.path.join(specification_dir, filename), mode='rb') as file:
+        source = file.read()
+    digest = sha1(source).hexdigest()
+    try:
+        with open(cache_path(specification_dir, filename), mode='rb') as file:
+            cached_digest, spec = pickle.load(file)
+        if cached_digest == digest:
+            return spec, True
+    except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+        pass
+    return yaml.safe_load(source), False
+
+
+def save(specification_dir: str, filename: str, spec: dict) -> None:
+    with open(os.path.join(specification_dir, filename), mode='rb') as file:
+        digest = sha1(file.read()).hexdigest()
+    path = cache_path(specification_dir, filename)
+    try:
+        with open(f'{path}.tmp', mode='wb') as file:
+            pickle.dump((digest, spec), file)
+        os.replace(f'{path}.tmp', path)
+    except OSError as e:
+        logger.warning("Unable to cache spec %s - %s", filename, e)
+
+
+@contextmanager
+def skip_validation(skip: bool):
+    # connexion validates every spec it loads, a cached spec was validated when it was cached
+    from connexion.spec import OpenAPISpecification
+    if not skip:
+        yield
+        return
+    # inherited from Specification unless overridden, so it is restored by deleting the override
+    validate = vars(OpenAPISpecification).get('_validate_spec')
+    OpenAPISpecification._validate_spec = classmethod(lambda cls, spec: None)
+    try:
+        yield
+    finally:
+        if validate is None:
+            del OpenAPISpecification._validate_spec
+        else:
+            OpenAPISpecification._validate_spec = validate
+
+
+def add_api(app, filename: str, **kwargs):
+    """Adds an API to a connexion app from the cached spec, if it is current"""
+    specification_dir = str(app.specification_dir)
+    spec, cached = load(specification_dir, filename)
+    with skip_validation(cached):
+        # connexion resolves references in place, so it gets a copy of the spec
+        api = app.add_api(pickle.loads(pickle.dumps(spec)), **kwargs)
+    if not cached:
+        save(specification_dir, filename, spec)
+    return api
+
+
+def build(specification_dir: str, filename: str) -> None:
+    from connexion.spec import OpenAPISpecification
+    spec, cached = load(specification_dir, filename)
+    if not cached:
+        # validated the way connexion validates it when it is added
+        OpenAPISpecification(pickle.loads(pickle.dumps(spec)))
+        save(specification_dir, filename, spec)
+
+
+if __name__ == '__main__':
+    build(sys.argv[1], sys.argv[2])
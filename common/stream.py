@@ -0,0 +1,88 @@
+"""
+Server-Sent Events feed
+
+Holds the latest snapshot and wakes every subscribed client when it
+changes. Idle clients block on a shared condition and only send a
+heartbeat comment, so they cost no work between updates.
+
+Each streaming client holds a worker connection (a greenlet under a
+gevent worker) for as long as it is connected, so a feed takes at most
+max_clients at once and turns the others away, leaving connections for
+the polling endpoints.
+"""
+import json
+from threading import Condition
+
+
+class Broadcaster:
+    def __init__(self, event: str, heartbeat_sec: int = 15, retry_ms: int = 5000, ignore: tuple = (), max_clients: int = None) -> None:
+        self.event = event
+        self.ignore = ignore  # fields that do not count as a change, eg. timestamps
+        self.heartbeat_sec = heartbeat_sec
+        self.retry_ms = retry_ms
+        self.max_clients = max_clients
+        self.clients = 0
+        self.condition = Condition()
+        self.version = 0
+        self.data = None
+        self.values = None
+
+    def publish(self, snapshot: dict) -> None:
+        """Notifies clients, unless the snapshot is unchanged"""
+        data = json.dumps(snapshot, sort_keys=True, default=str)
+        values = {key: value for key, value in snapshot.items() if key not in self.ignore}
+        with self.condition:
+            if values == self.values:
+                return
+            self.data = data
+            self.values = values
+            self.version += 1
+            self.condition.notify_all()
+
+    def subscribe(self):
+        """Event stream for a new client, or None if max_clients are already connected"""
+        with self.condition:
+            if self.max_clients is not None and self.clients >= self.max_clients:
+                return None
+            self.clients += 1
+        return Subscription(self, self.events())
+
+    def unsubscribe(self) -> None:
+        with self.condition:
+            self.clients -= 1
+
+    def events(self):
+        """Event stream for one client, starting with the current snapshot, in bytes as it is not encoded by the response"""
+        yield f"retry: {self.retry_ms}\n\n".encode('utf-8')
+        seen = 0
+        while True:
+            with self.condition:
+                if self.version == seen:
+                    self.condition.wait(self.heartbeat_sec)
+                changed = self.version != seen
+                seen, data = self.version, self.data
+            if changed:
+                yield f"id: {seen}\nevent: {self.event}\ndata: {data}\n\n".encode('utf-8')
+            else:
+                yield b": heartbeat\n\n"
+
+
+class Subscription:
+    """One client's event stream, which frees its place in the feed when the server closes it"""
+    def __init__(self, feed: Broadcaster, events) -> None:
+        self.feed = feed
+        self.events = events
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> bytes:
+        return next(self.events)
+
+    def close(self) -> None:
+        # called once the client disconnects, even if no event was sent
+        if not self.closed:
+            self.closed = True
+            self.events.close()
+            self.feed.unsubscribe()
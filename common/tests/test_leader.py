@@ -0,0 +1,36 @@
+import fcntl
+import time
+from threading import Thread
+from leader import acquire, file_lock
+
+
+def test_lock_is_taken_once_the_holder_releases_it(tmp_path):
+    path = tmp_path / 'service.lock'
+    taken = list()
+
+    def wait_for_lock():
+        with open(path, mode='a') as file:
+            acquire(file, poll_sec=0.01)
+            taken.append(time.monotonic())
+
+    with file_lock(path):
+        waiter = Thread(target=wait_for_lock)
+        waiter.start()
+        time.sleep(0.1)
+        assert not taken
+        released = time.monotonic()
+    waiter.join(timeout=5)
+    assert taken and taken[0] >= released
+
+
+def test_lock_is_taken_at_once_when_free(tmp_path):
+    with open(tmp_path / 'service.lock', mode='a') as file:
+        acquire(file)
+        # held, so another open file description cannot take it
+        with open(tmp_path / 'service.lock', mode='a') as other:
+            try:
+                fcntl.flock(other, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                held = False
+            except BlockingIOError:
+                held = True
+    assert held
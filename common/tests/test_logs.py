@@ -0,0 +1,42 @@
+import logging
+import threading
+from logging.handlers import QueueListener
+from queue import Queue
+from logs import DroppingQueueHandler
+
+
+class RecordingHandler(logging.Handler):
+    """Keeps each formatted line with the thread that formatted it"""
+    def __init__(self) -> None:
+        super().__init__()
+        self.setFormatter(logging.Formatter('%(levelname)s %(message)s'))
+        self.lines = list()
+
+    def emit(self, record) -> None:
+        self.lines.append((self.format(record), threading.current_thread().name))
+
+
+def test_records_are_formatted_by_the_listener():
+    queue, handler = Queue(), RecordingHandler()
+    logger = logging.getLogger('test_logs')
+    logger.propagate = False
+    logger.addHandler(DroppingQueueHandler(queue))
+    listener = QueueListener(queue, handler)
+    listener.start()
+    try:
+        batch = [1, 2]
+        logger.warning("Batch %s", batch)
+        # the line holds the args as they were when it was logged
+        batch.append(3)
+        try:
+            raise ValueError("bad reading")
+        except ValueError:
+            logger.exception("Reading rejected")
+    finally:
+        listener.stop()
+        logger.handlers.clear()
+
+    (line, thread), (failure, failure_thread) = handler.lines
+    assert line == "WARNING Batch [1, 2]"
+    assert failure.startswith("ERROR Reading rejected\nTraceback") and "ValueError: bad reading" in failure
+    assert thread == failure_thread != threading.current_thread().name
@@ -0,0 +1,37 @@
+from threading import Thread
+from metrics import RETIRE_AT, Counter, Histogram
+
+
+def run_threads(target, count: int) -> None:
+    # one at a time, as a server starting a thread per request would
+    for _ in range(count):
+        thread = Thread(target=target)
+        thread.start()
+        thread.join()
+
+
+def test_cells_of_exited_threads_are_retired():
+    counter = Counter('requests_total', "Requests", ('method',))
+    run_threads(lambda: counter.inc('POST'), 2000)
+    assert len(counter.cells) < RETIRE_AT
+    assert counter.collect() == ['requests_total{method="POST"} 2000']
+
+
+def test_live_and_retired_cells_are_summed():
+    counter = Counter('requests_total', "Requests")
+    counter.inc(amount=3)
+    run_threads(lambda: counter.inc(), 5)
+    assert counter.collect() == ['requests_total 8']
+    # this thread is still alive, so its cell is kept and still counted
+    counter.inc()
+    assert counter.collect() == ['requests_total 9']
+
+
+def test_histogram_keeps_observations_of_exited_threads():
+    histogram = Histogram('fetch_seconds', "Fetches", buckets=(0.1, 1))
+    run_threads(lambda: histogram.observe(0.5), 100)
+    lines = histogram.collect()
+    assert 'fetch_seconds_bucket{le="0.1"} 0' in lines
+    assert 'fetch_seconds_bucket{le="1"} 100' in lines
+    assert 'fetch_seconds_count 100' in lines
+    assert len(histogram.cells) < RETIRE_AT
@@ -0,0 +1,83 @@
+import os
+import connexion
+import pytest
+import spec
+from connexion.exceptions import InvalidSpecification
+from connexion.spec import OpenAPISpecification
+
+SOURCE = """
+openapi: 3.0.0
+info:
+  title: Test
+  version: 1.0.0
+paths:
+  /ping:
+    get:
+      operationId: test_spec.ping
+      responses:
+        '200':
+          description: Pong
+          content:
+            application/json:
+              schema:
+                $ref: '#/components/schemas/Pong'
+components:
+  schemas:
+    Pong:
+      type: object
+      properties:
+        pong:
+          type: boolean
+"""
+
+
+def ping():
+    return {'pong': True}, 200
+
+
+def write_spec(directory) -> str:
+    with open(os.path.join(directory, 'openapi.yml'), mode='w') as file:
+        file.write(SOURCE)
+    return str(directory)
+
+
+def test_build_writes_cache(tmp_path):
+    specification_dir = write_spec(tmp_path)
+    spec.build(specification_dir, 'openapi.yml')
+    assert os.path.exists(spec.cache_path(specification_dir, 'openapi.yml'))
+    assert spec.load(specification_dir, 'openapi.yml')[1]
+
+
+def test_build_rejects_invalid_spec(tmp_path):
+    with open(os.path.join(tmp_path, 'openapi.yml'), mode='w') as file:
+        file.write(SOURCE.replace('version: 1.0.0', 'version: [1]'))
+    with pytest.raises(InvalidSpecification):
+        spec.build(str(tmp_path), 'openapi.yml')
+    assert not os.path.exists(spec.cache_path(str(tmp_path), 'openapi.yml'))
+
+
+def test_stale_cache_is_reparsed(tmp_path):
+    specification_dir = write_spec(tmp_path)
+    spec.build(specification_dir, 'openapi.yml')
+    with open(os.path.join(specification_dir, 'openapi.yml'), mode='a') as file:
+        file.write('\n')
+    assert not spec.load(specification_dir, 'openapi.yml')[1]
+
+
+def test_skip_validation_restores_inherited_method():
+    validate = OpenAPISpecification._validate_spec
+    with spec.skip_validation(True):
+        assert OpenAPISpecification._validate_spec({}) is None
+    assert '_validate_spec' not in vars(OpenAPISpecification)
+    assert OpenAPISpecification._validate_spec == validate
+
+
+def test_add_api_from_cache(tmp_path):
+    specification_dir = write_spec(tmp_path)
+    for cached in (False, True):
+        assert spec.load(specification_dir, 'openapi.yml')[1] == cached
+        app = connexion.FlaskApp(__name__, specification_dir=specification_dir)
+        spec.add_api(app, 'openapi.yml', validate_responses=True)
+        response = app.app.test_client().get('/ping')
+        assert response.status_code == 200
+        assert response.get_json() == {'pong': True}
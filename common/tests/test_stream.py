@@ -0,0 +1,29 @@
+from stream import Broadcaster
+
+
+def test_clients_past_the_limit_are_turned_away():
+    feed = Broadcaster('stats', heartbeat_sec=0, max_clients=2)
+    first, second = feed.subscribe(), feed.subscribe()
+    assert feed.subscribe() is None
+
+    # a client that disconnects before its first event frees its place too
+    first.close()
+    third = feed.subscribe()
+    assert third is not None
+    assert next(third).startswith(b'retry: ')
+    second.close()
+    third.close()
+    third.close()
+    assert feed.clients == 0
+
+
+def test_subscribers_receive_the_latest_snapshot():
+    feed = Broadcaster('stats', heartbeat_sec=0)
+    feed.publish({'count': 1})
+    events = feed.subscribe()
+    try:
+        next(events)
+        assert next(events) == b'id: 1\nevent: stats\ndata: {"count": 1}\n\n'
+        assert next(events) == b': heartbeat\n\n'
+    finally:
+        events.close()
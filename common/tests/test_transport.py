@@ -0,0 +1,44 @@
+import pytest
+from pykafka.exceptions import LeaderNotAvailable, ProduceFailureError, SocketDisconnectedError
+from transport import KafkaTransport, TransportError
+
+
+class StubProducer:
+    def __init__(self, error: Exception) -> None:
+        self.error = error
+
+    def produce(self, value: bytes) -> None:
+        raise self.error
+
+
+class StubTopic:
+    """Hands out producers that fail with the next error"""
+    def __init__(self, *errors) -> None:
+        self.errors = list(errors)
+        self.producers = 0
+
+    def get_sync_producer(self) -> StubProducer:
+        self.producers += 1
+        return StubProducer(self.errors.pop(0))
+
+
+def connected(topic: StubTopic) -> KafkaTransport:
+    transport = KafkaTransport('127.0.0.1', 9092, 'telemetry')
+    transport._topic = topic
+    transport.connected.set()
+    return transport
+
+
+def test_produce_raises_transport_error_once_the_retry_fails():
+    topic = StubTopic(SocketDisconnectedError(), LeaderNotAvailable())
+    with pytest.raises(TransportError):
+        connected(topic).produce(b'{}')
+    # the producer was restarted once before giving up
+    assert topic.producers == 2
+
+
+def test_produce_failures_that_are_not_retried_raise_transport_error():
+    topic = StubTopic(ProduceFailureError())
+    with pytest.raises(TransportError):
+        connected(topic).produce(b'{}')
+    assert topic.producers == 1
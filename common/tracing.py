@@ -0,0 +1,75 @@
+"""
+Pipeline tracing
+
+Readings are stamped with the wall clock time, in nanoseconds, as they
+pass each stage of the pipeline:
+- ingest:    the receiver accepted the reading
+- consumed:  storage took the message off the broker
+- committed: storage committed the row
+- stats:     processing published stats that include the row
+
+A sample of readings keep every stamp in a bounded trace store. The
+sample is chosen by hashing the trace id, so each service keeps the
+same readings without coordinating.
+"""
+import time
+from collections import OrderedDict
+from threading import Lock
+from zlib import crc32
+
+INGEST = 'ingest'
+CONSUMED = 'consumed'
+COMMITTED = 'committed'
+STATS = 'stats'
+STAGES = (INGEST, CONSUMED, COMMITTED, STATS)
+# latency of a stage is the time since the previous stamp
+LATENCIES = {CONSUMED: 'broker_dwell', COMMITTED: 'db_commit', STATS: 'time_to_stats'}
+
+# seconds, from 500us to 5m, readings can wait on the broker or the processing interval
+PIPELINE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def now_ns() -> int:
+    return time.time_ns()
+
+
+def stage_latencies(stamps: dict) -> dict:
+    """Seconds spent in each stage that has both of its stamps"""
+    latencies = dict()
+    for previous, stage in zip(STAGES, STAGES[1:]):
+        if previous in stamps and stage in stamps:
+            latencies[LATENCIES[stage]] = (stamps[stage] - stamps[previous]) / 1e9
+    return latencies
+
+
+class TraceStore:
+    """Stamps of sampled traces, the least recently updated are evicted first"""
+    def __init__(self, sample_rate: float, capacity: int) -> None:
+        self.threshold = int(sample_rate * 2 ** 32)
+        self.capacity = capacity
+        self.traces = OrderedDict()  # trace id -> {stage: time in ns}
+        self.lock = Lock()
+
+    def sampled(self, trace_id: str) -> bool:
+        return crc32(trace_id.encode('utf-8')) < self.threshold
+
+    def record(self, trace_id: str, stamps: dict) -> None:
+        """Merges stamps into the trace, if it is sampled"""
+        if not self.sampled(trace_id):
+            return
+        with self.lock:
+            trace = self.traces.pop(trace_id, None) or dict()
+            trace.update(stamps)
+            self.traces[trace_id] = trace
+            while len(self.traces) > self.capacity:
+                self.traces.popitem(last=False)
+
+    def get(self, trace_id: str):
+        if not self.sampled(trace_id):
+            return None
+        with self.lock:
+            trace = self.traces.get(trace_id)
+            return None if trace is None else dict(trace)
+
+    def __len__(self) -> int:
+        return len(self.traces)
@@ -0,0 +1,391 @@
+"""
+Message transport
+
+Produces and consumes the telemetry topic through one interface, so a
+service does not depend on the broker it runs against:
+- kafka:  a Kafka broker (pykafka)
+- memory: an in-process log, for running services in a single process
+- file:   append-only log files in a shared directory, for running
+          services as separate processes on one node without a broker
+
+Kafka connects in the background, local transports are ready at once.
+
+Offsets count messages from 0 in each partition. A consumer seek takes
+the next offset to read, and held offsets are the last offsets read.
+"""
+import json
+import logging
+import os
+import struct
+import time
+from array import array
+from threading import Condition, Event, Lock, Thread
+
+logger = logging.getLogger(__name__)
+
+RECORD_HEADER = struct.Struct('<I')
+
+
+class TransportError(Exception):
+    """Connection to the transport was lost, the consumer or producer should be restarted"""
+
+
+class Message:
+    def __init__(self, partition_id: int, offset: int, value: bytes) -> None:
+        self.partition_id = partition_id
+        self.offset = offset
+        self.value = value
+
+
+# Kafka
+class KafkaConsumer:
+    def __init__(self, topic, group: str = None, from_beginning: bool = False, timeout_ms: int = -1, partitions: list = None) -> None:
+        from pykafka.common import OffsetType
+        kwargs = {
+            'consumer_group': None if group is None else group.encode('utf-8'),
+            'auto_offset_reset': OffsetType.EARLIEST if from_beginning else OffsetType.LATEST,
+            'reset_offset_on_start': from_beginning and group is None,
+            'consumer_timeout_ms': timeout_ms
+        }
+        if partitions is not None:
+            kwargs['partitions'] = [topic.partitions[partition] for partition in partitions]
+        self.topic = topic
+        self.consumer = topic.get_simple_consumer(**kwargs)
+
+    def __iter__(self):
+        from pykafka.exceptions import SocketDisconnectedError
+        try:
+            for msg in self.consumer:
+                yield Message(msg.partition_id, msg.offset, msg.value)
+        except SocketDisconnectedError as e:
+            raise TransportError(e)
+
+    def consume(self):
+        from pykafka.exceptions import SocketDisconnectedError
+        try:
+            msg = self.consumer.consume()
+        except SocketDisconnectedError as e:
+            raise TransportError(e)
+        return None if msg is None else Message(msg.partition_id, msg.offset, msg.value)
+
+    def seek(self, offsets: dict) -> None:
+        # pykafka resets to the last consumed offset
+        self.consumer.reset_offsets([(self.topic.partitions[partition], offset - 1)
+            for partition, offset in offsets.items() if partition in self.topic.partitions])
+
+    def commit(self) -> None:
+        self.consumer.commit_offsets()
+
+    @property
+    def held_offsets(self) -> dict:
+        # unconsumed partitions hold a negative OffsetType
+        return {partition: max(offset, -1) for partition, offset in self.consumer.held_offsets.items()}
+
+    @property
+    def running(self) -> bool:
+        return getattr(self.consumer, '_running', True)
+
+    def restart(self) -> None:
+        self.consumer.stop()
+        self.consumer.start()
+
+    def stop(self) -> None:
+        self.consumer.stop()
+
+
+class KafkaTransport:
+    """Connects to the broker in the background on first use
+
+    A service starts without waiting on the broker. Until the connection
+    is up, producing or consuming raises TransportError.
+    """
+    def __init__(self, host: str, port: int, topic: str, retry_sec: float = 1, max_retry_sec: float = 30) -> None:
+        self.hosts = f'{host}:{port}'
+        self.topic_name = topic
+        self.retry_sec = retry_sec
+        self.max_retry_sec = max_retry_sec
+        self.connected = Event()
+        self.connector = None
+        self._topic = None
+        self.producer = None
+        self.lock = Lock()
+
+    def connect(self) -> None:
+        """Starts connecting in the background, retrying until the broker is reachable"""
+        with self.lock:
+            if self.connector is None:
+                self.connector = Thread(target=self._connect, name='kafka-connect', daemon=True)
+                self.connector.start()
+
+    def _connect(self) -> None:
+        from pykafka import KafkaClient
+        from pykafka.exceptions import KafkaException
+        delay = self.retry_sec
+        retries = 0
+        while True:
+            try:
+                client = KafkaClient(hosts=self.hosts)
+                self._topic = client.topics[str.encode(self.topic_name)]
+            except KafkaException as e:
+                logger.warning("Connection failed - %s - Retrying in %ss (%s)", e, delay, retries)
+                time.sleep(delay)
+                delay = min(delay * 2, self.max_retry_sec)
+                retries += 1
+                continue
+            logger.info("Client connected to Kafka server")
+            self.connected.set()
+            return
+
+    @property
+    def ready(self) -> bool:
+        return self.connected.is_set()
+
+    def wait_ready(self, timeout: float = None) -> bool:
+        self.connect()
+        return self.connected.wait(timeout)
+
+    @property
+    def topic(self):
+        if not self.connected.is_set():
+            self.connect()
+            raise TransportError(f"Not connected to Kafka server at {self.hosts}")
+        return self._topic
+
+    def produce(self, value: bytes) -> None:
+        from pykafka.exceptions import KafkaException, SocketDisconnectedError, LeaderNotAvailable
+        topic = self.topic
+        try:
+            with self.lock:
+                if self.producer is None:
+                    self.producer = topic.get_sync_producer()
+                producer = self.producer
+            try:
+                producer.produce(value)
+            except (SocketDisconnectedError, LeaderNotAvailable) as e:
+                logger.warning("Restarting producer - ERROR: %s", e)
+                with self.lock:
+                    producer = self.producer = topic.get_sync_producer()
+                producer.produce(value)
+        except KafkaException as e:
+            # the restarted producer failed as well, or the broker refused the message
+            raise TransportError(e)
+
+    def consumer(self, group: str = None, from_beginning: bool = False, timeout_ms: int = -1, partitions: list = None) -> KafkaConsumer:
+        return KafkaConsumer(self.topic, group, from_beginning, timeout_ms, partitions)
+
+    def partitions(self) -> list:
+        return list(self.topic.partitions)
+
+    def latest_offsets(self) -> dict:
+        """Next offset to be written in each partition"""
+        from pykafka.exceptions import KafkaException, SocketDisconnectedError
+        topic = self.topic
+        try:
+            return {partition: response.offset[0]
+                for partition, response in topic.latest_available_offsets().items()}
+        except (KafkaException, SocketDisconnectedError) as e:
+            raise TransportError(e)
+
+
+# Local logs
+class LogConsumer:
+    def __init__(self, transport, group: str = None, from_beginning: bool = False, timeout_ms: int = -1, partitions: list = None) -> None:
+        self.transport = transport
+        self.group = group
+        self.timeout_ms = timeout_ms
+        self.partitions = transport.partitions() if partitions is None else partitions
+        committed = transport.committed(group) if group is not None else dict()
+        latest = transport.latest_offsets()
+        # next offset to read in each partition
+        self.positions = {partition: committed.get(partition, 0 if from_beginning else latest[partition])
+            for partition in self.partitions}
+        self.held = {partition: self.positions[partition] - 1 for partition in self.partitions}
+        self.running = True
+
+    def __iter__(self):
+        while True:
+            msg = self.consume()
+            if msg is None:
+                return
+            yield msg
+
+    def consume(self):
+        deadline = None if self.timeout_ms < 0 else time.monotonic() + self.timeout_ms / 1000
+        while True:
+            for partition in self.partitions:
+                value = self.transport.read(partition, self.positions[partition])
+                if value is not None:
+                    offset = self.positions[partition]
+                    self.positions[partition] += 1
+                    self.held[partition] = offset
+                    return Message(partition, offset, value)
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return None
+            self.transport.wait(self.positions, remaining)
+
+    def seek(self, offsets: dict) -> None:
+        for partition, offset in offsets.items():
+            if partition in self.positions:
+                self.positions[partition] = offset
+                self.held[partition] = offset - 1
+
+    def commit(self) -> None:
+        if self.group is not None:
+            self.transport.commit(self.group, dict(self.positions))
+
+    @property
+    def held_offsets(self) -> dict:
+        return dict(self.held)
+
+    def restart(self) -> None:
+        pass
+
+    def stop(self) -> None:
+        self.running = False
+
+
+class MemoryTransport:
+    """In-process log with one partition, shared by every consumer in the process"""
+    def __init__(self) -> None:
+        self.log = list()
+        self.offsets = dict()  # group -> {partition: next offset}
+        self.condition = Condition()
+
+    ready = True
+
+    def connect(self) -> None:
+        pass
+
+    def wait_ready(self, timeout: float = None) -> bool:
+        return True
+
+    def produce(self, value: bytes) -> None:
+        with self.condition:
+            self.log.append(value)
+            self.condition.notify_all()
+
+    def consumer(self, group: str = None, from_beginning: bool = False, timeout_ms: int = -1, partitions: list = None) -> LogConsumer:
+        return LogConsumer(self, group, from_beginning, timeout_ms, partitions)
+
+    def partitions(self) -> list:
+        return [0]
+
+    def latest_offsets(self) -> dict:
+        with self.condition:
+            return {0: len(self.log)}
+
+    def read(self, partition: int, offset: int):
+        with self.condition:
+            return self.log[offset] if 0 <= offset < len(self.log) else None
+
+    def wait(self, positions: dict, timeout) -> None:
+        with self.condition:
+            self.condition.wait_for(lambda: len(self.log) > min(positions.values()), timeout)
+
+    def committed(self, group: str) -> dict:
+        with self.condition:
+            return dict(self.offsets.get(group, dict()))
+
+    def commit(self, group: str, offsets: dict) -> None:
+        with self.condition:
+            self.offsets[group] = offsets
+
+
+class FileTransport:
+    """Append-only log file with one partition, shared by processes on the same node
+
+    Records are length-prefixed and appended under an exclusive file lock.
+    Readers find new records by polling the file size.
+    """
+    def __init__(self, directory: str, topic: str, poll_ms: int = 50) -> None:
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.path = os.path.join(directory, f'{topic}.log')
+        self.topic = topic
+        self.poll_sec = poll_ms / 1000
+        self.positions = array('Q')  # file position of each record
+        self.scanned = 0  # file position scanned up to
+        self.lock = Lock()
+        open(self.path, mode='ab').close()
+        self.file = open(self.path, mode='rb')
+
+    ready = True
+
+    def connect(self) -> None:
+        pass
+
+    def wait_ready(self, timeout: float = None) -> bool:
+        return True
+
+    def produce(self, value: bytes) -> None:
+        import fcntl
+        with open(self.path, mode='ab') as file:
+            fcntl.flock(file, fcntl.LOCK_EX)
+            try:
+                file.write(RECORD_HEADER.pack(len(value)) + value)
+                file.flush()
+            finally:
+                fcntl.flock(file, fcntl.LOCK_UN)
+
+    def consumer(self, group: str = None, from_beginning: bool = False, timeout_ms: int = -1, partitions: list = None) -> LogConsumer:
+        return LogConsumer(self, group, from_beginning, timeout_ms, partitions)
+
+    def partitions(self) -> list:
+        return [0]
+
+    def _scan(self) -> None:
+        # indexes records written since the last scan, stops at a partly written one
+        size = os.path.getsize(self.path)
+        while self.scanned + RECORD_HEADER.size <= size:
+            self.file.seek(self.scanned)
+            length, = RECORD_HEADER.unpack(self.file.read(RECORD_HEADER.size))
+            if self.scanned + RECORD_HEADER.size + length > size:
+                break
+            self.positions.append(self.scanned)
+            self.scanned += RECORD_HEADER.size + length
+
+    def latest_offsets(self) -> dict:
+        with self.lock:
+            self._scan()
+            return {0: len(self.positions)}
+
+    def read(self, partition: int, offset: int):
+        with self.lock:
+            if offset >= len(self.positions):
+                self._scan()
+            if not 0 <= offset < len(self.positions):
+                return None
+            self.file.seek(self.positions[offset])
+            length, = RECORD_HEADER.unpack(self.file.read(RECORD_HEADER.size))
+            return self.file.read(length)
+
+    def wait(self, positions: dict, timeout) -> None:
+        time.sleep(self.poll_sec if timeout is None else min(self.poll_sec, timeout))
+
+    def _offsets_path(self, group: str) -> str:
+        return os.path.join(self.directory, f'{self.topic}.{group}.offsets')
+
+    def committed(self, group: str) -> dict:
+        if not os.path.exists(self._offsets_path(group)):
+            return dict()
+        with open(self._offsets_path(group), mode='r') as file:
+            return {int(partition): offset for partition, offset in json.load(file).items()}
+
+    def commit(self, group: str, offsets: dict) -> None:
+        temp = self._offsets_path(group) + '.tmp'
+        with open(temp, mode='w') as file:
+            json.dump(offsets, file)
+        os.replace(temp, self._offsets_path(group))
+
+
+def create_transport(config: dict, server: dict = None, topic: str = None):
+    """Transport from the `transport` section of app_conf.yml, Kafka by default"""
+    kind = config.get('type', 'kafka')
+    if kind == 'kafka':
+        return KafkaTransport(server['host'], server['port'], topic, config.get('retry_sec', 1), config.get('max_retry_sec', 30))
+    if kind == 'memory':
+        return MemoryTransport()
+    if kind == 'file':
+        return FileTransport(config['directory'], topic, config.get('poll_ms', 50))
+    raise ValueError(f"Unknown transport: {kind}")
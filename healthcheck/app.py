@@ -5,25 +5,43 @@ Healthcheck Service
 Polls all services for status. Forwards to a user interface service.
 
 Environment configuration
+SERVICES (dict):        services to poll, by name, with an optional health URL
+GRADING (dict):         yellow and red thresholds for the load signals services report
+TIMEOUT (integer):      request timeout per service, in seconds
+SWEEP_DEADLINE (float): longest a sweep waits for all services, in seconds
+BREAKER (dict):         failures before a service is backed off, backoff and re-probe periods
+HISTORY (dict):         retention of raw status rows and of minute and hour rollups
+HTTP (dict):            gunicorn workers, gevent connections per worker, and the lock file electing the polling worker
 """
 import connexion
 import json
 import logging
-import logging.config
+import logs
 import os
 import requests
 import sqlite3
 import time
+import spec
 import yaml
 from apscheduler.schedulers.background import BackgroundScheduler
+from breaker import CircuitBreaker
+from concurrent.futures import ThreadPoolExecutor, wait
 from connexion import NoContent
-from datetime import datetime
-from data import Base, Health, sqlite_client, create_table, version
+from datetime import datetime, timedelta
+from data import Base, Health, HealthRollup, sqlite_client, add_columns, added_columns, create_table, create_index, create_rollups, version
+from flask import Response
+from leader import Leader, file_lock
+from metrics import Registry
+from requests.adapters import HTTPAdapter
+from rollup import Rollup, RollupSet, MINUTE, HOUR, bucket_start, parse_window, resolution_for, window_start
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
+from stream import Broadcaster
+from threading import Thread
 
 # Constants
 DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+NOT_POLLED = "not polled"
 
 # Environment config
 if 'TARGET_ENV' in os.environ and os.environ['TARGET_ENV'] == 'prod':
@@ -38,7 +56,7 @@ else:
 # Logging config
 with open(log_conf_file, mode='r') as file:
     log_config = yaml.safe_load(file.read())
-    logging.config.dictConfig(log_config)
+    logs.configure(log_config)
 
 logger = logging.getLogger('healthcheck')
 
@@ -49,158 +67,391 @@ with open(app_conf_file, mode='r') as file:
 FQDN_URL = app_config['localhost']['fqdn']
 DATA_URL = app_config['datastore']['filename']
 INTERVAL = app_config['scheduler']['period_sec']
+TICK = app_config['scheduler']['tick_sec']
+JITTER = app_config['scheduler']['jitter']
 TIMEOUT = app_config['connection']['timeout']
+SWEEP_DEADLINE = app_config['connection']['sweep_deadline_sec']
+SERVICES = {
+    name: url or f'{FQDN_URL}/{name}/health' 
+    for name, url in app_config['services'].items()
+}
+GRADING = app_config['grading']
+GREEN, YELLOW, RED = "green", "yellow", "red"
+BREAKER = app_config['breaker']
+HISTORY = app_config['history']
+HTTP = app_config['http']
+SLO_QUANTILES = (0.5, 0.9, 0.99)
 
 DB_ENGINE = create_engine(f"sqlite:///{DATA_URL}")
 Base.metadata.bind = DB_ENGINE
 DB_SESSION = sessionmaker(bind=DB_ENGINE)
 
+POLL_WORKERS = min(len(SERVICES), app_config['connection']['max_workers'])
+HTTP_SESSION = requests.Session()
+HTTP_SESSION.mount('http://', HTTPAdapter(pool_connections=len(SERVICES), pool_maxsize=POLL_WORKERS))
+HTTP_SESSION.mount('https://', HTTPAdapter(pool_connections=len(SERVICES), pool_maxsize=POLL_WORKERS))
+POLL_POOL = ThreadPoolExecutor(max_workers=POLL_WORKERS, thread_name_prefix='poll')
+
+HEALTH_FEED = Broadcaster('health', heartbeat_sec=app_config['stream']['heartbeat_sec'], ignore=('last_updated',), max_clients=app_config['stream']['max_clients'])
+ROLLUPS = RollupSet()
+SIGNALS = dict()  # service -> load signals from its last successful probe
+BREAKERS = {
+    service: CircuitBreaker(
+        INTERVAL, 
+        failure_threshold=BREAKER['failure_threshold'], 
+        fast_period_sec=BREAKER['fast_period_sec'], 
+        backoff_base_sec=BREAKER['backoff_base_sec'], 
+        backoff_max_sec=BREAKER['backoff_max_sec'], 
+        jitter=JITTER
+    ) 
+    for service in SERVICES
+}
+LATEST_STATUS = None  # last sweep, served without touching the database
+# only the leader worker polls, the others follow the status it saves
+LEADER = Leader(HTTP['leader_lock'])
+
+METRICS = Registry('healthcheck')
+METRICS.add(logs.DROPPED)
+PROBE_SECONDS = METRICS.histogram('probe_seconds', "Time to probe a service", ('service', 'result'))
+SWEEP_SECONDS = METRICS.histogram('sweep_seconds', "Time to poll, grade and record one sweep")
+
 # endpoints
 def get_health() -> dict:
-    data = query_db()
-    status = {
-        "system": data['system'], 
-        "receiver": data['receiver'], 
-        "storage": data['storage'], 
-        "audit_log": data['audit_log'], 
-        "processing": data['processing'], 
-        "last_updated": data['last_updated']
+    return LATEST_STATUS, 200
+
+def ready():
+    checks = {"status": LATEST_STATUS is not None}
+    if not all(checks.values()):
+        return {"message": "Not ready", "checks": checks}, 503
+    return {"message": "OK", "checks": checks}, 200
+
+def get_slo(window: str = '24h') -> dict:
+    try:
+        minutes = parse_window(window)
+    except ValueError as e:
+        return { "message": str(e) }, 400
+    now = datetime.now()
+    resolution = resolution_for(minutes, HISTORY['minute_retention_hours'])
+    totals = query_rollups(resolution, window_start(minutes, resolution, now))
+    services = dict()
+    for service in SERVICES:
+        rollup = totals.get(service)
+        if rollup is None:
+            continue
+        services[service] = {
+            "availability": rollup.availability(), 
+            "checks": rollup.total, 
+            "latency_ms": {f"p{round(q * 100)}": rollup.quantile(q) for q in SLO_QUANTILES}
         }
-    return status, 200
+    return {
+        "window": window, 
+        "resolution": resolution, 
+        "services": services, 
+        "last_updated": datetime.strftime(now, DATETIME_FORMAT)
+        }, 200
+
+def stream_health():
+    events = HEALTH_FEED.subscribe()
+    if events is None:
+        # each stream holds a worker connection, the clients turned away poll /health instead
+        return {"message": "Too many streaming clients, poll /healthcheck/health"}, 503
+    # passed through unbuffered, connexion would otherwise read the endless stream to validate it
+    return Response(
+        events,
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+        direct_passthrough=True
+    )
+
+def get_metrics():
+    return Response(METRICS.exposition(), mimetype='text/plain')
 
 # Poll services
+def probe(service):
+    started = time.perf_counter()
+    response = check_(service)
+    PROBE_SECONDS.observe(time.perf_counter() - started, service, 'up' if response is not None else 'down')
+    return response
+
 def check_(service):
     try:
-        res = requests.get(
-            f'{FQDN_URL}/{service}/health', 
+        res = HTTP_SESSION.get(
+            f'{SERVICES[service]}/detail', 
             timeout=TIMEOUT
             )
         res.raise_for_status()
         if res.status_code == 200:
             msg = json.loads(res.text)
-            response = {"message": msg['message'], "status_code": res.status_code}
-            logger.debug(f"{service} - {response}")
+            response = {
+                "message": msg['message'], 
+                "status_code": res.status_code, 
+                "latency_ms": res.elapsed.total_seconds() * 1000, 
+                "signals": msg.get('signals', dict())
+            }
+            logger.debug("%s - %s", service, response)
             
             return response
         else:
             return None
 
     except requests.exceptions.ReadTimeout as timeout_err:
-        logger.error(f"{service} - Timeout ({TIMEOUT}) exceeded. {timeout_err}")
+        logger.error("%s - Timeout (%s) exceeded. %s", service, TIMEOUT, timeout_err)
         return None
     
     except requests.exceptions.ConnectionError as err:
-        logger.error(f"{service} - Connection failed. {err}")
+        logger.error("%s - Connection failed. %s", service, err)
         return None
 
     except requests.exceptions.RequestException as e:
-        logger.error(f"{service} - {e}")
+        logger.error("%s - %s", service, e)
         return None
 
 # health check
+def grade_service(signals: dict) -> str:
+    """Grades a running service on its load signals"""
+    grade = GREEN
+    for flag in GRADING['flags']:
+        if signals.get(flag) is False:
+            logger.warning("%s is false", flag)
+            return RED
+    for signal, thresholds in GRADING['thresholds'].items():
+        value = signals.get(signal)
+        if value is None:
+            continue
+        if value >= thresholds['red']:
+            logger.warning("%s (%s) over red threshold (%s)", signal, value, thresholds['red'])
+            return RED
+        if value >= thresholds['yellow']:
+            grade = YELLOW
+    return grade
+
+def grade_system(grades: dict) -> str:
+    # services that are down make the system yellow, as before, unless none are up
+    running = [grade for service, grade in grades.items() if BREAKERS[service].up]
+    if not running or RED in running:
+        return RED
+    if len(running) == len(grades) and all(grade == GREEN for grade in running):
+        return GREEN
+    return YELLOW
+
+def poll_services(services: list) -> dict:
+    """Polls services at once and returns each response, or None if the service is down"""
+    futures = {POLL_POOL.submit(probe, service): service for service in services}
+    done, not_done = wait(futures, timeout=SWEEP_DEADLINE)
+    results = {futures[future]: future.result() for future in done}
+    for future in not_done:
+        # still waiting on the request timeout, so the service counts as down for this sweep
+        logger.error("%s - Sweep deadline (%s) exceeded", futures[future], SWEEP_DEADLINE)
+        results[futures[future]] = None
+    return results
+
 def check_health():
-    logger.info(f"Checking health of services")
-    system = []
-    services = [
-        "receiver", 
-        "storage", 
-        "audit_log", 
-        "processing"
-        ]
-    status = {
-        "system": str | None, 
-        "receiver": str | None, 
-        "storage": str | None, 
-        "audit_log": str | None, 
-        "processing": str | None,
-        "last_updated": str | None
-        }
-    for service in services:
-        res = check_(service)
-        if res == None:
+    with SWEEP_SECONDS.time():
+        sweep()
+
+def sweep():
+    global LATEST_STATUS
+    logger.info("Checking health of services")
+    status = dict()
+    grades = dict()
+    now = datetime.now()
+    # only services whose breaker is due are probed, the rest keep their last result
+    due = [service for service, breaker in BREAKERS.items() if breaker.due()]
+    results = poll_services(due)
+    for service, breaker in BREAKERS.items():
+        if service in results:
+            res = results[service]
+            if breaker.record(res is not None):
+                logger.warning("%s circuit %s", service, breaker.state)
+            if res is not None:
+                SIGNALS[service] = res['signals']
+            # only probes count towards availability and latency, not the sweeps a breaker skipped
+            ROLLUPS.add(service, res is not None, res['latency_ms'] if res is not None else None, now)
+        if not breaker.up:
             status[service] = "down"
-            system.append(0)
-            logger.info(f"{service} status: {status[service]}")
+            grades[service] = RED
         else:
             status[service] = "running"
-            system.append(1)
-            logger.info(f"{service} status: {status[service]}")
+            grades[service] = grade_service(SIGNALS.get(service, dict()))
+        logger.info("%s status: %s (%s)", service, status[service], grades[service])
     
-    if all(system):
-        status['system'] = "green"
-        logger.info(f"System status: Green")
-    elif any(system):
-        status['system'] = "yellow"
-        logger.warning(f"System status: Yellow")
-    elif not all(system):
-        status['system'] = "red"
-        logger.critical(f"System status: Red")
+    system = grade_system(grades)
+    if system == GREEN:
+        logger.info("System status: Green")
+    elif system == YELLOW:
+        logger.warning("System status: Yellow")
+    else:
+        logger.critical("System status: Red")
     
-    status['last_updated'] = datetime.strftime(datetime.now(), DATETIME_FORMAT)
+    status = snapshot(system, status, grades, now)
+    LATEST_STATUS = status
     insert_(status)
+    save_rollups(now)
+    HEALTH_FEED.publish(status)
+
+def snapshot(system: str, services: dict, grades: dict, last_updated: datetime) -> dict:
+    """Status served by /health and the stream, built the same way from a sweep and from a saved row"""
+    status = dict(services)
+    status['system'] = system
+    status['grades'] = grades
+    status['last_updated'] = datetime.strftime(last_updated, DATETIME_FORMAT)
+    return status
 
 # database utilities
 def query_db():
     session = DB_SESSION()
     result = session.query(Health).order_by(Health.last_updated.desc()).first()
-    status = {
-        "system": result.system, 
-        "receiver": result.receiver, 
-        "storage": result.storage, 
-        "audit_log": result.audit_log, 
-        "processing": result.processing,
-        "last_updated": result.last_updated.strftime(DATETIME_FORMAT)
-        }
+    if result.services is not None:
+        services = json.loads(result.services)
+    else:
+        # written before every service was saved, only the original services have columns
+        services = {
+            "receiver": result.receiver, 
+            "storage": result.storage, 
+            "audit_log": result.audit_log, 
+            "processing": result.processing
+            }
+    status = snapshot(result.system, services, json.loads(result.grades or '{}'), result.last_updated)
     session.close()
 
     return status
 
 def insert_(data: dict) -> None:
     session = DB_SESSION()
+    # the original services also keep their own columns
     status = Health(
         system=data['system'], 
-        receiver=data['receiver'], 
-        storage=data['storage'], 
-        audit_log=data['audit_log'], 
-        processing=data['processing'], 
-        last_updated=datetime.strptime(data['last_updated'], DATETIME_FORMAT)
+        receiver=data.get('receiver', NOT_POLLED), 
+        storage=data.get('storage', NOT_POLLED), 
+        audit_log=data.get('audit_log', NOT_POLLED), 
+        processing=data.get('processing', NOT_POLLED), 
+        last_updated=datetime.strptime(data['last_updated'], DATETIME_FORMAT), 
+        services=json.dumps({service: data.get(service, NOT_POLLED) for service in SERVICES}), 
+        grades=json.dumps(data.get('grades', dict()))
         )
     session.add(status)
     session.commit()
 
     session.close()
 
+def save_rollups(timestamp: datetime) -> None:
+    rows = ROLLUPS.flush(timestamp)
+    if not rows:
+        return
+    session = DB_SESSION()
+    for service, resolution, start, up, total, counts in rows:
+        rollup = session.query(HealthRollup).filter_by(resolution=resolution, start=start, service=service).first()
+        if rollup is None:
+            session.add(HealthRollup(service, resolution, start, up, total, counts))
+        else:
+            rollup.up = up
+            rollup.total = total
+            rollup.counts = counts
+    session.commit()
+
+    session.close()
+
+def load_rollups() -> None:
+    # rollups of the current minute and hour keep counting after a restart
+    now = datetime.now()
+    session = DB_SESSION()
+    for resolution in (MINUTE, HOUR):
+        rows = session.query(HealthRollup).filter_by(resolution=resolution, start=bucket_start(resolution, now))
+        for row in rows:
+            ROLLUPS.load(row.service, row.resolution, row.start, row.up, row.total, row.counts)
+    session.close()
+
+def query_rollups(resolution: str, start: datetime) -> dict:
+    """Rollups of each service since start, merged into one"""
+    session = DB_SESSION()
+    rows = session.query(HealthRollup).filter(
+        HealthRollup.resolution == resolution, 
+        HealthRollup.start >= start
+        )
+    totals = dict()
+    for row in rows:
+        rollup = totals.setdefault(row.service, Rollup())
+        rollup.merge(Rollup(row.up, row.total, row.counts))
+    session.close()
+
+    return totals
+
+def prune_db() -> None:
+    now = datetime.now()
+    session = DB_SESSION()
+    raw = session.query(Health).filter(
+        Health.last_updated < now - timedelta(hours=HISTORY['raw_retention_hours'])
+        ).delete()
+    minutes = session.query(HealthRollup).filter(
+        HealthRollup.resolution == MINUTE, 
+        HealthRollup.start < now - timedelta(hours=HISTORY['minute_retention_hours'])
+        ).delete()
+    hours = session.query(HealthRollup).filter(
+        HealthRollup.resolution == HOUR, 
+        HealthRollup.start < now - timedelta(days=HISTORY['hour_retention_days'])
+        ).delete()
+    session.commit()
+
+    session.close()
+    logger.info("Health history pruned. Removed %s status rows, %s rollups", raw, minutes + hours)
+
 def init_database(filename: str):
     init_msg = "starting.."
-    status = {
-        "system": init_msg, 
-        "receiver": init_msg, 
-        "storage": init_msg, 
-        "audit_log": init_msg, 
-        "processing": init_msg,
-        "last_updated": datetime.strftime(datetime.now(), DATETIME_FORMAT)
-        }
+    status = snapshot(init_msg, {service: init_msg for service in SERVICES}, dict(), datetime.now())
     abs_path = os.path.join(os.path.dirname(__file__), filename)
     if not os.path.exists(abs_path):
         sqlite_client(abs_path, create_table)
+        sqlite_client(abs_path, create_index)
+        sqlite_client(abs_path, create_rollups)
         insert_(status)
-        logger.info(f"Datastore: {abs_path}")
+        logger.info("Datastore: %s", abs_path)
     elif os.path.exists(abs_path):
-        logger.info(f"Datastore: {abs_path}")
+        add_columns(abs_path, 'health', added_columns)
+        sqlite_client(abs_path, create_index)
+        sqlite_client(abs_path, create_rollups)
+        logger.info("Datastore: %s", abs_path)
 
 
 def init_scheduler(interval: int) -> None:
-    sched = BackgroundScheduler(daemon=True, job_defaults={'max_instances': 3})
-    sched.add_job(check_health, 'interval', seconds=interval)
+    # sweeps are bounded by the deadline, so they never overlap
+    sched = BackgroundScheduler(daemon=True, job_defaults={'max_instances': 1, 'coalesce': True})
+    # each sweep only probes the services that are due, see BREAKERS
+    sched.add_job(check_health, 'interval', seconds=interval, jitter=interval * JITTER, id='check_health')
+    sched.add_job(prune_db, 'interval', seconds=HISTORY['prune_period_sec'], id='prune_db')
     sched.start()
 
 app = connexion.FlaskApp(__name__, specification_dir='openapi/')
-app.add_api('openapi.yml', base_path='/healthcheck', strict_validation=True, validate_responses=True)
+spec.add_api(app, 'openapi.yml', base_path='/healthcheck', strict_validation=True, validate_responses=True)
+METRICS.instrument(app.app)
+application = app.app
+
+
+def start_worker() -> None:
+    """Starts a worker, called by gunicorn after the fork, the leader also polls the services"""
+    global LATEST_STATUS
+    with file_lock(f'{DATA_URL}.lock'):
+        init_database(DATA_URL)
+    LATEST_STATUS = query_db()
+    HEALTH_FEED.publish(LATEST_STATUS)
+    LEADER.campaign(start_polling)
+    Thread(target=follow_leader, name='follow', daemon=True).start()
+
+def start_polling() -> None:
+    load_rollups()
+    init_scheduler(TICK)
 
+def follow_leader() -> None:
+    global LATEST_STATUS
+    while not LEADER.elected.wait(TICK):
+        try:
+            LATEST_STATUS = query_db()
+        except Exception as e:
+            logger.warning("Unable to follow the leader's status - %s", e)
+            continue
+        HEALTH_FEED.publish(LATEST_STATUS)
 
 def main() -> None:
-    init_database(DATA_URL)
-    init_scheduler(INTERVAL)
+    start_worker()
     app.run(port=8120, debug=False)
 
 
@@ -0,0 +1,69 @@
+"""
+Circuit breakers
+
+Decides when each service is probed next. A healthy service is probed
+every period, a failing one trips its breaker open after a few failures
+and is then only re-probed (half-open) after an exponential backoff, so
+a service that is hard down costs one request per backoff instead of a
+full timeout on every sweep. Services are probed sooner right after a
+state change, and every delay is jittered so the probes of several
+healthcheck replicas drift apart.
+"""
+import random
+import time
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitBreaker:
+    def __init__(self, period_sec: float, failure_threshold: int = 2, fast_period_sec: float = 5,
+            backoff_base_sec: float = 20, backoff_max_sec: float = 300, jitter: float = 0.1) -> None:
+        self.period_sec = period_sec
+        self.failure_threshold = failure_threshold
+        self.fast_period_sec = fast_period_sec
+        self.backoff_base_sec = backoff_base_sec
+        self.backoff_max_sec = backoff_max_sec
+        self.jitter = jitter
+        self.state = CLOSED
+        self.failures = 0  # consecutive
+        self.trips = 0  # consecutive times opened, for the backoff
+        self.next_probe = 0.0
+        self.up = False  # result of the last probe
+
+    def _delay(self, seconds: float) -> float:
+        return seconds * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def due(self, now: float = None) -> bool:
+        now = time.monotonic() if now is None else now
+        if now < self.next_probe:
+            return False
+        if self.state == OPEN:
+            self.state = HALF_OPEN
+        return True
+
+    def record(self, success: bool, now: float = None) -> bool:
+        """Updates the breaker with a probe result, returns True if its state changed"""
+        now = time.monotonic() if now is None else now
+        previous = self.state
+        self.up = success
+        if success:
+            self.state = CLOSED
+            self.failures = 0
+            self.trips = 0
+        else:
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = OPEN
+                self.trips += 1
+
+        if self.state == OPEN:
+            backoff = min(self.backoff_base_sec * 2 ** (self.trips - 1), self.backoff_max_sec)
+            self.next_probe = now + self._delay(backoff)
+        elif self.state != previous or self.failures:
+            # confirm a recovery, or a first failure, sooner than the regular period
+            self.next_probe = now + self._delay(self.fast_period_sec)
+        else:
+            self.next_probe = now + self._delay(self.period_sec)
+        return self.state != previous and not (previous == HALF_OPEN and self.state == OPEN)
@@ -1,6 +1,6 @@
 import sqlite3
 from sqlite3 import OperationalError
-from sqlalchemy import Column, Integer, String, DateTime
+from sqlalchemy import Column, Integer, String, Text, DateTime, LargeBinary
 from sqlalchemy.ext.declarative import declarative_base
 
 Base = declarative_base()
@@ -14,15 +14,20 @@ class Health(Base):
     storage = Column(String(250), nullable=False)
     audit_log = Column(String(250), nullable=False)
     processing = Column(String(250), nullable=False)
-    last_updated = Column(DateTime, nullable=False)
+    last_updated = Column(DateTime, nullable=False, index=True)
+    # JSON, status and grade of every polled service, missing in rows written before they were added
+    services = Column(Text, nullable=True)
+    grades = Column(Text, nullable=True)
 
-    def __init__(self, system, receiver, storage, audit_log, processing, last_updated) -> None:
+    def __init__(self, system, receiver, storage, audit_log, processing, last_updated, services=None, grades=None) -> None:
         self.system = system
         self.receiver = receiver
         self.storage = storage
         self.audit_log = audit_log
         self.processing = processing
         self.last_updated = last_updated
+        self.services = services
+        self.grades = grades
 
     def to_dict(self):
         dict = {}
@@ -32,10 +37,32 @@ class Health(Base):
         dict['audit_log'] = self.audit_log
         dict['processing'] = self.processing
         dict['last_updated'] = self.last_updated
+        dict['services'] = self.services
+        dict['grades'] = self.grades
 
         return dict
 
 
+class HealthRollup(Base):
+    __tablename__ = "rollups"
+
+    id_ = Column(Integer, primary_key=True)
+    service = Column(String(250), nullable=False)
+    resolution = Column(String(10), nullable=False)
+    start = Column(DateTime, nullable=False)
+    up = Column(Integer, nullable=False)
+    total = Column(Integer, nullable=False)
+    counts = Column(LargeBinary, nullable=False)
+
+    def __init__(self, service, resolution, start, up, total, counts) -> None:
+        self.service = service
+        self.resolution = resolution
+        self.start = start
+        self.up = up
+        self.total = total
+        self.counts = counts
+
+
 def sqlite_client(database, query):
     with sqlite3.connect(database) as conn:
         c = conn.cursor()
@@ -45,6 +72,15 @@ def sqlite_client(database, query):
         finally:
             c.close()
 
+def add_columns(database, table, columns: dict):
+    """Adds the columns a table created by an earlier version is missing"""
+    with sqlite3.connect(database) as conn:
+        existing = {row[1] for row in conn.execute(f'PRAGMA table_info({table})')}
+        for name, kind in columns.items():
+            if name not in existing:
+                conn.execute(f'ALTER TABLE {table} ADD COLUMN {name} {kind}')
+        conn.commit()
+
 create_table = '''
     CREATE TABLE IF NOT EXISTS health
     (id_ INTEGER PRIMARY KEY ASC,
@@ -53,7 +89,30 @@ create_table = '''
     storage VARCHAR(250) NOT NULL,
     audit_log VARCHAR(250) NOT NULL,
     processing VARCHAR(250) NOT NULL,
-    last_updated VARCHAR(100) NOT NULL)
+    last_updated VARCHAR(100) NOT NULL,
+    services TEXT,
+    grades TEXT)
+'''
+
+added_columns = {
+    'services': 'TEXT',
+    'grades': 'TEXT'
+}
+
+create_index = '''
+    CREATE INDEX IF NOT EXISTS ix_health_last_updated ON health (last_updated)
+'''
+
+create_rollups = '''
+    CREATE TABLE IF NOT EXISTS rollups
+    (id_ INTEGER PRIMARY KEY ASC,
+    service VARCHAR(250) NOT NULL,
+    resolution VARCHAR(10) NOT NULL,
+    start VARCHAR(100) NOT NULL,
+    up INTEGER NOT NULL,
+    total INTEGER NOT NULL,
+    counts BLOB NOT NULL,
+    UNIQUE (resolution, start, service))
 '''
 
 drop_table = '''
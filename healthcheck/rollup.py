@@ -0,0 +1,128 @@
+"""
+Latency histograms and uptime rollups
+
+Each poll adds one check to its service's current minute and hour.
+Latencies are counted in fixed log-linear buckets (HDR-style: each
+power of two in milliseconds is split into equal sub-buckets), so a
+rollup is a small array of counts that merges by addition, and any
+percentile is read back within one sub-bucket of the true value.
+"""
+from array import array
+from datetime import datetime, timedelta
+from threading import Lock
+
+SUB_BUCKETS = 8
+MAX_POWER = 17  # ~131s, beyond any request timeout
+MINUTE = 'minute'
+HOUR = 'hour'
+UNITS = {'m': 1, 'h': 60, 'd': 1440}
+
+
+def parse_window(label: str) -> int:
+    """Converts a window label (eg. 30m, 24h, 7d) to minutes"""
+    try:
+        size = int(label[:-1]) * UNITS[label[-1]]
+    except (KeyError, ValueError, IndexError):
+        raise ValueError(f"Invalid window: {label}")
+    if size <= 0:
+        raise ValueError(f"Invalid window: {label}")
+
+    return size
+
+def bucket_bounds() -> list:
+    """Upper bound (ms) of each latency bucket"""
+    bounds = [1.0]
+    for power in range(MAX_POWER):
+        low = 2 ** power
+        bounds.extend(low + low * (step + 1) / SUB_BUCKETS for step in range(SUB_BUCKETS))
+    return bounds
+
+BOUNDS = bucket_bounds()
+
+def bucket_of(latency_ms: float) -> int:
+    if latency_ms <= 1:
+        return 0
+    power = min(int(latency_ms).bit_length() - 1, MAX_POWER - 1)
+    low = 2 ** power
+    step = min(int((latency_ms - low) * SUB_BUCKETS / low), SUB_BUCKETS - 1)
+    return 1 + power * SUB_BUCKETS + step
+
+def bucket_start(resolution: str, timestamp: datetime) -> datetime:
+    if resolution == MINUTE:
+        return timestamp.replace(second=0, microsecond=0)
+    return timestamp.replace(minute=0, second=0, microsecond=0)
+
+
+class Rollup:
+    def __init__(self, up: int = 0, total: int = 0, counts: bytes = None) -> None:
+        self.up = up
+        self.total = total
+        self.counts = array('I', [0] * len(BOUNDS))
+        if counts:
+            self.counts = array('I', counts)
+
+    def add(self, up: bool, latency_ms: float) -> None:
+        self.total += 1
+        if up:
+            self.up += 1
+        if latency_ms is not None:
+            self.counts[bucket_of(latency_ms)] += 1
+
+    def merge(self, other) -> None:
+        self.up += other.up
+        self.total += other.total
+        for index, count in enumerate(other.counts):
+            self.counts[index] += count
+
+    def quantile(self, q: float):
+        """Upper bound (ms) of the bucket holding the qth latency, or None if there are none"""
+        samples = sum(self.counts)
+        if not samples:
+            return None
+        rank = q * samples
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return BOUNDS[index]
+        return BOUNDS[-1]
+
+    def availability(self):
+        return None if not self.total else self.up / self.total
+
+
+class RollupSet:
+    def __init__(self) -> None:
+        self.open = dict()  # (service, resolution, start) -> Rollup
+        self.dirty = set()
+        self.lock = Lock()
+
+    def load(self, service: str, resolution: str, start: datetime, up: int, total: int, counts: bytes) -> None:
+        # rollups still open when the service stopped
+        with self.lock:
+            self.open[(service, resolution, start)] = Rollup(up, total, counts)
+
+    def add(self, service: str, up: bool, latency_ms: float, timestamp: datetime) -> None:
+        with self.lock:
+            for resolution in (MINUTE, HOUR):
+                key = (service, resolution, bucket_start(resolution, timestamp))
+                self.open.setdefault(key, Rollup()).add(up, latency_ms)
+                self.dirty.add(key)
+
+    def flush(self, timestamp: datetime) -> list:
+        """Changed rollups as (service, resolution, start, up, total, counts), dropping closed ones from memory"""
+        with self.lock:
+            rows = [key + (self.open[key].up, self.open[key].total, self.open[key].counts.tobytes())
+                for key in self.dirty]
+            self.dirty = set()
+            for key in list(self.open):
+                if key[2] < bucket_start(key[1], timestamp):
+                    del self.open[key]
+        return rows
+
+
+def resolution_for(minutes: int, minute_retention_hours: int) -> str:
+    return MINUTE if minutes <= minute_retention_hours * 60 else HOUR
+
+def window_start(minutes: int, resolution: str, timestamp: datetime) -> datetime:
+    return bucket_start(resolution, timestamp - timedelta(minutes=minutes))
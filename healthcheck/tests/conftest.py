@@ -0,0 +1,61 @@
+"""
+Runs the service against SQLite, with the polled services unreachable
+
+    cd healthcheck
+    python -m pytest tests
+"""
+import os
+import shutil
+import sys
+import time
+import pytest
+import yaml
+
+SERVICE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [SERVICE, os.path.join(os.path.dirname(SERVICE), 'common')]
+
+
+def wait_for(condition, timeout_sec: float = 5):
+    deadline = time.monotonic() + timeout_sec
+    while not condition():
+        if time.monotonic() > deadline:
+            raise TimeoutError("Condition not met")
+        time.sleep(0.01)
+
+
+@pytest.fixture(scope='session')
+def healthcheck(tmp_path_factory):
+    directory = tmp_path_factory.mktemp('healthcheck')
+    with open(os.path.join(SERVICE, 'app_conf.yml'), mode='r') as file:
+        app_config = yaml.safe_load(file.read())
+    # nothing listens on the discard port, so every probe fails at once
+    app_config['localhost']['fqdn'] = 'http://127.0.0.1:9'
+    app_config['datastore']['filename'] = str(directory / 'healthcheck.sqlite')
+    # a service without a column of its own in the health table
+    app_config['services']['dashboard'] = None
+    # sweeps are run by the tests rather than the scheduler
+    app_config['scheduler']['tick_sec'] = 3600
+    app_config['history']['prune_period_sec'] = 3600
+    app_config['stream']['heartbeat_sec'] = 1
+    app_config['http']['leader_lock'] = str(directory / 'healthcheck.leader')
+    with open(directory / 'app_conf.yml', mode='w') as file:
+        yaml.safe_dump(app_config, file)
+    shutil.copy(os.path.join(SERVICE, 'log_conf.yml'), directory)
+
+    # config and log files are read from the working directory on import
+    cwd = os.getcwd()
+    os.environ['TARGET_ENV'] = 'test'
+    os.chdir(directory)
+    try:
+        import app
+    finally:
+        os.chdir(cwd)
+
+    app.start_worker()
+    wait_for(lambda: app.LEADER.is_leader)
+    return app
+
+
+@pytest.fixture()
+def client(healthcheck):
+    return healthcheck.app.app.test_client()
@@ -0,0 +1,71 @@
+import json
+import sqlite3
+
+
+def test_health_stream_sends_the_status_first(client):
+    response = client.get('/healthcheck/health/stream', buffered=False)
+    try:
+        assert response.status_code == 200
+        assert response.mimetype == 'text/event-stream'
+        frames = iter(response.response)
+        assert next(frames).startswith(b'retry: ')
+        frame = next(frames).decode('utf-8')
+        fields = dict(line.split(': ', 1) for line in frame.strip().splitlines())
+        assert fields['event'] == 'health'
+        assert 'system' in json.loads(fields['data'])
+    finally:
+        response.close()
+
+
+def test_health_after_a_sweep(client, healthcheck):
+    healthcheck.sweep()
+    response = client.get('/healthcheck/health')
+    assert response.status_code == 200
+    status = response.get_json()
+    # nothing is listening, so every service is down
+    assert status['system'] == 'red'
+    for service in ('receiver', 'storage', 'audit_log', 'processing', 'dashboard'):
+        assert status[service] == 'down'
+        assert status['grades'][service] == 'red'
+
+
+def test_followers_serve_the_same_status(healthcheck):
+    healthcheck.sweep()
+    assert healthcheck.query_db() == healthcheck.LATEST_STATUS
+
+
+def test_rows_from_before_the_services_column(healthcheck, tmp_path):
+    database = str(tmp_path / 'health.sqlite')
+    with sqlite3.connect(database) as conn:
+        conn.execute('''
+            CREATE TABLE health
+            (id_ INTEGER PRIMARY KEY ASC,
+            system VARCHAR(250) NOT NULL,
+            receiver VARCHAR(250) NOT NULL,
+            storage VARCHAR(250) NOT NULL,
+            audit_log VARCHAR(250) NOT NULL,
+            processing VARCHAR(250) NOT NULL,
+            last_updated VARCHAR(100) NOT NULL)
+        ''')
+    healthcheck.add_columns(database, 'health', healthcheck.added_columns)
+    with sqlite3.connect(database) as conn:
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(health)')]
+    assert columns[-2:] == ['services', 'grades']
+
+
+def test_rollups_only_count_services_that_were_probed(healthcheck, monkeypatch):
+    rollups = healthcheck.RollupSet()
+    monkeypatch.setattr(healthcheck, 'ROLLUPS', rollups)
+    monkeypatch.setattr(healthcheck, 'save_rollups', lambda timestamp: None)
+    # the receiver answers, the others are waiting out their breaker's period
+    monkeypatch.setattr(healthcheck, 'poll_services', lambda services: {
+        service: {'latency_ms': 12.0, 'signals': dict()} for service in services})
+    for service, breaker in healthcheck.BREAKERS.items():
+        monkeypatch.setattr(breaker, 'due', lambda service=service: service == 'receiver')
+
+    healthcheck.sweep()
+    healthcheck.sweep()
+    counted = {service for service, _, _ in rollups.open}
+    assert counted == {'receiver'}
+    for rollup in rollups.open.values():
+        assert (rollup.up, rollup.total, sum(rollup.counts)) == (2, 2, 2)
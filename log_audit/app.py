@@ -9,20 +9,40 @@ Environment configuration
 SERVER_HOST (string):   URL of message broker service
 SERVER_PORT (integer):  port for message broker service
 DATA_TOPIC (string):    topic group assigned to data
+TRANSPORT (dict):       kafka, memory (in-process) or file (shared directory) message transport, and Kafka reconnect backoff
+INDEX_DIR (string):     directory of the message offset index
+STORE (dict):           local segment store directory, segment size, retention and cache size
+MAX_PAGE (integer):     most messages returned by one range request
+SECONDARY_INDEX:        trace_id and device_id lookups, kept next to the offset index
+POOL (dict):            consumers per partition for single message fetches and their timeouts
+HTTP (dict):            gunicorn workers and threads, and the lock file electing the indexing worker
+COMPRESSION (dict):     smallest response compressed, and gzip and zstd levels
 """
 import connexion
+import encoding
 import logging
-import logging.config
+import logs
 import json
 import requests
 import time
+import spec
 import yaml
 from connexion import NoContent
+from datetime import datetime, timezone
+from flask import Response
 from flask_cors import CORS, cross_origin
-from os import environ
-from pykafka import KafkaClient
-from pykafka.common import OffsetType
-from pykafka.exceptions import KafkaException, SocketDisconnectedError
+from index import OffsetIndex, TYPES
+from leader import Leader
+from metrics import Registry
+from secondary import SecondaryIndex
+from segments import SegmentStore
+from os import environ, getpid, path, rename
+from pool import ConsumerPool, PoolExhausted
+from threading import Event, Lock, Thread
+from transport import TransportError, create_transport
+
+# Constants
+DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
 
 # Environment config
 if 'TARGET_ENV' in environ and environ['TARGET_ENV'] == 'prod':
@@ -37,7 +57,7 @@ else:
 # Logging config
 with open(log_conf_file, mode='r') as file:
     log_config = yaml.safe_load(file.read())
-    logging.config.dictConfig(log_config)
+    logs.configure(log_config)
 
 logger = logging.getLogger('auditlog')
 
@@ -48,75 +68,335 @@ with open(app_conf_file, mode='r') as file:
 SERVER_HOST = app_config['server']['host']
 SERVER_PORT = app_config['server']['port']
 DATA_TOPIC = app_config['events']['topic']
+INDEX_DIR = app_config['index']['directory']
+INDEX_FLUSH_MESSAGES = app_config['index']['flush_messages']
+INDEX_FLUSH_MS = app_config['index']['flush_ms']
+MAX_PAGE = app_config['pages']['max_count']
+HTTP = app_config['http']
+COMPRESSION = app_config['compression']
+INDEX_EPOCH = path.join(INDEX_DIR, 'epoch')  # rewritten each time a leader loads the index
+
+OFFSET_INDEX = OffsetIndex(INDEX_DIR)
+SECONDARY_INDEX = SecondaryIndex(INDEX_DIR)
+INDEXER_THREAD = None
+INDEX_LOADED = Event()
+# only the leader worker indexes, the others follow the files it writes
+LEADER = Leader(HTTP['leader_lock'])
+RELOAD_LOCK = Lock()
+
+METRICS = Registry('audit')
+METRICS.add(logs.DROPPED)
+INDEXED = METRICS.counter('messages_indexed_total', "Messages indexed from the broker", ('type',))
+INDEX_BATCH_SECONDS = METRICS.histogram('index_batch_seconds', "Time to index and flush one batch of messages")
+READS = METRICS.counter('messages_read_total', "Messages read for responses", ('source',))
+FETCH_SECONDS = METRICS.histogram('broker_fetch_seconds', "Time to fetch one message from the broker")
+SCAN_SECONDS = METRICS.histogram('scan_seconds', "Time to stream a page or range of messages")
+
+def create_store() -> SegmentStore:
+    return SegmentStore(
+        app_config['store']['directory'], 
+        segment_bytes=app_config['store']['segment_bytes'], 
+        max_segments=app_config['store']['max_segments'], 
+        cache_entries=app_config['store']['cache_entries']
+    )
+
+SEGMENT_STORE = create_store()
 
 # endpoints
 def health():
     return {"message": "OK"}, 200
 
-def get_temperature(index):
+def ready():
+    checks = {"index": INDEX_LOADED.is_set(), "broker": TRANSPORT.ready}
+    if not all(checks.values()):
+        return {"message": "Not ready", "checks": checks}, 503
+    return {"message": "OK", "checks": checks}, 200
+
+def get_metrics():
+    return Response(METRICS.exposition(), mimetype='text/plain')
+
+def health_detail():
+    signals = {
+        "indexer_alive": indexer_alive(), 
+        "consumer_lag": indexer_lag(), 
+        "consumer_pool_in_use": CONSUMER_POOL.in_use()
+    }
+    return {"message": "OK", "signals": signals}, 200
+
+def get_temperature(index: int = None, start: int = None, count: int = None):
+    if start is not None:
+        return get_messages('temperature', start, count)
+    if index is None:
+        return { "message": "index or start is required" }, 400
+    return get_message('temperature', index)
+
+def get_environment(index: int = None, start: int = None, count: int = None):
+    if start is not None:
+        return get_messages('environment', start, count)
+    if index is None:
+        return { "message": "index or start is required" }, 400
+    return get_message('environment', index)
+
+def get_temperature_range(start_time: str, end_time: str, count: int = None):
+    return get_time_range('temperature', start_time, end_time, count)
+
+def get_environment_range(start_time: str, end_time: str, count: int = None):
+    return get_time_range('environment', start_time, end_time, count)
+
+def get_trace(trace_id: str):
+    ref = SECONDARY_INDEX.trace(trace_id)
+    if ref is None:
+        logger.error("Could not find trace ID: %s", trace_id)
+        return { "message": "Not Found" }, 404
+    return get_message(*ref)
+
+def get_device(device_id: str, limit: int = 100):
+    refs = SECONDARY_INDEX.device(device_id, min(limit, MAX_PAGE))
+    locations = [location for location in (OFFSET_INDEX.lookup(*ref) for ref in refs) if location is not None]
+    logger.info("Sending %d messages from device: %s", len(locations), device_id)
+    return stream_response(locations)
+
+def get_messages(name: str, start: int, count: int = None):
+    locations = OFFSET_INDEX.slice(name, start, min(count or MAX_PAGE, MAX_PAGE))
+    logger.info("Sending %d %s messages from index: %d", len(locations), name, start)
+    return stream_response(locations)
+
+def get_time_range(name: str, start_time: str, end_time: str, count: int = None):
     try:
-        consumer = topic.get_simple_consumer(
-            reset_offset_on_start=True, 
-            consumer_timeout_ms=1000
-        )
-        count = 0
-        while count < index + 1:
-            for msg in consumer:
-                msg_str = msg.value.decode('utf-8')
-                msg = json.loads(msg_str)
-                
-                if msg['type'] == 'temperature':
-                    payload = msg
-                    count += 1
-                
-                elif msg['type'] == 'environment':
-                    continue
+        start = OFFSET_INDEX.find_time(name, to_epoch(start_time))
+        end = OFFSET_INDEX.find_time(name, to_epoch(end_time))
+    except ValueError as e:
+        return { "message": f"Invalid timestamp - {e}" }, 400
+    locations = OFFSET_INDEX.slice(name, start, min(end - start, count or MAX_PAGE, MAX_PAGE))
+    logger.info("Sending %d %s messages between %s and %s", len(locations), name, start_time, end_time)
+    return stream_response(locations)
+
+def stream_response(locations: list):
+    # messages that left the local store are fetched before the response starts,
+    # so a busy pool or a lost broker fails the page instead of leaving rows out
+    try:
+        fetched = fetch_missing(locations)
+    except TransportError as e:
+        logger.warning("Consumer disconnected - Error: %s", e)
+        return { "message": "Broker unavailable, retry shortly" }, 503, {'Retry-After': '1'}
+    except PoolExhausted:
+        return { "message": "Too many concurrent fetches, retry shortly" }, 503, {'Retry-After': '1'}
+
+    # stored records are streamed as they are, MessagePack re-encodes them
+    media_type = encoding.accepted((encoding.NDJSON, encoding.MSGPACK), encoding.NDJSON)
+    if media_type == encoding.MSGPACK:
+        # a stream of maps, read with msgpack.Unpacker
+        records = (encoding.packb(payload) for payload in read_messages(locations, fetched, decode=True))
+    else:
+        records = (data + b'\n' for data in read_messages(locations, fetched, decode=False))
+
+    def generate():
+        with SCAN_SECONDS.time():
+            yield from records
+
+    # passed through unbuffered, connexion would otherwise read the whole scan to validate it
+    return Response(generate(), mimetype=media_type, direct_passthrough=True)
+
+def fetch_missing(locations: list) -> dict:
+    """Messages of a page that are no longer in the local store, by sequence"""
+    return {sequence: fetch_message(partition, offset)
+        for partition, offset, sequence in locations if not SEGMENT_STORE.has(sequence)}
 
+def read_messages(locations: list, fetched: dict, decode: bool):
+    """Messages from the local store, or fetched from the broker, decoded or as JSON bytes"""
+    for partition, offset, sequence in locations:
+        data = SEGMENT_STORE.get(sequence) if decode else SEGMENT_STORE.raw(sequence)
+        if data is None:
+            # expired while the page was sent, a failed fetch ends the response early
+            payload = fetched[sequence] if sequence in fetched else fetch_message(partition, offset)
+            if payload is None:
+                continue
+            data = payload if decode else json.dumps(payload).encode('utf-8')
+        else:
+            READS.inc('store')
+        yield data
+
+def to_epoch(timestamp: str) -> int:
+    return int(datetime.strptime(timestamp, DATETIME_FORMAT).replace(tzinfo=timezone.utc).timestamp())
+
+def get_message(name: str, index: int):
+    location = OFFSET_INDEX.lookup(name, index)
+    if location is None:
+        logger.error("Could not find %s at index: %s", name, index)
+        return { "message": "Not Found" }, 404
+
+    partition, offset, sequence = location
+    payload = SEGMENT_STORE.get(sequence)
+    if payload is not None:
+        READS.inc('store')
         return payload, 200
-            
-    except SocketDisconnectedError as e:
-        logger.warning(f"Restarting consumer - Error: {e}")
-        consumer.stop()
-        consumer.start()
-
-    except:
-        logger.error("No more messages found")
-    
-    logger.error(f"Could not find temperature at index: {index}")
+
+    # not in the local store (expired or indexed before it existed)
+    try:
+        payload = fetch_message(partition, offset)
+        if payload is not None:
+            return payload, 200
+
+    except TransportError as e:
+        logger.warning("Consumer disconnected - Error: %s", e)
+
+    except PoolExhausted:
+        # the message exists, it can be fetched once a consumer frees up
+        return { "message": "Too many concurrent fetches, retry shortly" }, 503, {'Retry-After': '1'}
+
+    logger.error("Could not fetch %s at index: %s (partition %s, offset %s)", name, index, partition, offset)
     return { "message": "Not Found" }, 404
 
+def fetch_message(partition: int, offset: int):
+    # single fetch from the indexed position with a pooled consumer
+    if partition not in TRANSPORT.partitions():
+        return None
+    with FETCH_SECONDS.time():
+        msg = CONSUMER_POOL.fetch(partition, offset)
+    if msg is None:
+        return None
+    READS.inc('broker')
+    return json.loads(msg.value.decode('utf-8'))
 
-def get_environment(index):
-    try:
-        consumer = topic.get_simple_consumer(
-            reset_offset_on_start=True, 
-            consumer_timeout_ms=1000
-        )
-        count = 0
-        while count < index + 1: 
+# message indexer
+def index_messages():
+    # secondary entries are caught up before new ones are added, so they stay in index order
+    catch_up_secondary()
+    TRANSPORT.wait_ready()
+    consumer = TRANSPORT.consumer(from_beginning=True, timeout_ms=INDEX_FLUSH_MS)
+    # resume after the last indexed offset of each partition
+    resume = {partition: offset + 1 for partition, offset in OFFSET_INDEX.last_offsets.items()}
+    if resume:
+        consumer.seek(resume)
+    logger.info("Indexer started - temperature: %s, environment: %s", OFFSET_INDEX.count('temperature'), OFFSET_INDEX.count('environment'))
+
+    while True:
+        try:
+            count = 0
+            started = time.perf_counter()
             for msg in consumer:
-                msg_str = msg.value.decode('utf-8')
-                msg = json.loads(msg_str)
-                
-                if msg['type'] == 'environment':
-                    payload = msg
-                    count += 1
-                
-                elif msg['type'] == 'temperature':
-                    continue
+                sequence = SEGMENT_STORE.append(msg.value)
+                envelope = decode_message(msg)
+                msg_type, received = message_info(envelope)
+                index = OFFSET_INDEX.count(msg_type) if msg_type in TYPES else None
+                OFFSET_INDEX.add(msg_type, msg.partition_id, msg.offset, sequence, received)
+                if index is not None:
+                    add_secondary(msg_type, index, envelope)
+                INDEXED.inc(str(msg_type))
+                count += 1
+                if count >= INDEX_FLUSH_MESSAGES:
+                    break
+            # the store is flushed first, so the index never points past stored records
+            SEGMENT_STORE.flush()
+            OFFSET_INDEX.flush()
+            SECONDARY_INDEX.flush()
+            if count:
+                INDEX_BATCH_SECONDS.observe(time.perf_counter() - started)
+                logger.debug("Indexed %d messages", count)
 
-        return payload, 200
-            
-    except SocketDisconnectedError as e:
-        logger.warning(f"Restarting consumer - Error: {e}")
-        consumer.stop()
-        consumer.start()
-
-    except:
-        logger.error("No more messages found")
-    
-    logger.error(f"Could not find environment at index: {index}")
-    return { "message": "Not Found" }, 404
+        except TransportError as e:
+            logger.warning("Restarting indexer consumer - Error: %s", e)
+            consumer.restart()
+
+def decode_message(msg):
+    try:
+        return json.loads(msg.value.decode('utf-8'))
+    except (ValueError, AttributeError) as e:
+        logger.error("Unable to decode message at offset %s - %s", msg.offset, e)
+        return None
+
+def message_info(envelope) -> tuple:
+    """Type and receive time (epoch seconds) of a message"""
+    if envelope is None:
+        return None, 0
+    try:
+        return envelope.get('type'), to_epoch(envelope['datetime'])
+    except (ValueError, AttributeError, KeyError, TypeError) as e:
+        logger.error("Unable to index message - %s", e)
+        return None, 0
+
+def add_secondary(name: str, index: int, envelope: dict) -> None:
+    payload = envelope.get('payload') or dict()
+    SECONDARY_INDEX.add(name, index, payload.get('trace_id'), payload.get('device_id'))
+
+def catch_up_secondary() -> None:
+    # entries indexed before the last secondary flush, eg. after a crash
+    for name in TYPES:
+        start = SECONDARY_INDEX.progress[name]
+        for index, (partition, offset, sequence) in enumerate(
+                OFFSET_INDEX.slice(name, start, OFFSET_INDEX.count(name) - start), start=start):
+            envelope = SEGMENT_STORE.get(sequence)
+            if envelope is not None:
+                add_secondary(name, index, envelope)
+    SECONDARY_INDEX.flush()
+
+def indexer_alive():
+    # unknown in the other workers, the indexer runs in the leader
+    if not LEADER.is_leader:
+        return None
+    return INDEXER_THREAD is not None and INDEXER_THREAD.is_alive()
+
+def indexer_lag():
+    """Messages in the topic not yet indexed"""
+    try:
+        latest = TRANSPORT.latest_offsets()
+    except TransportError as e:
+        logger.warning("Unable to fetch latest offsets - %s", e)
+        return None
+    last_offsets = OFFSET_INDEX.last_offsets
+    # latest offsets are the next offset to be written
+    return sum(max(0, offset - 1 - last_offsets.get(partition, -1)) for partition, offset in latest.items())
+
+# leader and followers
+def load_indexes(readonly: bool) -> None:
+    """Replaces the indexes with ones loaded from disk, read-only in the followers"""
+    global OFFSET_INDEX, SECONDARY_INDEX, SEGMENT_STORE
+    offset_index, secondary_index, segment_store = OffsetIndex(INDEX_DIR), SecondaryIndex(INDEX_DIR), create_store()
+    segment_store.load(readonly)
+    offset_index.load(readonly)
+    secondary_index.load(readonly)
+    OFFSET_INDEX, SECONDARY_INDEX, SEGMENT_STORE = offset_index, secondary_index, segment_store
+    INDEX_LOADED.set()
+
+def read_epoch():
+    try:
+        with open(INDEX_EPOCH, mode='r') as file:
+            return file.read()
+    except OSError:
+        return None
+
+def start_indexer() -> None:
+    global INDEXER_THREAD
+    with RELOAD_LOCK:
+        load_indexes(readonly=False)
+        # loading repairs the files, so the followers reload them instead of refreshing
+        with open(f'{INDEX_EPOCH}.tmp', mode='w') as file:
+            file.write(f'{getpid()} {time.time_ns()}')
+        rename(f'{INDEX_EPOCH}.tmp', INDEX_EPOCH)
+    t1 = INDEXER_THREAD = Thread(target=index_messages, daemon=True)
+    t1.start()
+
+def follow_leader() -> None:
+    epoch = None
+    while not LEADER.elected.wait(INDEX_FLUSH_MS / 1000):
+        with RELOAD_LOCK:
+            if LEADER.is_leader:
+                return
+            try:
+                current = read_epoch()
+                if current is None:
+                    # no leader has loaded the index yet
+                    continue
+                if current != epoch:
+                    load_indexes(readonly=True)
+                    epoch = current
+                else:
+                    # in flush order, so the index never points past stored records
+                    SEGMENT_STORE.refresh()
+                    OFFSET_INDEX.refresh()
+                    SECONDARY_INDEX.refresh()
+            except (OSError, ValueError) as e:
+                logger.warning("Unable to follow the leader's index - %s", e)
 
 # debug function (unmapped)
 def get_queue(consumer):
@@ -128,43 +408,40 @@ def get_queue(consumer):
             msg = json.loads(msg_str)
             temp_queue[index] = msg
     
-    except SocketDisconnectedError as e:
-        consumer.stop()
-        consumer.start()
+    except TransportError as e:
+        consumer.restart()
 
     logger.debug(temp_queue)
     return NoContent, 200
 
 
-def create_kafka_connection(max_retries: int, timeout: int):
-    count = 0
-    while count < max_retries:
-        try:
-            client = KafkaClient(hosts=f'{SERVER_HOST}:{SERVER_PORT}')
-            topic = client.topics[str.encode(DATA_TOPIC)]
-            logger.info(f"Client connected to Kafka server")
-
-            return topic
-
-        except KafkaException as e:
-            logger.error(f"Connection failed - {e} - Retries: ({count})")
-            time.sleep(timeout)
-            count += 1
-            continue
-
-    else:
-        logger.error(f"Connection failed - Unable to connect to kafka server. Max retries exceeded ({max_retries})")
-        raise SystemExit(1)
-
-topic = create_kafka_connection(max_retries=3, timeout=2)
+TRANSPORT = create_transport(app_config['transport'], app_config['server'], DATA_TOPIC)
+CONSUMER_POOL = ConsumerPool(
+    TRANSPORT, 
+    size=app_config['pool']['size'], 
+    timeout_ms=app_config['pool']['consumer_timeout_ms'], 
+    checkout_ms=app_config['pool']['checkout_timeout_ms'], 
+    max_idle_sec=app_config['pool']['max_idle_sec']
+)
 
 app = connexion.FlaskApp(__name__, specification_dir='openapi/')
 if 'TARGET_ENV' not in environ and environ['TARGET_ENV'] != 'prod':
     CORS(app.app)
     app.app.config['CORS_HEADERS'] = 'Content-Type'
-app.add_api('openapi.yml', base_path='/audit_log', strict_validation=True, validate_responses=True)
+spec.add_api(app, 'openapi.yml', base_path='/audit_log', strict_validation=True, validate_responses=True)
+METRICS.instrument(app.app)
+encoding.compress(app.app, COMPRESSION)
+application = app.app
+
+def start_worker() -> None:
+    """Starts a worker, called by gunicorn after the fork, the leader also indexes the topic"""
+    TRANSPORT.connect()
+    CONSUMER_POOL.start_reaper()
+    LEADER.campaign(start_indexer)
+    Thread(target=follow_leader, name='follow', daemon=True).start()
 
 def main() -> None:
+    start_worker()
     app.run(port=8110, debug=False)
 
 
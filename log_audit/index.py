@@ -0,0 +1,151 @@
+"""
+Offset Index
+
+Maps the Nth message of each type to its (partition, offset) in the
+topic. Entries are kept in typed arrays and appended to one file per
+type, with the last indexed offset per partition stored alongside so
+the indexer can resume where it stopped. Each entry also records the
+sequence of the message in the local segment store (-1 if not stored)
+and its receive time, for time range lookups.
+
+Only the indexer writes the files. Readers in other processes load the
+index read-only and refresh it from the end of the files.
+"""
+import json
+import os
+from array import array
+from bisect import bisect_left
+from threading import Lock
+
+TYPES = ('temperature', 'environment')
+
+
+class OffsetIndex:
+    def __init__(self, directory: str, types: tuple = TYPES) -> None:
+        self.directory = directory
+        self.types = types
+        self.partitions = {name: array('H') for name in types}
+        self.offsets = {name: array('q') for name in types}
+        self.sequences = {name: array('q') for name in types}
+        self.times = {name: array('q') for name in types}  # epoch seconds
+        self.flushed = {name: 0 for name in types}
+        self.last_offsets = dict()  # partition -> last indexed offset
+        self.lock = Lock()
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def load(self, readonly: bool = False) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        self._load_offsets()
+        for name in self.types:
+            for suffix, values in self._arrays(name):
+                filename = self._path(f'{name}.{suffix}')
+                if os.path.exists(filename):
+                    with open(filename, mode='rb') as file:
+                        data = file.read()
+                    # ignore a partly written entry
+                    values.frombytes(data[:len(data) - len(data) % values.itemsize])
+            # entries indexed before the segment store have no sequence or time
+            for values, default in ((self.sequences[name], -1), (self.times[name], 0)):
+                missing = len(self.offsets[name]) - len(values)
+                if missing > 0:
+                    values.extend([default] * missing)
+            self._truncate(name, readonly)
+
+    def _load_offsets(self) -> None:
+        if os.path.exists(self._path('offsets.json')):
+            with open(self._path('offsets.json'), mode='r') as file:
+                self.last_offsets = {int(key): value for key, value in json.load(file).items()}
+
+    def _arrays(self, name: str) -> tuple:
+        return (
+            ('partitions', self.partitions[name]), 
+            ('offsets', self.offsets[name]), 
+            ('sequences', self.sequences[name]), 
+            ('times', self.times[name])
+        )
+
+    def _truncate(self, name: str, readonly: bool = False) -> None:
+        # drop entries written after the last saved offsets (eg. a crash between flushes)
+        partitions, offsets = self.partitions[name], self.offsets[name]
+        size = min(len(values) for _, values in self._arrays(name))
+        while size and offsets[size - 1] > self.last_offsets.get(partitions[size - 1], -1):
+            size -= 1
+        for suffix, values in self._arrays(name):
+            del values[size:]
+            if not readonly:
+                with open(self._path(f'{name}.{suffix}'), mode='wb') as file:
+                    values.tofile(file)
+        self.flushed[name] = size
+
+    def refresh(self) -> None:
+        """Reads entries another process has flushed since the last load or refresh"""
+        with self.lock:
+            # offsets are saved after the entries they cover, so they are read first
+            self._load_offsets()
+            for name in self.types:
+                start = self.flushed[name]
+                # the files of a type are appended one after the other, entries are complete in all of them
+                size = min(self._entries(f'{name}.{suffix}', values.itemsize) for suffix, values in self._arrays(name))
+                if size <= start:
+                    continue
+                for suffix, values in self._arrays(name):
+                    with open(self._path(f'{name}.{suffix}'), mode='rb') as file:
+                        file.seek(start * values.itemsize)
+                        values.frombytes(file.read((size - start) * values.itemsize))
+                self.flushed[name] = size
+
+    def _entries(self, filename: str, itemsize: int) -> int:
+        try:
+            return os.path.getsize(self._path(filename)) // itemsize
+        except OSError:
+            return 0
+
+    def add(self, name: str, partition: int, offset: int, sequence: int = -1, time: int = 0) -> None:
+        with self.lock:
+            if name in self.types:
+                self.partitions[name].append(partition)
+                self.offsets[name].append(offset)
+                self.sequences[name].append(sequence)
+                self.times[name].append(time)
+            self.last_offsets[partition] = offset
+
+    def flush(self) -> None:
+        """Appends new entries to disk, then records the offsets they cover"""
+        with self.lock:
+            for name in self.types:
+                start = self.flushed[name]
+                if start == len(self.offsets[name]):
+                    continue
+                for suffix, values in self._arrays(name):
+                    with open(self._path(f'{name}.{suffix}'), mode='ab') as file:
+                        values[start:].tofile(file)
+                self.flushed[name] = len(self.offsets[name])
+            temp = self._path('offsets.json.tmp')
+            with open(temp, mode='w') as file:
+                json.dump(self.last_offsets, file)
+            os.replace(temp, self._path('offsets.json'))
+
+    def lookup(self, name: str, index: int):
+        """(partition, offset, sequence) of the message at index, or None"""
+        with self.lock:
+            if name not in self.types or not 0 <= index < len(self.offsets[name]):
+                return None
+            return self.partitions[name][index], self.offsets[name][index], self.sequences[name][index]
+
+    def slice(self, name: str, start: int, count: int) -> list:
+        """(partition, offset, sequence) of up to count messages from index start"""
+        with self.lock:
+            end = min(start + count, len(self.offsets[name]))
+            return [(self.partitions[name][index], self.offsets[name][index], self.sequences[name][index]) 
+                for index in range(start, end)]
+
+    def find_time(self, name: str, time: int) -> int:
+        """Index of the first message received at or after time (epoch seconds)"""
+        # messages are indexed in arrival order, so receive times are close to sorted
+        with self.lock:
+            return bisect_left(self.times[name], time)
+
+    def count(self, name: str) -> int:
+        return len(self.offsets[name])
@@ -0,0 +1,152 @@
+"""
+Consumer Pool
+
+Long-lived consumers for single message fetches. Each partition has
+its own small pool, so a checked out consumer only needs to seek
+within one partition before it reads. Consumers are checked for a
+broken connection when they are checked out and replaced if needed,
+so a request never pays for broker metadata or connection setup.
+Consumers left idle long enough for the broker to close their
+connection are stopped in the background, not by a request.
+"""
+import logging
+import time
+from queue import Queue, Empty
+from threading import Event, Lock, Thread
+
+logger = logging.getLogger('auditlog')
+
+
+class PoolExhausted(Exception):
+    """Every consumer for a partition stayed checked out for the whole checkout timeout"""
+
+
+class PooledConsumer:
+    def __init__(self, transport, partition: int, timeout_ms: int) -> None:
+        self.partition = partition
+        self.consumer = transport.consumer(partitions=[partition], timeout_ms=timeout_ms)
+        self.broken = False
+        self.last_used = time.monotonic()
+
+    def healthy(self) -> bool:
+        return not self.broken and self.consumer.running
+
+    def idle_sec(self) -> float:
+        return time.monotonic() - self.last_used
+
+    def fetch(self, offset: int):
+        """Message at offset, or None if it could not be read"""
+        self.last_used = time.monotonic()
+        self.consumer.seek({self.partition: offset})
+        msg = self.consumer.consume()
+        # skip anything fetched ahead of the reset
+        while msg is not None and msg.offset < offset:
+            msg = self.consumer.consume()
+        if msg is None or msg.offset != offset:
+            return None
+        return msg
+
+    def stop(self) -> None:
+        try:
+            self.consumer.stop()
+        except Exception as e:
+            logger.warning("Unable to stop consumer for partition %s - %s", self.partition, e)
+
+
+class ConsumerPool:
+    def __init__(self, transport, size: int, timeout_ms: int = 1000, checkout_ms: int = 2000, max_idle_sec: int = 300) -> None:
+        self.transport = transport
+        self.size = size
+        self.timeout_ms = timeout_ms
+        self.checkout_ms = checkout_ms
+        self.max_idle_sec = max_idle_sec
+        self.idle = dict()  # partition -> queue of idle consumers
+        self.created = dict()  # partition -> number of open consumers
+        self.lock = Lock()
+        self.stopped = Event()
+
+    def _queue(self, partition: int) -> Queue:
+        with self.lock:
+            if partition not in self.idle:
+                self.idle[partition] = Queue()
+                self.created[partition] = 0
+            return self.idle[partition]
+
+    def checkout(self, partition: int):
+        """Idle consumer for a partition, or a new one while under the pool size, raises PoolExhausted if none frees up in time"""
+        idle = self._queue(partition)
+        while True:
+            try:
+                consumer = idle.get_nowait()
+            except Empty:
+                with self.lock:
+                    create = self.created[partition] < self.size
+                    if create:
+                        self.created[partition] += 1
+                if create:
+                    try:
+                        return PooledConsumer(self.transport, partition, self.timeout_ms)
+                    except Exception:
+                        with self.lock:
+                            self.created[partition] -= 1
+                        raise
+                try:
+                    consumer = idle.get(timeout=self.checkout_ms / 1000)
+                except Empty:
+                    logger.warning("No consumer available for partition %s after %sms", partition, self.checkout_ms)
+                    raise PoolExhausted(f"No consumer available for partition {partition}")
+            if consumer.healthy():
+                return consumer
+            self.discard(consumer)
+
+    def checkin(self, consumer: PooledConsumer) -> None:
+        if consumer.broken:
+            self.discard(consumer)
+        else:
+            self.idle[consumer.partition].put(consumer)
+
+    def discard(self, consumer: PooledConsumer) -> None:
+        consumer.stop()
+        with self.lock:
+            self.created[consumer.partition] -= 1
+
+    def start_reaper(self) -> None:
+        """Stops idle consumers in the background, checking every half of max_idle_sec"""
+        Thread(target=self._reap_idle, name='pool-reaper', daemon=True).start()
+
+    def _reap_idle(self) -> None:
+        while not self.stopped.wait(self.max_idle_sec / 2):
+            self.reap()
+
+    def reap(self) -> None:
+        """Stops the idle consumers whose connection the broker may have closed"""
+        with self.lock:
+            queues = list(self.idle.values())
+        for idle in queues:
+            kept = list()
+            while True:
+                try:
+                    consumer = idle.get_nowait()
+                except Empty:
+                    break
+                if consumer.healthy() and consumer.idle_sec() < self.max_idle_sec:
+                    kept.append(consumer)
+                else:
+                    self.discard(consumer)
+            for consumer in kept:
+                idle.put(consumer)
+
+    def in_use(self) -> int:
+        with self.lock:
+            return sum(self.created.values()) - sum(idle.qsize() for idle in self.idle.values())
+
+    def fetch(self, partition: int, offset: int):
+        """Single message fetch with a pooled consumer"""
+        consumer = self.checkout(partition)
+        try:
+            return consumer.fetch(offset)
+        except Exception:
+            consumer.broken = True
+            raise
+        finally:
+            self.checkin(consumer)
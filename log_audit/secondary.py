@@ -0,0 +1,175 @@
+"""
+Secondary Indexes
+
+Hash index from trace_id to a message, and posting lists of messages
+per device_id. Messages are referenced by their position in the offset
+index (index * 2 + type), and ids are hashed to 16 byte keys.
+
+Both indexes are append-only files. Posting lists are stored as
+zigzag varint-encoded deltas and rewritten into one record per device
+when the indexer loads the file. Readers in other processes load them
+read-only and refresh them from the end of the files.
+"""
+import json
+import os
+import struct
+from array import array
+from hashlib import md5
+from threading import Lock
+from uuid import UUID
+from index import TYPES
+
+TRACE_RECORD = struct.Struct('<16sq')
+
+
+def to_key(value: str) -> bytes:
+    try:
+        return UUID(value).bytes
+    except (ValueError, AttributeError, TypeError):
+        return md5(str(value).encode('utf-8')).digest()
+
+def to_ref(name: str, index: int) -> int:
+    return index * len(TYPES) + TYPES.index(name)
+
+def from_ref(ref: int) -> tuple:
+    return TYPES[ref % len(TYPES)], ref // len(TYPES)
+
+def encode_varint(value: int, out: bytearray) -> None:
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+def decode_varint(data: bytes, position: int) -> tuple:
+    value = shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, position
+        shift += 7
+
+def encode_postings(key: bytes, refs) -> bytes:
+    out = bytearray(key)
+    encode_varint(len(refs), out)
+    previous = 0
+    for ref in refs:
+        # refs of the two types interleave, so deltas can be negative
+        delta = ref - previous
+        encode_varint(delta * 2 if delta >= 0 else -delta * 2 - 1, out)
+        previous = ref
+    return bytes(out)
+
+
+class SecondaryIndex:
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+        self.traces = dict()  # key -> ref
+        self.devices = dict()  # key -> array of refs, in arrival order
+        self.pending_traces = list()
+        self.pending_devices = dict()
+        self.progress = {name: 0 for name in TYPES}  # offset index entries covered
+        self.positions = {'traces.idx': 0, 'devices.idx': 0}  # bytes of each file read
+        self.lock = Lock()
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def load(self, readonly: bool = False) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        self._read()
+        # the indexer rewrites posting lists into one record per device, readers leave the file as it is
+        if not readonly and os.path.exists(self._path('devices.idx')):
+            self._compact()
+            self.positions['devices.idx'] = os.path.getsize(self._path('devices.idx'))
+
+    def refresh(self) -> None:
+        """Reads entries another process has flushed since the last load or refresh"""
+        with self.lock:
+            self._read()
+
+    def _read(self) -> None:
+        if os.path.exists(self._path('secondary.json')):
+            with open(self._path('secondary.json'), mode='r') as file:
+                self.progress.update(json.load(file))
+        data = self._tail('traces.idx')
+        size = len(data) - len(data) % TRACE_RECORD.size
+        for key, ref in TRACE_RECORD.iter_unpack(data[:size]):
+            self.traces[key] = ref
+        self.positions['traces.idx'] += size
+        data = self._tail('devices.idx')
+        position = 0
+        while position < len(data):
+            try:
+                key = data[position:position + 16]
+                size, end = decode_varint(data, position + 16)
+                refs = list()
+                previous = 0
+                for _ in range(size):
+                    delta, end = decode_varint(data, end)
+                    previous += delta // 2 if delta % 2 == 0 else -(delta + 1) // 2
+                    refs.append(previous)
+            except IndexError:
+                # partly written record at the end of the file
+                break
+            self.devices.setdefault(key, array('q')).extend(refs)
+            position = end
+        self.positions['devices.idx'] += position
+
+    def _tail(self, name: str) -> bytes:
+        """Contents of an index file after the last complete record read"""
+        if not os.path.exists(self._path(name)):
+            return b''
+        with open(self._path(name), mode='rb') as file:
+            file.seek(self.positions[name])
+            return file.read()
+
+    def _compact(self) -> None:
+        temp = self._path('devices.idx.tmp')
+        with open(temp, mode='wb') as file:
+            for key, refs in self.devices.items():
+                file.write(encode_postings(key, refs))
+        os.replace(temp, self._path('devices.idx'))
+
+    def add(self, name: str, index: int, trace_id: str, device_id: str) -> None:
+        ref = to_ref(name, index)
+        with self.lock:
+            if trace_id is not None:
+                key = to_key(trace_id)
+                self.traces[key] = ref
+                self.pending_traces.append((key, ref))
+            if device_id is not None:
+                key = to_key(device_id)
+                self.devices.setdefault(key, array('q')).append(ref)
+                self.pending_devices.setdefault(key, list()).append(ref)
+            self.progress[name] = max(self.progress[name], index + 1)
+
+    def flush(self) -> None:
+        with self.lock:
+            if self.pending_traces:
+                with open(self._path('traces.idx'), mode='ab') as file:
+                    for key, ref in self.pending_traces:
+                        file.write(TRACE_RECORD.pack(key, ref))
+            if self.pending_devices:
+                with open(self._path('devices.idx'), mode='ab') as file:
+                    for key, refs in self.pending_devices.items():
+                        file.write(encode_postings(key, refs))
+            self.pending_traces = list()
+            self.pending_devices = dict()
+            temp = self._path('secondary.json.tmp')
+            with open(temp, mode='w') as file:
+                json.dump(self.progress, file)
+            os.replace(temp, self._path('secondary.json'))
+
+    def trace(self, trace_id: str):
+        """(type, index) of the message with a trace_id, or None"""
+        with self.lock:
+            ref = self.traces.get(to_key(trace_id))
+        return None if ref is None else from_ref(ref)
+
+    def device(self, device_id: str, limit: int) -> list:
+        """(type, index) of the latest messages from a device, oldest first"""
+        with self.lock:
+            refs = self.devices.get(to_key(device_id), array('q'))[-limit:]
+        return [from_ref(ref) for ref in refs]
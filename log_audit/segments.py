@@ -0,0 +1,216 @@
+"""
+Segment Store
+
+Append-only local copy of audit messages. Records are written to
+fixed-size, memory-mapped segment files numbered by the sequence of
+their first record, with the end position of each record kept in an
+index file next to the segment. Reads slice the mapping without
+copying, and a small LRU keeps recently decoded records.
+
+Readers in other processes map the segments read-only and refresh the
+record positions from the end of the index files.
+"""
+import mmap
+import os
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
+from threading import Lock
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    import json
+
+    def json_loads(data):
+        return json.loads(bytes(data))
+
+
+class Segment:
+    def __init__(self, directory: str, base: int, size: int, readonly: bool = False) -> None:
+        self.base = base
+        self.path = os.path.join(directory, f'{base:020d}.log')
+        self.index_path = os.path.join(directory, f'{base:020d}.idx')
+        self.ends = array('Q')
+        self.flushed = 0
+        if not os.path.exists(self.path) and not readonly:
+            with open(self.path, mode='wb') as file:
+                file.truncate(size)
+        else:
+            self.refresh()
+        if readonly:
+            self.file = open(self.path, mode='rb')
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.file = open(self.path, mode='r+b')
+            self.map = mmap.mmap(self.file.fileno(), 0)
+
+    @property
+    def position(self) -> int:
+        return self.ends[-1] if self.ends else 0
+
+    def free(self) -> int:
+        return len(self.map) - self.position
+
+    def append(self, data: bytes) -> None:
+        start = self.position
+        self.map[start:start + len(data)] = data
+        self.ends.append(start + len(data))
+
+    def read(self, number: int) -> memoryview:
+        start = self.ends[number - 1] if number else 0
+        return memoryview(self.map)[start:self.ends[number]]
+
+    def flush(self) -> None:
+        if self.flushed == len(self.ends):
+            return
+        self.map.flush()
+        with open(self.index_path, mode='ab') as file:
+            self.ends[self.flushed:].tofile(file)
+        self.flushed = len(self.ends)
+
+    def refresh(self) -> None:
+        """Reads record positions flushed since the last refresh"""
+        if not os.path.exists(self.index_path):
+            return
+        with open(self.index_path, mode='rb') as file:
+            file.seek(self.flushed * self.ends.itemsize)
+            data = file.read()
+        self.ends.frombytes(data[:len(data) - len(data) % self.ends.itemsize])
+        self.flushed = len(self.ends)
+
+    def close(self) -> None:
+        self.map.close()
+        self.file.close()
+
+    def delete(self) -> None:
+        self.close()
+        os.remove(self.path)
+        if os.path.exists(self.index_path):
+            os.remove(self.index_path)
+
+
+class LRUCache:
+    def __init__(self, capacity: int) -> None:
+        self.capacity = capacity
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        if key not in self.entries:
+            return None
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self, key, value) -> None:
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+
+class SegmentStore:
+    def __init__(self, directory: str, segment_bytes: int, max_segments: int, cache_entries: int = 256) -> None:
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_segments = max_segments
+        self.segments = list()
+        self.bases = list()
+        self.cache = LRUCache(cache_entries)
+        self.lock = Lock()
+
+    def load(self, readonly: bool = False) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        for base in self._bases():
+            self._open(base, readonly)
+
+    def _bases(self) -> list:
+        return sorted(int(name[:-4]) for name in os.listdir(self.directory) if name.endswith('.log'))
+
+    def _open(self, base: int, readonly: bool = False) -> Segment:
+        segment = Segment(self.directory, base, self.segment_bytes, readonly)
+        self.segments.append(segment)
+        self.bases.append(base)
+        return segment
+
+    def refresh(self) -> None:
+        """Follows the segments another process writes, mapped read-only"""
+        with self.lock:
+            bases = self._bases()
+            # segments expired by the writer, the mapping keeps a deleted file readable until closed
+            while self.segments and (not bases or self.segments[0].base < bases[0]):
+                self.segments.pop(0).close()
+                self.bases.pop(0)
+            if self.segments:
+                self.segments[-1].refresh()
+            for base in bases:
+                if self.bases and base <= self.bases[-1]:
+                    continue
+                try:
+                    self._open(base, readonly=True)
+                except (OSError, ValueError):
+                    # created but not yet sized, or already expired, by the writer, opened on the next refresh
+                    break
+
+    @property
+    def next_sequence(self) -> int:
+        if not self.segments:
+            return 0
+        return self.segments[-1].base + len(self.segments[-1].ends)
+
+    def append(self, data: bytes) -> int:
+        """Stores one record and returns its sequence number, or -1 if it does not fit a segment"""
+        if len(data) > self.segment_bytes:
+            return -1
+        with self.lock:
+            sequence = self.next_sequence
+            if not self.segments or self.segments[-1].free() < len(data):
+                if self.segments:
+                    self.segments[-1].flush()
+                self._open(sequence)
+                self._expire()
+            self.segments[-1].append(data)
+        return sequence
+
+    def _expire(self) -> None:
+        while len(self.segments) > self.max_segments:
+            self.segments.pop(0).delete()
+            self.bases.pop(0)
+
+    def _read(self, sequence: int):
+        if sequence < 0:
+            return None
+        position = bisect_right(self.bases, sequence) - 1
+        if position < 0:
+            return None
+        segment = self.segments[position]
+        if sequence - segment.base >= len(segment.ends):
+            return None
+        return segment.read(sequence - segment.base)
+
+    def get(self, sequence: int):
+        """Decoded record, or None if it has expired or was never stored"""
+        with self.lock:
+            record = self.cache.get(sequence)
+            if record is not None:
+                return record
+            data = self._read(sequence)
+            if data is None:
+                return None
+            record = json_loads(data)
+            self.cache.put(sequence, record)
+            return record
+
+    def has(self, sequence: int) -> bool:
+        """Whether the record is still stored"""
+        with self.lock:
+            return self.cache.get(sequence) is not None or self._read(sequence) is not None
+
+    def raw(self, sequence: int):
+        """Encoded record as bytes, for responses that do not need to decode it"""
+        with self.lock:
+            data = self._read(sequence)
+            return None if data is None else bytes(data)
+
+    def flush(self) -> None:
+        with self.lock:
+            if self.segments:
+                self.segments[-1].flush()
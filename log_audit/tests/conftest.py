@@ -0,0 +1,75 @@
+"""
+Runs the service against the in-process message transport
+
+    cd log_audit
+    python -m pytest tests
+"""
+import json
+import os
+import shutil
+import sys
+import time
+import pytest
+import yaml
+
+SERVICE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [SERVICE, os.path.join(os.path.dirname(SERVICE), 'common')]
+
+
+def wait_for(condition, timeout_sec: float = 5):
+    deadline = time.monotonic() + timeout_sec
+    while not condition():
+        if time.monotonic() > deadline:
+            raise TimeoutError("Condition not met")
+        time.sleep(0.01)
+
+
+@pytest.fixture(scope='session')
+def audit(tmp_path_factory):
+    directory = tmp_path_factory.mktemp('log_audit')
+    with open(os.path.join(SERVICE, 'app_conf.yml'), mode='r') as file:
+        app_config = yaml.safe_load(file.read())
+    app_config['transport'] = {'type': 'memory'}
+    app_config['index']['directory'] = str(directory / 'index')
+    app_config['index']['flush_ms'] = 50
+    app_config['store']['directory'] = str(directory / 'index' / 'segments')
+    app_config['http']['leader_lock'] = str(directory / 'audit_log.leader')
+    with open(directory / 'app_conf.yml', mode='w') as file:
+        yaml.safe_dump(app_config, file)
+    shutil.copy(os.path.join(SERVICE, 'log_conf.yml'), directory)
+
+    # config and log files are read from the working directory on import
+    cwd = os.getcwd()
+    os.environ['TARGET_ENV'] = 'test'
+    os.chdir(directory)
+    try:
+        import app
+    finally:
+        os.chdir(cwd)
+
+    app.start_worker()
+    wait_for(lambda: app.INDEXER_THREAD is not None)
+    return app
+
+
+@pytest.fixture()
+def client(audit):
+    return audit.app.app.test_client()
+
+
+@pytest.fixture()
+def produce(audit):
+    """Sends readings the way the receiver does and waits for them to be indexed"""
+    def produce(kind: str, payloads: list) -> int:
+        start = audit.OFFSET_INDEX.count(kind)
+        for payload in payloads:
+            msg = {
+                'type': kind,
+                'datetime': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                'ingest_ns': time.time_ns(),
+                'payload': payload
+            }
+            audit.TRANSPORT.produce(json.dumps(msg).encode('utf-8'))
+        wait_for(lambda: audit.OFFSET_INDEX.count(kind) >= start + len(payloads))
+        return start
+    return produce
@@ -0,0 +1,158 @@
+import gzip
+import json
+import uuid
+import msgpack
+
+
+def temperature(location: str) -> dict:
+    return {
+        'device_id': str(uuid.uuid4()),
+        'location': location,
+        'temperature': 21.5,
+        'timestamp': '2022-11-01T12:00:00Z',
+        'trace_id': str(uuid.uuid4())
+    }
+
+
+def test_message_by_index(client, produce):
+    payload = temperature('Vancouver')
+    start = produce('temperature', [payload])
+    response = client.get('/audit_log/temperature', query_string={'index': start})
+    assert response.status_code == 200
+    assert response.get_json()['payload'] == payload
+
+
+def test_message_by_trace_id(client, produce):
+    payload = temperature('Burnaby')
+    produce('temperature', [payload])
+    response = client.get(f"/audit_log/trace/{payload['trace_id']}")
+    assert response.status_code == 200
+    assert response.get_json()['payload'] == payload
+
+
+def test_missing_message(client):
+    response = client.get('/audit_log/temperature', query_string={'index': 10 ** 6})
+    assert response.status_code == 404
+
+
+def test_page_as_ndjson(client, produce):
+    payloads = [temperature('Surrey') for _ in range(3)]
+    start = produce('temperature', payloads)
+    response = client.get('/audit_log/temperature', query_string={'start': start, 'count': 3})
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-ndjson'
+    records = [json.loads(line) for line in response.get_data().splitlines()]
+    assert [record['payload'] for record in records] == payloads
+
+
+def test_page_as_msgpack(client, produce):
+    payloads = [temperature('Richmond') for _ in range(3)]
+    start = produce('temperature', payloads)
+    response = client.get(
+        '/audit_log/temperature',
+        query_string={'start': start, 'count': 3},
+        headers={'Accept': 'application/msgpack'}
+    )
+    assert response.status_code == 200
+    assert response.mimetype == 'application/msgpack'
+    unpacker = msgpack.Unpacker()
+    unpacker.feed(response.get_data())
+    assert [record['payload'] for record in unpacker] == payloads
+
+
+def scans(client) -> float:
+    for line in client.get('/audit_log/metrics').get_data(as_text=True).splitlines():
+        if line.startswith('audit_scan_seconds_count'):
+            return float(line.split()[-1])
+    return 0
+
+
+def test_page_is_streamed_as_it_is_read(client, produce):
+    payloads = [temperature('Delta') for _ in range(3)]
+    start = produce('temperature', payloads)
+    before = scans(client)
+    response = client.get('/audit_log/temperature', query_string={'start': start, 'count': 3}, buffered=False)
+    try:
+        records = iter(response.response)
+        assert json.loads(next(records))['payload'] == payloads[0]
+        # the scan is still open while the first record is being sent
+        assert scans(client) == before
+        assert [json.loads(record)['payload'] for record in records] == payloads[1:]
+    finally:
+        response.close()
+    assert scans(client) == before + 1
+
+
+def test_page_is_compressed_as_it_is_streamed(client, produce):
+    payloads = [temperature('Langley') for _ in range(3)]
+    start = produce('temperature', payloads)
+    response = client.get(
+        '/audit_log/temperature',
+        query_string={'start': start, 'count': 3},
+        headers={'Accept-Encoding': 'gzip'}
+    )
+    assert response.status_code == 200
+    assert response.headers['Content-Encoding'] == 'gzip'
+    lines = gzip.decompress(response.get_data()).splitlines()
+    assert [json.loads(line)['payload'] for line in lines] == payloads
+
+
+def test_message_fetch_is_retried_when_every_consumer_is_busy(client, produce, audit, monkeypatch):
+    payload = temperature('Richmond')
+    start = produce('temperature', [payload])
+    partition, _, _ = audit.OFFSET_INDEX.lookup('temperature', start)
+    pool = audit.ConsumerPool(audit.TRANSPORT, size=1, checkout_ms=50)
+    monkeypatch.setattr(audit, 'CONSUMER_POOL', pool)
+    # not in the local store, so it is fetched from the broker
+    monkeypatch.setattr(audit.SEGMENT_STORE, 'get', lambda sequence: None)
+
+    consumer = pool.checkout(partition)
+    try:
+        response = client.get('/audit_log/temperature', query_string={'index': start})
+        assert response.status_code == 503
+        assert response.headers['Retry-After'] == '1'
+    finally:
+        pool.checkin(consumer)
+    response = client.get('/audit_log/temperature', query_string={'index': start})
+    assert response.status_code == 200
+    assert response.get_json()['payload'] == payload
+
+
+def test_page_fails_when_a_message_cannot_be_fetched(client, produce, audit, monkeypatch):
+    payloads = [temperature('Surrey') for _ in range(3)]
+    start = produce('temperature', payloads)
+    partition, _, _ = audit.OFFSET_INDEX.lookup('temperature', start)
+    pool = audit.ConsumerPool(audit.TRANSPORT, size=1, checkout_ms=50)
+    monkeypatch.setattr(audit, 'CONSUMER_POOL', pool)
+    # the second message has left the local store
+    _, _, expired = audit.OFFSET_INDEX.lookup('temperature', start + 1)
+    def expire(method: str, missing) -> None:
+        stored = getattr(audit.SEGMENT_STORE, method)
+        monkeypatch.setattr(audit.SEGMENT_STORE, method, lambda sequence: missing if sequence == expired else stored(sequence))
+    expire('has', False)
+    expire('get', None)
+    expire('raw', None)
+
+    consumer = pool.checkout(partition)
+    try:
+        response = client.get('/audit_log/temperature', query_string={'start': start, 'count': 3})
+        assert response.status_code == 503
+        assert response.headers['Retry-After'] == '1'
+    finally:
+        pool.checkin(consumer)
+    response = client.get('/audit_log/temperature', query_string={'start': start, 'count': 3})
+    assert response.status_code == 200
+    assert [json.loads(line)['payload'] for line in response.get_data().splitlines()] == payloads
+
+
+def test_idle_consumers_are_stopped_in_the_background(audit):
+    pool = audit.ConsumerPool(audit.TRANSPORT, size=2, max_idle_sec=60)
+    stale, fresh = pool.checkout(0), pool.checkout(0)
+    pool.checkin(stale)
+    pool.checkin(fresh)
+    stale.last_used -= 60
+
+    pool.reap()
+    assert pool.created[0] == 1
+    assert not stale.consumer.running
+    assert pool.checkout(0) is fresh
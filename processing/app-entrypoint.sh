@@ -1,8 +1,5 @@
 #!/bin/bash
 set -e
-# wait for the server to be up
-if [ -n "$SERVER_HOST" ]; then
-    /usr/bin/wait-for-it "$SERVER_HOST:${SERVER_PORT:-80}/storage" -t 120
-fi
+# storage is polled by the service until it is up
 # run the main container command
 exec "$@"
\ No newline at end of file
@@ -9,27 +9,57 @@ forwards to a user interface service.
 Environment configuration
 SERVER_URL (string):    URL of storage service
 INTERVAL (integer):     Interval (seconds) between requesting data
+PAGE_SIZE (integer):    Rows requested per table per page
+MAX_PAGES (integer):    Pages processed per run before a catch-up run is scheduled
 TIMEOUT (integer):      Timeout (seconds) to wait for response
+REQUEST_TIMEOUT (int):  Timeout (seconds) for each storage request
+WINDOWS (list):         Rolling stats windows (eg. 1h, 24h)
+QUANTILES (dict):       Quantile sketch compression, per-location and retention
+HISTORY (dict):         Stats history compaction period and per-minute retention
+RULES (list):           Alert rules (metric, comparator, threshold, duration, scope)
+TRACING (dict):         Fraction of readings traced by stage, and how many traces are kept
+HTTP (dict):            Gunicorn workers, gevent connections per worker, and the lock file electing the scheduler worker
+
+Backfill
+backfill.py recomputes the stats history over a date range.
 """
 import connexion
 import logging
-import logging.config
+import logs
 import json
 import requests
 import time
+import spec
 import yaml
-from connexion import NoContent
-from datetime import datetime
-from data import Base, create, version
+from connexion import NoContent, request
+from flask import Response
+from datetime import datetime, timedelta
+from hashlib import sha1
+from data import Base, create, create_alerts, create_alerts_index, create_cursors, create_index, create_sketches, compact, prune_alerts, query, version
 from flask_cors import CORS, cross_origin
 from json.decoder import JSONDecodeError
+from leader import Leader, file_lock, load_state, save_state
 from os import environ, path
-from stats import Stats
+from sketch import SketchSet, ALL_LOCATIONS, ALL_TIME, BUCKET_FORMAT
+from rules import Rule, RuleEngine, FIRING
+from stats import Stats, Sketch, Cursor, Alert
+from metrics import Registry
+from stream import Broadcaster
+from tracing import TraceStore, INGEST, STATS, PIPELINE_BUCKETS, now_ns, stage_latencies
+from window import RollingStats, packet_time
 from sqlite3 import connect
-from sqlalchemy import create_engine
+from functools import wraps
+from sqlalchemy import create_engine, func, text
 from sqlalchemy.orm import sessionmaker
 from requests.exceptions import RequestException, ConnectionError
 from apscheduler.schedulers.background import BackgroundScheduler
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from threading import Thread
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 # Constants
 DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
@@ -47,7 +77,7 @@ else:
 # Logging config
 with open(log_conf_file, mode='r') as file:
     log_config = yaml.safe_load(file.read())
-    logging.config.dictConfig(log_config)
+    logs.configure(log_config)
 
 logger = logging.getLogger('processor')
 
@@ -58,134 +88,441 @@ with open(app_conf_file, mode='r') as file:
 SERVER_URL = app_config['eventstore']['url']
 DATA_URL = app_config['datastore']['filename']
 INTERVAL = app_config['scheduler']['period_sec']
+PAGE_SIZE = app_config['scheduler']['page_size']
+MAX_PAGES = app_config['scheduler']['max_pages']
 TIMEOUT = app_config['connection']['timeout']
+REQUEST_TIMEOUT = app_config['connection']['request_timeout']
+WINDOWS = app_config['stats']['windows']
+QUANTILES = app_config['stats']['quantiles']
+HISTORY = app_config['stats']['history']
+ALERTS = app_config['alerts']
+RULES = ALERTS['rules']
+TRACING = app_config['tracing']
+HTTP = app_config['http']
 
 DB_ENGINE = create_engine(f"sqlite:///{DATA_URL}")
 Base.metadata.bind = DB_ENGINE
 DB_SESSION = sessionmaker(bind=DB_ENGINE)
 
+ROLLING_STATS = {label: RollingStats(label) for label in WINDOWS}
+SKETCHES = SketchSet(
+    compression=QUANTILES['compression'], 
+    by_location=QUANTILES['by_location']
+)
+STATS_FEED = Broadcaster('stats', heartbeat_sec=app_config['stream']['heartbeat_sec'], max_clients=app_config['stream']['max_clients'])
+RULE_ENGINE = RuleEngine([Rule(**rule) for rule in RULES])
+# (stats, response body, etag) of the latest stats row
+SNAPSHOT = (None, None, None)
+# highest storage row id processed per table
+CURSORS = {'temperature': 0, 'environment': 0}
+# environment rows created before this time were in the stats before cursors were kept
+COUNTED_BEFORE = None
+SCHEDULER = None
+JOB_RUNS = dict()  # job id -> (duration in seconds, epoch time it finished)
+# only the leader worker runs the scheduled jobs, the others follow the state it saves
+LEADER = Leader(HTTP['leader_lock'])
+WINDOWS_FILE = f'{DATA_URL}.windows.json'
+WINDOW_VIEW = dict()  # window -> stats, as last saved by the leader
+JOBS_FILE = f'{DATA_URL}.jobs.json'
+SKETCHES_SYNCED = None  # last_updated of the newest sketch loaded from the leader
+
+METRICS = Registry('processing')
+METRICS.add(logs.DROPPED)
+JOB_SECONDS = METRICS.histogram('job_seconds', "Duration of scheduled job runs", ('job',))
+FETCH_SECONDS = METRICS.histogram('storage_fetch_seconds', "Time to fetch one page of both tables from storage")
+BATCH_SECONDS = METRICS.histogram('batch_seconds', "Time to process one page of readings")
+ROWS = METRICS.counter('rows_processed_total', "Storage rows processed into stats", ('table',))
+STAGE_SECONDS = METRICS.histogram('stage_seconds', "Time readings spend in each pipeline stage", ('stage',), PIPELINE_BUCKETS)
+
+# full traces of the readings storage sampled, completed when they reach the stats
+TRACES = TraceStore(TRACING['sample_rate'], TRACING['capacity'])
+
+# Keep-alive connections to storage, shared by the fetch threads
+HTTP_SESSION = requests.Session()
+HTTP_SESSION.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=4))
+HTTP_SESSION.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=4))
+FETCH_POOL = ThreadPoolExecutor(max_workers=2, thread_name_prefix='fetch')
+
 # Endpoints
 def health():
     return {"message": "OK"}, 200
 
-def get_stats() -> dict:
-    data = query_db()
-    stats = {
-        'max_temp': data['max_temp'], 
-        'min_temp': data['min_temp'], 
-        'avg_temp': data['avg_temp'], 
-        'max_pm2_5': data['max_pm2_5'], 
-        'max_co_2': data['max_co_2'], 
-        'last_updated': data['last_updated']
+def ready():
+    checks = {"stats": SNAPSHOT[0] is not None}
+    if not all(checks.values()):
+        return {"message": "Not ready", "checks": checks}, 503
+    return {"message": "OK", "checks": checks}, 200
+
+def get_metrics():
+    return Response(METRICS.exposition(), mimetype='text/plain')
+
+def health_detail():
+    # the jobs run in the leader, the other workers read the runs it saved
+    runs = JOB_RUNS if LEADER.is_leader else load_state(JOBS_FILE) or dict()
+    duration, finished = runs.get('populate_stats', (None, None))
+    signals = {
+        "job_duration_sec": duration, 
+        "job_age_sec": None if finished is None else time.time() - finished, 
+        "db_checkout_ms": db_checkout_ms()
+    }
+    return {"message": "OK", "signals": signals}, 200
+
+def get_stats(window: str = None, location: str = None) -> dict:
+    if location is not None and not SKETCHES.by_location:
+        return {"message": "Per-location quantiles are disabled"}, 400
+    location = location or ALL_LOCATIONS
+
+    if window is not None:
+        if window not in ROLLING_STATS:
+            return {"message": f"Unknown window: {window}. Available: {', '.join(ROLLING_STATS)}"}, 400
+        rolling = ROLLING_STATS[window]
+        stats = window_stats(window)
+        stats['quantiles'] = SKETCHES.quantiles(location, since=datetime.now() - timedelta(minutes=rolling.minutes))
+        return cached_response(stats)
+
+    _, body, etag = SNAPSHOT
+    if location != ALL_LOCATIONS:
+        body = dict(body, quantiles=SKETCHES.quantiles(location))
+        etag = None
+    return cached_response(body, etag)
+
+def stream_stats():
+    events = STATS_FEED.subscribe()
+    if events is None:
+        # each stream holds a worker connection, the clients turned away poll /stats instead
+        return {"message": "Too many streaming clients, poll /processing/stats"}, 503
+    # passed through unbuffered, connexion would otherwise read the endless stream to validate it
+    return Response(
+        events,
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+        direct_passthrough=True
+    )
+
+def get_alerts(state: str = None, limit: int = 100) -> dict:
+    session = DB_SESSION()
+    results = session.query(Alert)
+    if state is not None:
+        results = results.filter(Alert.state == state)
+    history = [alert.to_dict() for alert in results.order_by(Alert.id_.desc()).limit(limit)]
+    session.close()
+
+    alerts = {
+        'active': [dict(alert, timestamp=alert['timestamp'].strftime(DATETIME_FORMAT)) for alert in RULE_ENGINE.active()], 
+        'rules': [rule.to_dict() for rule in RULE_ENGINE.rules], 
+        'history': [dict(alert, timestamp=alert['timestamp'].strftime(DATETIME_FORMAT)) for alert in history]
+    }
+    return alerts, 200
+
+def get_trace(trace_id: str) -> dict:
+    stamps = TRACES.get(trace_id)
+    if stamps is None:
+        return {"message": f"Trace {trace_id} was not sampled or is no longer kept"}, 404
+    latency_ms = {stage: seconds * 1000 for stage, seconds in stage_latencies(stamps).items()}
+    if INGEST in stamps and STATS in stamps:
+        latency_ms['end_to_end'] = (stamps[STATS] - stamps[INGEST]) / 1e6
+    return {"trace_id": trace_id, "stages_ns": stamps, "latency_ms": latency_ms}, 200
+
+def window_stats(window: str) -> dict:
+    if LEADER.is_leader:
+        return ROLLING_STATS[window].to_dict()
+    return dict(WINDOW_VIEW.get(window) or ROLLING_STATS[window].to_dict())
+
+def cached_response(body: dict, etag: str = None):
+    etag = etag or make_etag(body)
+    headers = {
+        'ETag': f'"{etag}"', 
+        'Cache-Control': f'public, max-age={INTERVAL}'
+    }
+    if request.if_none_match.contains(etag):
+        return NoContent, 304, headers
+    return body, 200, headers
+
+def make_etag(body: dict) -> str:
+    return sha1(json.dumps(body, sort_keys=True).encode('utf-8')).hexdigest()[:20]
+
+def update_snapshot(stats: dict) -> None:
+    """Replaces the latest stats snapshot served by get_stats()"""
+    global SNAPSHOT
+    body = {
+        'count': stats['count'], 
+        'max_temp': stats['max_temp'], 
+        'min_temp': stats['min_temp'], 
+        'avg_temp': stats['avg_temp'], 
+        'max_pm2_5': stats['max_pm2_5'], 
+        'max_co_2': stats['max_co_2'], 
+        'quantiles': SKETCHES.quantiles(), 
+        'last_updated': stats['last_updated']
     }
-    return stats, 200
+    # single assignment, so readers never see a partial update
+    SNAPSHOT = (stats, body, make_etag(body))
+    STATS_FEED.publish(body)
 
 # processor logic
+def timed(job_id: str):
+    """Records how long each run of a scheduled job takes"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.monotonic()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                duration = time.monotonic() - started
+                JOB_RUNS[job_id] = (duration, time.time())
+                JOB_SECONDS.observe(duration, job_id)
+                save_state(JOBS_FILE, JOB_RUNS)
+        return wrapper
+    return decorator
+
+@timed('populate_stats')
 def populate_stats() -> None:
     logger.info("Checking for updated data")
-    # read in stats from sqlite db
-    stats = query_db()
+    pages = 0
+    while pages < MAX_PAGES:
+        # Query storage server endpoints after the last processed row ids
+        try:
+            temp_table_contents, env_table_contents = fetch_tables(
+                {'after_id': CURSORS['temperature'], 'limit': PAGE_SIZE}, 
+                {'after_id': CURSORS['environment'], 'limit': PAGE_SIZE}
+            )
+        
+        except (JSONDecodeError, RequestException):
+            logger.warning("Storage server unavailable.")
+            break
+
+        if not temp_table_contents and not env_table_contents:
+            logger.info("Data is up-to-date")
+            break
+
+        try:
+            with BATCH_SECONDS.time():
+                process_batch(temp_table_contents, env_table_contents)
+            trace_batch(temp_table_contents, env_table_contents)
+            save_windows()
+            ROWS.inc('temperature', amount=len(temp_table_contents))
+            ROWS.inc('environment', amount=len(env_table_contents))
+            logger.info("Data updated")
+
+        except KeyError as e:
+            logger.error("Invalid content: %s", e)
+            break
+
+        pages += 1
+        if len(temp_table_contents) < PAGE_SIZE and len(env_table_contents) < PAGE_SIZE:
+            break
+    
+    else:
+        # still behind storage, run again straight away instead of waiting an interval
+        logger.info("Processed %s pages - Scheduling catch-up run", pages)
+        SCHEDULER.modify_job('populate_stats', next_run_time=datetime.now())
+        
+    logger.debug("Stopped periodic processing")
+
+def process_batch(temp_table_contents: list, env_table_contents: list) -> None:
     # last updated statistics
+    stats = SNAPSHOT[0]
+    last_count = stats['count']
     last_buffer = stats['temp_buffer']
     last_max = stats['max_temp']
     last_min = stats['min_temp']
     last_max_pm25 = stats['max_pm2_5']
     last_max_co_2 = stats['max_co_2']
-    last_timestamp = stats['last_updated']
     # Current timestamp
-    timestamp = datetime.strftime(datetime.now(), DATETIME_FORMAT)
-    # Query storage server endpoints using timestamp
-    try:
-        # Temperature table
-        temp_table_contents = query_temperature(last_timestamp, timestamp)
-        # Environment table
-        env_table_contents = query_environment(last_timestamp, timestamp)
-        # Parse updated telemetry
+    now = datetime.now()
+    timestamp = datetime.strftime(now, DATETIME_FORMAT)
+    # Temperature telemetry
+    temp_list = list()
+    temp_buffer = float()
+    for packet in temp_table_contents:
+        temp_list.append(packet['temperature'])
+        temp_buffer += packet['temperature']
+    new_buffer = last_buffer + temp_buffer
+    count = last_count + len(temp_list)
+    # high-water marks cover the whole page, including rows already in the stats
+    cursors = {
+        'temperature': temp_table_contents[-1]['id'] if temp_table_contents else CURSORS['temperature'], 
+        'environment': env_table_contents[-1]['id'] if env_table_contents else CURSORS['environment']
+    }
+    if COUNTED_BEFORE is not None:
+        env_table_contents = [packet for packet in env_table_contents if packet_time(packet, now) >= COUNTED_BEFORE]
+    # Environment telemetry
+    pm25_list = list()
+    co2_list = list()
+    for packet in env_table_contents:
+        pm25_list.append(packet['environment']['pm2_5'])
+        co2_list.append(packet['environment']['co_2'])
+    # Update stats
+    payload = {
+        'count': count, 
+        'temp_buffer': new_buffer, 
+        'max_temp': max(last_max, max(temp_list, default=-22)), 
+        'min_temp': min(last_min, min(temp_list, default=52)), 
+        'avg_temp': round(new_buffer/count, 2) if count else stats['avg_temp'], 
+        'max_pm2_5': max(last_max_pm25, max(pm25_list, default=0)), 
+        'max_co_2': max(last_max_co_2, max(co2_list, default=0)), 
+        'last_updated': timestamp
+    }
+    # Rolling window stats
+    update_windows(temp_table_contents, env_table_contents, now)
+    # Quantile sketches
+    update_sketches(temp_table_contents, env_table_contents, now)
+    # Alert rules
+    update_alerts(temp_table_contents, env_table_contents, now)
+    # Add new row and high-water marks to database
+    insert_db(payload, cursors)
+    CURSORS.update(cursors)
+    update_snapshot(payload)
+
+def trace_batch(temp_table_contents: list, env_table_contents: list) -> None:
+    """Records how long the rows of a batch took to reach the published stats"""
+    stats = now_ns()
+    for packets in (temp_table_contents, env_table_contents):
+        for packet in packets:
+            # every row has its creation time, only sampled rows carry the earlier stamps
+            created = packet_time(packet, None)
+            if created is not None:
+                STAGE_SECONDS.observe(stats / 1e9 - created.timestamp(), 'time_to_stats')
+            trace = packet.get('trace')
+            if trace is None:
+                continue
+            TRACES.record(packet['trace_id'], dict(trace, **{STATS: stats}))
+            if INGEST in trace:
+                STAGE_SECONDS.observe((stats - trace[INGEST]) / 1e9, 'end_to_end')
+
+def update_windows(temp_table_contents: list, env_table_contents: list, timestamp: datetime) -> None:
+    for rolling in ROLLING_STATS.values():
         try:
-            last_temp_packet = temp_table_contents[-1]
-            count = last_temp_packet['id']
-            # Temperature telemetry
-            temp_list = list()
-            temp_buffer = float()
-            for packet in temp_table_contents:
-                temp_list.append(packet['temperature'])
-                temp_buffer += packet['temperature']
-            new_buffer = last_buffer + temp_buffer
-            # Environment telemetry
-            pm25_list = list()
-            co2_list = list()
-            for packet in env_table_contents:
-                pm25_list.append(packet['environment']['pm2_5'])
-                co2_list.append(packet['environment']['co_2'])
-            # Update stats
-            payload = {
-                'count': count, 
-                'temp_buffer': new_buffer, 
-                'max_temp': max(last_max, max(temp_list, default=-22)), 
-                'min_temp': min(last_min, min(temp_list, default=52)), 
-                'avg_temp': round(new_buffer/count, 2), 
-                'max_pm2_5': max(last_max_pm25, max(pm25_list, default=0)), 
-                'max_co_2': max(last_max_co_2, max(co2_list, default=0)), 
-                'last_updated': timestamp
-            }
-            # Add new row to database
-            insert_db(payload)
-            logger.info("Data updated")
-
-        except IndexError:
-            logger.info("Data is up-to-date")
-        
+            rolling.update(temp_table_contents, env_table_contents, timestamp)
         except KeyError as e:
-            logger.error(f"Invalid content: {e}")
-    
-    except JSONDecodeError:
-        logger.warning(f"Storage server unavailable.")
-        
-    logger.debug("Stopped periodic processing")
+            logger.error("Invalid content for %s window: %s", rolling.label, e)
+
+def update_sketches(temp_table_contents: list, env_table_contents: list, timestamp: datetime) -> None:
+    try:
+        SKETCHES.update(temp_table_contents, env_table_contents, timestamp)
+    except KeyError as e:
+        logger.error("Invalid content for quantile sketches: %s", e)
+    SKETCHES.expire(timestamp - timedelta(days=QUANTILES['retention_days']))
+    save_sketches(timestamp)
+
+def update_alerts(temp_table_contents: list, env_table_contents: list, timestamp: datetime) -> None:
+    transitions = RULE_ENGINE.evaluate(temp_table_contents, env_table_contents, timestamp)
+    if not transitions:
+        return
+    session = DB_SESSION()
+    for alert in transitions:
+        session.add(Alert(**alert))
+        if alert['state'] == FIRING:
+            logger.warning("Alert %s firing at %s - %s: %s", alert['rule'], alert['location'], alert['metric'], alert['value'])
+        else:
+            logger.info("Alert %s resolved at %s - %s: %s", alert['rule'], alert['location'], alert['metric'], alert['value'])
+    session.commit()
+
+    session.close()
 
+def load_alerts() -> None:
+    firing = firing_alerts()
+    RULE_ENGINE.restore(firing)
+    logger.info("Alert rules loaded: %s rules, %s firing", len(RULE_ENGINE.rules), len(firing))
 
-def query_temperature(last_timestamp, timestamp):
+def firing_alerts() -> list:
+    # the latest transition per rule and location tells which alerts are still firing
+    session = DB_SESSION()
+    latest = session.query(func.max(Alert.id_)).group_by(Alert.rule, Alert.location)
+    alerts = [alert.to_dict() for alert in session.query(Alert).filter(Alert.id_.in_(latest), Alert.state == FIRING)]
+    session.close()
+    rules = {rule.name for rule in RULE_ENGINE.rules}
+    return [alert for alert in alerts if alert['rule'] in rules]
+
+def seed_windows() -> None:
+    # fill rolling windows once at startup so they are not empty after a restart
+    if not ROLLING_STATS:
+        return
+    now = datetime.now()
+    span = max(rolling.minutes for rolling in ROLLING_STATS.values())
+    start = datetime.strftime(now - timedelta(minutes=span), DATETIME_FORMAT)
+    end = datetime.strftime(now, DATETIME_FORMAT)
     try:
-        temp_res = requests.get(
-            f"{SERVER_URL}/temperature", 
-            params={'start_timestamp': last_timestamp, 
-            'end_timestamp': timestamp}
-            )
-        temp_table_contents = json.loads(temp_res.text) # Error trigger
+        params = {'start_timestamp': start, 'end_timestamp': end}
+        update_windows(*fetch_tables(params, params), now)
+        logger.info("Rolling windows seeded: %s", ', '.join(ROLLING_STATS))
+    except (JSONDecodeError, RequestException):
+        logger.warning("Unable to seed rolling windows. Storage server unavailable.")
 
-        if len(temp_table_contents) == 0:
-            logger.info(f"No new temperature data")
-        else:
-            logger.info(f"Updating temperature data. Content length: {len(temp_table_contents)} -- GET /storage/temperature {temp_res.status_code}")
-            logger.debug(f"Content: {temp_table_contents}")
 
-        return temp_table_contents
+def query_temperature(params: dict):
+    return query_table('temperature', params)
 
-    except JSONDecodeError as e:
-        logger.warning(f"No content returned: {e}")
-        raise
+def query_environment(params: dict):
+    return query_table('environment', params)
 
-def query_environment(last_timestamp, timestamp):
+def query_table(table: str, params: dict) -> list:
     try:
-        env_res = requests.get(
-            f"{SERVER_URL}/environment", 
-            params={'start_timestamp': last_timestamp, 
-            'end_timestamp': timestamp}
+        res = HTTP_SESSION.get(
+            f"{SERVER_URL}/{table}", 
+            params=params, 
+            timeout=REQUEST_TIMEOUT
             )
-        env_table_contents = json.loads(env_res.text) # Error trigger
-        
-        if len(env_table_contents) == 0:
-            logger.info(f"No new environment data")
+        table_contents = json_loads(res.content) # Error trigger
+
+        if len(table_contents) == 0:
+            logger.info("No new %s data", table)
         else:
-            logger.info(f"Updating environment data. Content length: {len(env_table_contents)} -- GET /storage/environment {env_res.status_code}")
-            logger.debug(f"Content: {env_table_contents}")
+            logger.info("Updating %s data. Content length: %d -- GET /storage/%s %s", table, len(table_contents), table, res.status_code)
+            logger.debug("Content: %s", table_contents)
 
-        return env_table_contents
+        return table_contents
 
     except JSONDecodeError as e:
-        logger.warning(f"No content returned: {e}")
+        logger.warning("No content returned: %s", e)
+        raise
+
+    except RequestException as e:
+        logger.warning("Request to /storage/%s failed: %s", table, e)
         raise
 
+def fetch_tables(temp_params: dict, env_params: dict) -> tuple:
+    # both tables are requested at once, so a cycle costs one round-trip
+    with FETCH_SECONDS.time():
+        temp_future = FETCH_POOL.submit(query_temperature, temp_params)
+        env_future = FETCH_POOL.submit(query_environment, env_params)
+        return temp_future.result(), env_future.result()
+
+
+# Leader and followers
+def save_windows() -> None:
+    """Saves the rolling window stats for the workers that follow the leader"""
+    save_state(WINDOWS_FILE, {label: rolling.to_dict() for label, rolling in ROLLING_STATS.items()})
+
+def follow_state() -> None:
+    """Loads the stats, sketches, alerts and windows the leader saved since the last call"""
+    global SKETCHES_SYNCED, WINDOW_VIEW
+    stats = query_db()
+    if stats != SNAPSHOT[0]:
+        update_snapshot(stats)
+
+    session = DB_SESSION()
+    sketches = session.query(Sketch)
+    if SKETCHES_SYNCED is not None:
+        sketches = sketches.filter(Sketch.last_updated >= SKETCHES_SYNCED)
+    for sketch in sketches:
+        SKETCHES.replace(sketch.metric, sketch.location, sketch.bucket, sketch.digest)
+        SKETCHES_SYNCED = max(SKETCHES_SYNCED or sketch.last_updated, sketch.last_updated)
+    session.close()
+    SKETCHES.expire(datetime.now() - timedelta(days=QUANTILES['retention_days']))
+
+    RULE_ENGINE.restore(firing_alerts(), replace=True)
+
+    WINDOW_VIEW = load_state(WINDOWS_FILE) or WINDOW_VIEW
+
+def follow_leader() -> None:
+    while not LEADER.is_leader:
+        try:
+            follow_state()
+        except Exception as e:
+            logger.warning("Unable to follow the leader's state - %s", e)
+        LEADER.elected.wait(INTERVAL)
+
 
 # Database functions
 def query_db() -> dict:
@@ -205,7 +542,7 @@ def query_db() -> dict:
     
     return payload
 
-def insert_db(data: dict) -> None:
+def insert_db(data: dict, cursors: dict) -> None:
     session = DB_SESSION()
     stats = Stats(
         count=data['count'], 
@@ -218,9 +555,80 @@ def insert_db(data: dict) -> None:
         last_updated=datetime.strptime(data['last_updated'], DATETIME_FORMAT)
     )
     session.add(stats)
+    # high-water marks are committed with the stats row they produced
+    for table, last_id in cursors.items():
+        cursor = session.query(Cursor).get(table)
+        if cursor is None:
+            session.add(Cursor(table, last_id))
+        else:
+            cursor.last_id = last_id
+    session.commit()
+
+    session.close()
+
+def load_cursors() -> None:
+    global COUNTED_BEFORE
+    session = DB_SESSION()
+    for cursor in session.query(Cursor):
+        CURSORS[cursor.table_name] = cursor.last_id
+    COUNTED_BEFORE = None
+    if session.query(Cursor).count() == 0 and SNAPSHOT[0]['count']:
+        # stats created before cursors, count matches the last temperature row id, and
+        # environment rows were read by time up to the last update
+        CURSORS['temperature'] = SNAPSHOT[0]['count']
+        COUNTED_BEFORE = datetime.strptime(SNAPSHOT[0]['last_updated'], DATETIME_FORMAT)
+        logger.warning("No cursors found - environment data created before %s is skipped", SNAPSHOT[0]['last_updated'])
+    session.close()
+    logger.info("Cursors loaded: %s", CURSORS)
+
+def save_sketches(timestamp: datetime) -> None:
+    rows = SKETCHES.flush()
+    if not rows:
+        return
+    session = DB_SESSION()
+    for metric, location, bucket, digest in rows:
+        sketch = session.query(Sketch).filter_by(metric=metric, location=location, bucket=bucket).first()
+        if sketch is None:
+            session.add(Sketch(metric, location, bucket, digest, timestamp))
+        else:
+            sketch.digest = digest
+            sketch.last_updated = timestamp
+    # hourly buckets past retention are dropped, all-time rows are kept
+    cutoff = (timestamp - timedelta(days=QUANTILES['retention_days'])).strftime(BUCKET_FORMAT)
+    session.query(Sketch).filter(Sketch.bucket != ALL_TIME, Sketch.bucket < cutoff).delete()
     session.commit()
 
     session.close()
+    logger.debug("Saved %s quantile sketches", len(rows))
+
+def load_sketches() -> None:
+    global SKETCHES_SYNCED
+    session = DB_SESSION()
+    for sketch in session.query(Sketch):
+        SKETCHES.replace(sketch.metric, sketch.location, sketch.bucket, sketch.digest)
+        SKETCHES_SYNCED = max(SKETCHES_SYNCED or sketch.last_updated, sketch.last_updated)
+    session.close()
+    logger.info("Loaded %s quantile sketches", len(SKETCHES.digests))
+
+def compact_db() -> None:
+    # keep the latest row per minute for recent history and per hour after that
+    cutoff = datetime.now() - timedelta(hours=HISTORY['minute_retention_hours'])
+    session = DB_SESSION()
+    result = session.execute(compact, {'cutoff': cutoff.strftime("%Y-%m-%d %H:%M:%S")})
+    # old transitions go, except the latest per rule and location which holds its current state
+    cutoff = datetime.now() - timedelta(days=ALERTS['retention_days'])
+    pruned = session.execute(prune_alerts, {'cutoff': cutoff.strftime("%Y-%m-%d %H:%M:%S")})
+    session.commit()
+
+    session.close()
+    logger.info("Stats history compacted. Removed %s rows, %s alert transitions", result.rowcount, pruned.rowcount)
+
+def db_checkout_ms() -> float:
+    # time to check out a connection and run a trivial query
+    started = time.perf_counter()
+    with DB_ENGINE.connect() as conn:
+        conn.execute(text('SELECT 1'))
+    return (time.perf_counter() - started) * 1000
 
 def init_db() -> None:
     # populate first row with default stats
@@ -243,62 +651,98 @@ def connect_database(filename: str):
             c.execute(version)
             data = c.fetchall().pop()
         ersion = data[0]
-        logger.info(f"Database connected: {abs_path} - SQLite v{ersion}")
+        query(filename, create_sketches)
+        query(filename, create_index)
+        query(filename, create_cursors)
+        query(filename, create_alerts)
+        query(filename, create_alerts_index)
+        logger.info("Database connected: %s - SQLite v%s", abs_path, ersion)
 
     elif not path.exists(abs_path):
-        logger.info(f"Database {filename} does not exist - Initialising...")
+        logger.info("Database %s does not exist - Initialising...", filename)
         with connect(filename) as conn:
             c = conn.cursor()
             try:
                 c.execute(create)
+                c.execute(create_sketches)
+                c.execute(create_index)
+                c.execute(create_cursors)
+                c.execute(create_alerts)
+                c.execute(create_alerts_index)
             finally:
                 conn.commit()
-        logger.info(f"Database created: {abs_path}")
+        logger.info("Database created: %s", abs_path)
         init_db()
 
 # Server connection
-def connect_server(url: str, timeout: int) -> None:
+def connect_server(url: str, timeout: int) -> bool:
     retries: int = 0
     while retries < timeout:
         try:
             res = requests.head(
                 url=url
             )
-            logger.info(f"Connected to server at {url} - {res.status_code}")
-            break
+            logger.info("Connected to server at %s - %s", url, res.status_code)
+            return True
 
         except ConnectionError as err:
-            logger.warning(f"Unable to connect to server. Error: {err} - Retries ({retries})")
+            logger.warning("Unable to connect to server. Error: %s - Retries (%s)", err, retries)
             retries += 1
             time.sleep(2)
             continue
         
         except RequestException as e:
             logger.error(e)
-            raise SystemExit(1)
+            return False
     
     else:
-        logger.error(f"Unable to connect to server at {url}. Max retries exceeded ({retries})")
-        raise SystemExit(1)
+        # the scheduled runs keep polling storage, so processing starts without it
+        logger.error("Unable to connect to server at %s. Max retries exceeded (%s)", url, retries)
+        return False
+
+def start_processing() -> None:
+    """Waits for storage and starts the scheduled jobs, in the background so stats are served at once"""
+    global SCHEDULER
+    # pick up where the previous leader stopped, if this worker took over
+    follow_state()
+    load_cursors()
+    if connect_server(SERVER_URL, TIMEOUT):
+        seed_windows()
+    save_windows()
+    SCHEDULER = init_scheduler()
 
 def init_scheduler() -> None:
-    sched = BackgroundScheduler(daemon=True, job_defaults={'max_instances': 3})
-    sched.add_job(populate_stats, 'interval', seconds=INTERVAL)
+    # one run at a time, missed runs are coalesced into the next one
+    sched = BackgroundScheduler(daemon=True, job_defaults={'max_instances': 1, 'coalesce': True})
+    sched.add_job(populate_stats, 'interval', seconds=INTERVAL, id='populate_stats')
+    sched.add_job(compact_db, 'interval', seconds=HISTORY['compaction_period_sec'], id='compact_db')
     sched.start()
 
+    return sched
+
 
 app = connexion.FlaskApp(__name__, specification_dir='openapi/')
 if 'TARGET_ENV' not in environ and environ['TARGET_ENV'] != 'prod':
     CORS(app.app)
     app.app.config['CORS_HEADERS'] = 'Content-Type'
-app.add_api('openapi.yml', base_path='/processing', strict_validation=True, validate_responses=True)
+spec.add_api(app, 'openapi.yml', base_path='/processing', strict_validation=True, validate_responses=True)
+METRICS.instrument(app.app)
+application = app.app
+
+def start_worker() -> None:
+    """Starts a worker, called by gunicorn after the fork, the leader also runs the scheduled jobs"""
+    with file_lock(f'{DATA_URL}.lock'):
+        connect_database(DATA_URL)
+    load_sketches()
+    update_snapshot(query_db())
+    load_cursors()
+    load_alerts()
+    LEADER.campaign(start_processing)
+    Thread(target=follow_leader, name='follow', daemon=True).start()
 
 def main() -> None:
-    connect_database(DATA_URL)
-    connect_server(SERVER_URL, TIMEOUT)
-    init_scheduler()
+    start_worker()
     app.run(port=8100, debug=False)
 
-
 if __name__ == '__main__':
     main()
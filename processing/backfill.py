@@ -0,0 +1,247 @@
+# Copyright 2020 - 2023 Alexander Visca. All rights reserved
+"""
+Stats Backfill
+
+Recomputes the stats history over a date range from the storage service.
+The range is split into chunks which are aggregated in a process pool
+and merged in order into cumulative stats rows and quantile sketches.
+Completed chunks are recorded in a progress file, so an interrupted
+backfill resumes where it stopped.
+
+Stop the processing service while a backfill is running.
+
+Usage
+python3 backfill.py --start 2023-01-01 --end 2024-01-01 --chunk 1d --workers 8
+"""
+import argparse
+import json
+import logging
+import logs
+import requests
+import yaml
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timedelta
+from os import environ, path, remove
+from sketch import SketchSet, ALL_TIME
+from stats import Stats, Sketch, Cursor
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from window import parse_window
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+# Constants
+DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+# Environment config
+if 'TARGET_ENV' in environ and environ['TARGET_ENV'] == 'prod':
+    app_conf_file = '/config/app_conf.yml'
+    log_conf_file = '/config/log_conf.yml'
+else:
+    app_conf_file = 'app_conf.yml'
+    log_conf_file = 'log_conf.yml'
+
+# Logging config
+with open(log_conf_file, mode='r') as file:
+    log_config = yaml.safe_load(file.read())
+    logs.configure(log_config)
+
+logger = logging.getLogger('processor')
+
+# application config
+with open(app_conf_file, mode='r') as file:
+    app_config = yaml.safe_load(file.read())
+
+SERVER_URL = app_config['eventstore']['url']
+DATA_URL = app_config['datastore']['filename']
+PAGE_SIZE = app_config['scheduler']['page_size']
+REQUEST_TIMEOUT = app_config['connection']['request_timeout']
+QUANTILES = app_config['stats']['quantiles']
+
+
+# chunk aggregation (runs in worker processes)
+def fetch_chunk(session, table: str, start: str, end: str):
+    after_id = 0
+    while True:
+        res = session.get(
+            f"{SERVER_URL}/{table}",
+            params={'start_timestamp': start, 'end_timestamp': end,
+            'after_id': after_id, 'limit': PAGE_SIZE},
+            timeout=REQUEST_TIMEOUT
+            )
+        res.raise_for_status()
+        page = json_loads(res.content)
+        yield page
+        if len(page) < PAGE_SIZE:
+            break
+        after_id = page[-1]['id']
+
+def aggregate_chunk(index: int, start: str, end: str) -> dict:
+    """Partial aggregate of one chunk, merged in order by the parent process"""
+    partial = {
+        'index': index, 'start': start, 'end': end,
+        'temp_count': 0, 'temp_sum': 0.0, 'env_count': 0,
+        'max_temp': None, 'min_temp': None, 'max_pm2_5': None, 'max_co_2': None,
+        'last_temp_id': 0, 'last_env_id': 0
+    }
+    sketches = SketchSet(QUANTILES['compression'], QUANTILES['by_location'])
+    chunk_end = datetime.strptime(end, DATETIME_FORMAT)
+    with requests.Session() as session:
+        for page in fetch_chunk(session, 'temperature', start, end):
+            values = [packet['temperature'] for packet in page]
+            if not values:
+                continue
+            if partial['temp_count'] == 0:
+                partial['max_temp'], partial['min_temp'] = values[0], values[0]
+            partial['temp_count'] += len(values)
+            partial['temp_sum'] += sum(values)
+            partial['max_temp'] = max(partial['max_temp'], max(values))
+            partial['min_temp'] = min(partial['min_temp'], min(values))
+            partial['last_temp_id'] = page[-1]['id']
+            sketches.update(page, [], chunk_end)
+
+        for page in fetch_chunk(session, 'environment', start, end):
+            if not page:
+                continue
+            pm25 = max(packet['environment']['pm2_5'] for packet in page)
+            co2 = max(packet['environment']['co_2'] for packet in page)
+            partial['env_count'] += len(page)
+            partial['max_pm2_5'] = max(pm25, partial['max_pm2_5'] or 0)
+            partial['max_co_2'] = max(co2, partial['max_co_2'] or 0)
+            partial['last_env_id'] = page[-1]['id']
+            sketches.update([], page, chunk_end)
+
+    partial['sketches'] = [[metric, location, bucket, digest.hex()] for metric, location, bucket, digest in sketches.flush()]
+    return partial
+
+
+# progress file
+def load_progress(filename: str) -> dict:
+    completed = dict()
+    if path.exists(filename):
+        with open(filename, mode='r') as file:
+            for line in file:
+                if line.strip():
+                    partial = json.loads(line)
+                    completed[(partial['start'], partial['end'])] = partial
+    return completed
+
+def save_progress(filename: str, partial: dict) -> None:
+    with open(filename, mode='a') as file:
+        file.write(json.dumps(partial) + '\n')
+
+
+# merge and write
+def merge_chunks(partials: list, session) -> None:
+    start = datetime.strptime(partials[0]['start'], DATETIME_FORMAT)
+    end = datetime.strptime(partials[-1]['end'], DATETIME_FORMAT)
+    base = session.query(Stats).filter(Stats.last_updated < start).order_by(Stats.last_updated.desc()).first()
+    if base is None:
+        stats = {'count': 0, 'temp_buffer': 0.0, 'max_temp': -21, 'min_temp': 51,
+            'avg_temp': 0, 'max_pm2_5': 0, 'max_co_2': 0}
+    else:
+        stats = {'count': base.count, 'temp_buffer': base.temp_buffer, 'max_temp': base.max_temp,
+            'min_temp': base.min_temp, 'avg_temp': base.avg_temp,
+            'max_pm2_5': base.max_pm2_5, 'max_co_2': base.max_co_2}
+
+    removed = session.query(Stats).filter(Stats.last_updated >= start, Stats.last_updated < end).delete()
+    logger.info("Replacing %s stats rows between %s and %s", removed, start, end)
+    later = session.query(Stats).filter(Stats.last_updated >= end).count()
+    if later:
+        logger.warning("Stats rows after the backfill range were computed from the old history")
+
+    sketches = SketchSet(QUANTILES['compression'], QUANTILES['by_location'])
+    last_ids = {'temperature': 0, 'environment': 0}
+    for partial in partials:
+        # cumulative stats, the same way populate_stats() builds them
+        stats['count'] += partial['temp_count']
+        stats['temp_buffer'] += partial['temp_sum']
+        if partial['temp_count']:
+            stats['max_temp'] = max(stats['max_temp'], partial['max_temp'])
+            stats['min_temp'] = min(stats['min_temp'], partial['min_temp'])
+            stats['avg_temp'] = round(stats['temp_buffer'] / stats['count'], 2)
+        if partial['env_count']:
+            stats['max_pm2_5'] = max(stats['max_pm2_5'], partial['max_pm2_5'])
+            stats['max_co_2'] = max(stats['max_co_2'], partial['max_co_2'])
+        session.add(Stats(last_updated=datetime.strptime(partial['end'], DATETIME_FORMAT), **stats))
+
+        for metric, location, bucket, digest in partial['sketches']:
+            sketches.merge(metric, location, bucket, bytes.fromhex(digest))
+        last_ids['temperature'] = max(last_ids['temperature'], partial['last_temp_id'])
+        last_ids['environment'] = max(last_ids['environment'], partial['last_env_id'])
+
+    # hourly buckets are replaced, all-time sketches only when the range covers the whole history
+    whole_history = base is None and not later
+    for (metric, location, bucket), digest in sketches.digests.items():
+        digest = digest.to_bytes()
+        if bucket == ALL_TIME and not whole_history:
+            continue
+        sketch = session.query(Sketch).filter_by(metric=metric, location=location, bucket=bucket).first()
+        if sketch is None:
+            session.add(Sketch(metric, location, bucket, digest, end))
+        else:
+            sketch.digest = digest
+            sketch.last_updated = end
+    if base is not None:
+        logger.warning("All-time quantile sketches were not recomputed - backfill did not start at the first row")
+    elif later:
+        logger.warning("All-time quantile sketches were not recomputed - readings after the backfill range are not in them")
+
+    # move live processing past the backfilled rows
+    for table, last_id in last_ids.items():
+        cursor = session.query(Cursor).get(table)
+        if cursor is None:
+            session.add(Cursor(table, last_id))
+        elif cursor.last_id < last_id:
+            cursor.last_id = last_id
+
+    session.commit()
+    logger.info("Backfill written: %s stats rows, cursors %s", len(partials), last_ids)
+
+
+def chunk_range(start: datetime, end: datetime, size: timedelta) -> list:
+    chunks = list()
+    while start < end:
+        chunks.append((start.strftime(DATETIME_FORMAT), min(start + size, end).strftime(DATETIME_FORMAT)))
+        start += size
+    return chunks
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Recompute processing stats history from storage")
+    parser.add_argument('--start', required=True, type=datetime.fromisoformat, help="first day to recompute (eg. 2023-01-01)")
+    parser.add_argument('--end', required=True, type=datetime.fromisoformat, help="end of the range, exclusive")
+    parser.add_argument('--chunk', default='1d', help="chunk size, one stats row is written per chunk (eg. 1h, 1d)")
+    parser.add_argument('--workers', default=4, type=int, help="worker processes")
+    parser.add_argument('--progress', default=f"{DATA_URL}.backfill", help="progress file used to resume")
+    args = parser.parse_args()
+
+    chunks = chunk_range(args.start, args.end, timedelta(minutes=parse_window(args.chunk)))
+    if not chunks:
+        parser.error("--end must be after --start")
+    completed = load_progress(args.progress)
+    pending = [(index, start, end) for index, (start, end) in enumerate(chunks) if (start, end) not in completed]
+    logger.info("Backfill %s - %s: %s chunks, %s already done", args.start, args.end, len(chunks), len(chunks) - len(pending))
+
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = [pool.submit(aggregate_chunk, index, start, end) for index, start, end in pending]
+        for done, future in enumerate(as_completed(futures), start=len(chunks) - len(pending) + 1):
+            partial = future.result()
+            save_progress(args.progress, partial)
+            completed[(partial['start'], partial['end'])] = partial
+            logger.info("Chunk %s done (%s/%s, %s%%) - %s temperature, %s environment",
+                partial['start'], done, len(chunks), done * 100 // len(chunks), partial['temp_count'], partial['env_count'])
+
+    engine = create_engine(f"sqlite:///{DATA_URL}")
+    session = sessionmaker(bind=engine)()
+    try:
+        merge_chunks([completed[chunk] for chunk in chunks], session)
+    finally:
+        session.close()
+    # partials are only reused while the backfill is unfinished
+    remove(args.progress)
+
+
+if __name__ == '__main__':
+    main()
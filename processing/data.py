@@ -1,5 +1,6 @@
 import sqlite3
 from sqlite3 import OperationalError
+from sqlalchemy import text
 from sqlalchemy.ext.declarative import declarative_base
 
 Base = declarative_base()
@@ -25,6 +26,58 @@ create = '''
     last_updated VARCHAR(100) NOT NULL)
 '''
 
+create_index = '''
+    CREATE INDEX IF NOT EXISTS ix_stats_last_updated ON Stats (last_updated)
+'''
+
+create_cursors = '''
+    CREATE TABLE IF NOT EXISTS cursors
+    (table_name VARCHAR(50) PRIMARY KEY,
+    last_id INTEGER NOT NULL)
+'''
+
+create_alerts = '''
+    CREATE TABLE IF NOT EXISTS alerts
+    (id_ INTEGER PRIMARY KEY ASC,
+    rule VARCHAR(100) NOT NULL,
+    metric VARCHAR(50) NOT NULL,
+    location VARCHAR(250) NOT NULL,
+    state VARCHAR(20) NOT NULL,
+    value FLOAT NOT NULL,
+    threshold FLOAT NOT NULL,
+    timestamp VARCHAR(100) NOT NULL)
+'''
+
+create_alerts_index = '''
+    CREATE INDEX IF NOT EXISTS ix_alerts_rule_location ON alerts (rule, location, id_)
+'''
+
+create_sketches = '''
+    CREATE TABLE IF NOT EXISTS sketches
+    (id_ INTEGER PRIMARY KEY ASC,
+    metric VARCHAR(50) NOT NULL,
+    location VARCHAR(250) NOT NULL,
+    bucket VARCHAR(100) NOT NULL,
+    digest BLOB NOT NULL,
+    last_updated VARCHAR(100) NOT NULL,
+    UNIQUE (metric, location, bucket))
+'''
+
+# keeps the newest row per minute after :cutoff and per hour before it
+compact = text('''
+    DELETE FROM stats WHERE id_ NOT IN (
+        SELECT MAX(id_) FROM stats WHERE last_updated >= :cutoff 
+        GROUP BY substr(last_updated, 1, 16)
+        UNION 
+        SELECT MAX(id_) FROM stats WHERE last_updated < :cutoff 
+        GROUP BY substr(last_updated, 1, 13))
+''')
+
+prune_alerts = text('''
+    DELETE FROM alerts WHERE timestamp < :cutoff AND id_ NOT IN (
+        SELECT MAX(id_) FROM alerts GROUP BY rule, location)
+''')
+
 drop = '''
     DROP TABLE stats
     '''
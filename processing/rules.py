@@ -0,0 +1,114 @@
+"""
+Threshold alert rules
+
+Evaluates declarative rules against each batch of readings.
+A rule fires when its condition holds for every reading at a location
+over its duration, and resolves on the first reading that clears it.
+Rules are indexed by (location, metric), so each reading is only
+checked against the rules that can match it.
+"""
+import operator
+from datetime import datetime
+from threading import Lock
+from window import packet_time
+
+ALL_LOCATIONS = '*'
+COMPARATORS = {
+    '>': operator.gt,
+    '>=': operator.ge,
+    '<': operator.lt,
+    '<=': operator.le
+}
+FIRING = 'firing'
+RESOLVED = 'resolved'
+
+
+class Rule:
+    def __init__(self, name: str, metric: str, comparator: str, threshold: float, duration_sec: int = 0, scope: str = ALL_LOCATIONS) -> None:
+        if comparator not in COMPARATORS:
+            raise ValueError(f"Invalid comparator for rule {name}: {comparator}")
+        self.name = name
+        self.metric = metric
+        self.comparator = comparator
+        self.threshold = threshold
+        self.duration_sec = duration_sec
+        self.scope = scope
+        self.check = COMPARATORS[comparator]
+
+    def to_dict(self) -> dict:
+        return {
+            'name': self.name,
+            'metric': self.metric,
+            'comparator': self.comparator,
+            'threshold': self.threshold,
+            'duration_sec': self.duration_sec,
+            'scope': self.scope
+        }
+
+
+class RuleEngine:
+    def __init__(self, rules: list) -> None:
+        self.rules = rules
+        self.index = dict()
+        for rule in rules:
+            self.index.setdefault((rule.scope, rule.metric), list()).append(rule)
+        self.breach_since = dict()  # (rule name, location) -> first breaching reading time
+        self.firing = dict()  # (rule name, location) -> transition
+        self.lock = Lock()
+
+    def _match(self, location: str, metric: str) -> list:
+        return self.index.get((location, metric), []) + self.index.get((ALL_LOCATIONS, metric), [])
+
+    def _evaluate(self, location: str, metric: str, value: float, timestamp: datetime, transitions: list) -> None:
+        for rule in self._match(location, metric):
+            key = (rule.name, location)
+            if rule.check(value, rule.threshold):
+                since = self.breach_since.setdefault(key, timestamp)
+                if key not in self.firing and (timestamp - since).total_seconds() >= rule.duration_sec:
+                    self.firing[key] = transition(rule, location, FIRING, value, timestamp)
+                    transitions.append(self.firing[key])
+            else:
+                self.breach_since.pop(key, None)
+                if key in self.firing:
+                    del self.firing[key]
+                    transitions.append(transition(rule, location, RESOLVED, value, timestamp))
+
+    def evaluate(self, temp_packets: list, env_packets: list, timestamp: datetime) -> list:
+        """Returns the alert transitions caused by a batch of readings"""
+        transitions = list()
+        with self.lock:
+            for packet in temp_packets:
+                self._evaluate(packet['location'], 'temperature', float(packet['temperature']),
+                    packet_time(packet, timestamp), transitions)
+            for packet in env_packets:
+                created = packet_time(packet, timestamp)
+                self._evaluate(packet['location'], 'pm2_5', packet['environment']['pm2_5'], created, transitions)
+                self._evaluate(packet['location'], 'co_2', packet['environment']['co_2'], created, transitions)
+        return transitions
+
+    def restore(self, firing: list, replace: bool = False) -> None:
+        # alerts still firing when the service stopped, or as saved by the leader worker
+        with self.lock:
+            if replace:
+                self.firing = dict()
+                self.breach_since = dict()
+            for alert in firing:
+                key = (alert['rule'], alert['location'])
+                self.firing[key] = alert
+                self.breach_since[key] = alert['timestamp']
+
+    def active(self) -> list:
+        with self.lock:
+            return list(self.firing.values())
+
+
+def transition(rule: Rule, location: str, state: str, value: float, timestamp: datetime) -> dict:
+    return {
+        'rule': rule.name,
+        'metric': rule.metric,
+        'location': location,
+        'state': state,
+        'value': value,
+        'threshold': rule.threshold,
+        'timestamp': timestamp
+    }
@@ -0,0 +1,205 @@
+"""
+Streaming quantile sketches
+
+Merging t-digest used to estimate p50/p95/p99 of telemetry metrics
+without keeping every reading. Digests are mergeable, so hourly
+buckets can be combined on read, and the digests a backfill computes
+per chunk can be combined into one.
+"""
+import struct
+from array import array
+from datetime import datetime
+from math import asin, pi, sin
+from threading import Lock
+from window import packet_time
+
+BUCKET_FORMAT = "%Y-%m-%dT%H:00:00Z"
+ALL_LOCATIONS = '*'
+ALL_TIME = 'all'
+PERCENTILES = (50, 95, 99)
+HEADER = struct.Struct('<dddI')
+
+
+class TDigest:
+    """Merging t-digest with the k1 (arcsine) scale function"""
+    def __init__(self, compression: float = 100) -> None:
+        self.compression = compression
+        self.centroids = list()  # (mean, weight), sorted by mean
+        self.buffer = list()
+        self.total = 0.0
+        self.min = float('inf')
+        self.max = float('-inf')
+
+    def __len__(self) -> int:
+        return int(self.total)
+
+    def add(self, value: float, weight: float = 1) -> None:
+        value = float(value)
+        self.buffer.append((value, weight))
+        self.total += weight
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        if len(self.buffer) >= self.compression * 5:
+            self.compress()
+
+    def merge(self, other: 'TDigest') -> 'TDigest':
+        other.compress()
+        self.buffer.extend(other.centroids)
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.compress()
+        return self
+
+    def _k(self, q: float) -> float:
+        return self.compression / (2 * pi) * asin(2 * q - 1)
+
+    def _q(self, k: float) -> float:
+        if k >= self.compression / 4:
+            return 1.0
+        return (sin(k * 2 * pi / self.compression) + 1) / 2
+
+    def compress(self) -> None:
+        if not self.buffer:
+            return
+        points = sorted(self.centroids + self.buffer)
+        self.buffer = list()
+        merged = list()
+        mean, weight = points[0]
+        so_far = 0.0
+        limit = self.total * self._q(self._k(0) + 1)
+        for point_mean, point_weight in points[1:]:
+            if so_far + weight + point_weight <= limit:
+                weight += point_weight
+                mean += (point_mean - mean) * point_weight / weight
+            else:
+                merged.append((mean, weight))
+                so_far += weight
+                limit = self.total * self._q(self._k(so_far / self.total) + 1)
+                mean, weight = point_mean, point_weight
+        merged.append((mean, weight))
+        self.centroids = merged
+
+    def quantile(self, q: float):
+        self.compress()
+        if not self.centroids:
+            return None
+        if len(self.centroids) == 1:
+            return self.centroids[0][0]
+        target = q * self.total
+        cumulative = 0.0
+        prev_mean, prev_center = self.min, 0.0
+        for mean, weight in self.centroids:
+            center = cumulative + weight / 2
+            if target <= center:
+                if center == prev_center:
+                    return mean
+                ratio = (target - prev_center) / (center - prev_center)
+                return prev_mean + (mean - prev_mean) * ratio
+            prev_mean, prev_center = mean, center
+            cumulative += weight
+        if self.total == prev_center:
+            return self.max
+        ratio = (target - prev_center) / (self.total - prev_center)
+        return prev_mean + (self.max - prev_mean) * ratio
+
+    def to_bytes(self) -> bytes:
+        self.compress()
+        values = array('d')
+        for mean, weight in self.centroids:
+            values.append(mean)
+            values.append(weight)
+        header = HEADER.pack(self.compression, self.min, self.max, len(self.centroids))
+        return header + values.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'TDigest':
+        compression, low, high, size = HEADER.unpack_from(data)
+        values = array('d')
+        values.frombytes(data[HEADER.size:HEADER.size + size * 16])
+        digest = cls(compression)
+        digest.centroids = list(zip(values[0::2], values[1::2]))
+        digest.total = sum(values[1::2])
+        digest.min, digest.max = low, high
+        return digest
+
+
+class SketchSet:
+    """
+    Digests keyed by (metric, location, bucket)
+
+    Every reading is added to the all-time bucket and to its hourly bucket,
+    for all locations and, optionally, for its own location.
+    """
+    def __init__(self, compression: float = 100, by_location: bool = False) -> None:
+        self.compression = compression
+        self.by_location = by_location
+        self.digests = dict()
+        self.dirty = set()
+        self.lock = Lock()
+
+    def _add(self, metric: str, location: str, timestamp: datetime, value: float) -> None:
+        bucket = timestamp.strftime(BUCKET_FORMAT)
+        locations = (ALL_LOCATIONS, location) if self.by_location else (ALL_LOCATIONS,)
+        for loc in locations:
+            for key in ((metric, loc, ALL_TIME), (metric, loc, bucket)):
+                if key not in self.digests:
+                    self.digests[key] = TDigest(self.compression)
+                self.digests[key].add(value)
+                self.dirty.add(key)
+
+    def update(self, temp_packets: list, env_packets: list, timestamp: datetime) -> None:
+        with self.lock:
+            for packet in temp_packets:
+                self._add('temperature', packet['location'], packet_time(packet, timestamp), packet['temperature'])
+            for packet in env_packets:
+                created = packet_time(packet, timestamp)
+                self._add('pm2_5', packet['location'], created, packet['environment']['pm2_5'])
+                self._add('co_2', packet['location'], created, packet['environment']['co_2'])
+
+    def merge(self, metric: str, location: str, bucket: str, data: bytes) -> None:
+        # digests for the same key (eg. from consecutive backfill chunks) are merged
+        digest = TDigest.from_bytes(data)
+        with self.lock:
+            if (metric, location, bucket) in self.digests:
+                self.digests[(metric, location, bucket)].merge(digest)
+            else:
+                self.digests[(metric, location, bucket)] = digest
+
+    def replace(self, metric: str, location: str, bucket: str, data: bytes) -> None:
+        # a saved digest is the whole digest for its key, so it replaces this worker's copy
+        with self.lock:
+            self.digests[(metric, location, bucket)] = TDigest.from_bytes(data)
+
+    def flush(self) -> list:
+        """Returns (metric, location, bucket, bytes) for digests changed since the last flush"""
+        with self.lock:
+            rows = [(*key, self.digests[key].to_bytes()) for key in self.dirty]
+            self.dirty = set()
+        return rows
+
+    def expire(self, before: datetime) -> None:
+        cutoff = before.strftime(BUCKET_FORMAT)
+        with self.lock:
+            for key in [key for key in self.digests if key[2] != ALL_TIME and key[2] < cutoff]:
+                del self.digests[key]
+                self.dirty.discard(key)
+
+    def quantiles(self, location: str = ALL_LOCATIONS, since: datetime = None) -> dict:
+        """p50/p95/p99 per metric, all-time or merged from hourly buckets since a timestamp"""
+        result = dict()
+        with self.lock:
+            for metric in ('temperature', 'pm2_5', 'co_2'):
+                if since is None:
+                    digest = self.digests.get((metric, location, ALL_TIME))
+                else:
+                    start = since.strftime(BUCKET_FORMAT)
+                    digest = TDigest(self.compression)
+                    for (name, loc, bucket), part in self.digests.items():
+                        if name == metric and loc == location and bucket != ALL_TIME and bucket >= start:
+                            digest.merge(part)
+                result[metric] = {
+                    f'p{p}': None if not digest else round(digest.quantile(p / 100), 2)
+                    for p in PERCENTILES
+                }
+        return result
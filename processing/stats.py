@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, Float, String, DateTime
+from sqlalchemy import Column, Index, Integer, Float, String, DateTime, LargeBinary
 from data import Base
 
 
@@ -13,7 +13,7 @@ class Stats(Base):
     avg_temp = Column(Float(2), nullable=False)
     max_pm2_5 = Column(Integer, nullable=False)
     max_co_2 = Column(Integer, nullable=False)
-    last_updated = Column(DateTime, nullable=False)
+    last_updated = Column(DateTime, nullable=False, index=True)
 
     def __init__(self, count, temp_buffer, max_temp, min_temp, avg_temp, max_pm2_5, max_co_2, last_updated) -> None:
         self.count = count
@@ -37,3 +37,70 @@ class Stats(Base):
         dict['last_updated'] = self.last_updated.strftime("%Y-%m-%dT%H:%M:%S")
 
         return dict
+
+
+
+class Sketch(Base):
+    __tablename__ = "sketches"
+
+    id_ = Column(Integer, primary_key=True)
+    metric = Column(String(50), nullable=False)
+    location = Column(String(250), nullable=False)
+    bucket = Column(String(100), nullable=False)
+    digest = Column(LargeBinary, nullable=False)
+    last_updated = Column(DateTime, nullable=False)
+
+    def __init__(self, metric, location, bucket, digest, last_updated) -> None:
+        self.metric = metric
+        self.location = location
+        self.bucket = bucket
+        self.digest = digest
+        self.last_updated = last_updated
+
+
+
+class Cursor(Base):
+    __tablename__ = "cursors"
+
+    table_name = Column(String(50), primary_key=True)
+    last_id = Column(Integer, nullable=False)
+
+    def __init__(self, table_name, last_id) -> None:
+        self.table_name = table_name
+        self.last_id = last_id
+
+
+
+class Alert(Base):
+    __tablename__ = "alerts"
+    __table_args__ = (Index('ix_alerts_rule_location', 'rule', 'location', 'id_'),)
+
+    id_ = Column(Integer, primary_key=True)
+    rule = Column(String(100), nullable=False)
+    metric = Column(String(50), nullable=False)
+    location = Column(String(250), nullable=False)
+    state = Column(String(20), nullable=False)
+    value = Column(Float, nullable=False)
+    threshold = Column(Float, nullable=False)
+    timestamp = Column(DateTime, nullable=False)
+
+    def __init__(self, rule, metric, location, state, value, threshold, timestamp) -> None:
+        self.rule = rule
+        self.metric = metric
+        self.location = location
+        self.state = state
+        self.value = value
+        self.threshold = threshold
+        self.timestamp = timestamp
+
+    def to_dict(self):
+        dict = {}
+        dict['rule'] = self.rule
+        dict['metric'] = self.metric
+        dict['location'] = self.location
+        dict['state'] = self.state
+        dict['value'] = self.value
+        dict['threshold'] = self.threshold
+        dict['timestamp'] = self.timestamp
+
+        return dict
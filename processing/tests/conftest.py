@@ -0,0 +1,73 @@
+"""
+Runs the service against SQLite, with storage pages handed to the batch processor
+
+    cd processing
+    python -m pytest tests
+"""
+import os
+import shutil
+import sys
+import time
+import pytest
+import yaml
+
+SERVICE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [SERVICE, os.path.join(os.path.dirname(SERVICE), 'common')]
+
+
+def wait_for(condition, timeout_sec: float = 5):
+    deadline = time.monotonic() + timeout_sec
+    while not condition():
+        if time.monotonic() > deadline:
+            raise TimeoutError("Condition not met")
+        time.sleep(0.01)
+
+
+@pytest.fixture(scope='session')
+def processing(tmp_path_factory):
+    directory = tmp_path_factory.mktemp('processing')
+    with open(os.path.join(SERVICE, 'app_conf.yml'), mode='r') as file:
+        app_config = yaml.safe_load(file.read())
+    # storage is not running, the scheduled jobs are left idle and batches are processed by the tests
+    app_config['eventstore']['url'] = 'http://127.0.0.1:9/storage'
+    app_config['datastore']['filename'] = str(directory / 'stats.sqlite')
+    app_config['scheduler']['period_sec'] = 3600
+    app_config['connection']['timeout'] = 0
+    app_config['stats']['history']['compaction_period_sec'] = 3600
+    app_config['stream']['heartbeat_sec'] = 1
+    app_config['stream']['max_clients'] = 2
+    app_config['tracing']['sample_rate'] = 1.0
+    app_config['http']['leader_lock'] = str(directory / 'processing.leader')
+    with open(directory / 'app_conf.yml', mode='w') as file:
+        yaml.safe_dump(app_config, file)
+    shutil.copy(os.path.join(SERVICE, 'log_conf.yml'), directory)
+
+    # config and log files are read from the working directory on import
+    cwd = os.getcwd()
+    os.environ['TARGET_ENV'] = 'test'
+    os.chdir(directory)
+    try:
+        import app
+    finally:
+        os.chdir(cwd)
+
+    app.start_worker()
+    wait_for(lambda: app.SCHEDULER is not None)
+    return app
+
+
+@pytest.fixture(scope='session')
+def backfill(processing):
+    """The backfill script, reading the same config as the service"""
+    cwd = os.getcwd()
+    os.chdir(os.path.dirname(processing.DATA_URL))
+    try:
+        import backfill
+    finally:
+        os.chdir(cwd)
+    return backfill
+
+
+@pytest.fixture()
+def client(processing):
+    return processing.app.app.test_client()
@@ -0,0 +1,179 @@
+import json
+import uuid
+from datetime import datetime, timedelta
+from threading import Event
+from window import to_minute
+
+
+def temperature_row(id_: int, location: str, temperature: float, created: datetime = None) -> dict:
+    """Temperature row as storage returns it"""
+    return {
+        'id': id_,
+        'date_created': (created or datetime.now()).isoformat() + 'Z',
+        'device_id': str(uuid.uuid4()),
+        'location': location,
+        'temperature': temperature,
+        'timestamp': '2022-11-01T12:00:00Z',
+        'trace_id': str(uuid.uuid4())
+    }
+
+
+def environment_row(id_: int, location: str, pm2_5: int, co_2: int, created: datetime = None) -> dict:
+    """Environment row as storage returns it"""
+    return {
+        'id': id_,
+        'date_created': (created or datetime.now()).isoformat() + 'Z',
+        'device_id': str(uuid.uuid4()),
+        'environment': {'pm2_5': pm2_5, 'co_2': co_2},
+        'location': location,
+        'timestamp': '2022-11-01T12:00:00Z',
+        'trace_id': str(uuid.uuid4())
+    }
+
+
+def test_stats(client):
+    response = client.get('/processing/stats')
+    assert response.status_code == 200
+    assert {'count', 'max_temp', 'min_temp', 'avg_temp', 'max_pm2_5', 'max_co_2'} <= set(response.get_json())
+
+
+def test_stats_not_modified(client):
+    etag = client.get('/processing/stats').headers['ETag']
+    response = client.get('/processing/stats', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+
+
+def test_stats_stream_sends_the_snapshot_first(client):
+    response = client.get('/processing/stats/stream', buffered=False)
+    try:
+        assert response.status_code == 200
+        assert response.mimetype == 'text/event-stream'
+        frames = iter(response.response)
+        assert next(frames).startswith(b'retry: ')
+        frame = next(frames).decode('utf-8')
+        fields = dict(line.split(': ', 1) for line in frame.strip().splitlines())
+        assert fields['event'] == 'stats'
+        assert json.loads(fields['data']) == client.get('/processing/stats').get_json()
+    finally:
+        response.close()
+
+
+def test_stats_stream_turns_away_clients_past_the_limit(client, processing):
+    streams = [client.get('/processing/stats/stream', buffered=False) for _ in range(processing.STATS_FEED.max_clients)]
+    try:
+        assert all(response.status_code == 200 for response in streams)
+        response = client.get('/processing/stats/stream', buffered=False)
+        assert response.status_code == 503
+    finally:
+        for response in streams:
+            response.close()
+    response = client.get('/processing/stats/stream', buffered=False)
+    assert response.status_code == 200
+    response.close()
+
+
+def test_window_stats(client, processing, monkeypatch):
+    rolling = processing.RollingStats('1h')
+    monkeypatch.setitem(processing.ROLLING_STATS, '1h', rolling)
+    now = datetime.now()
+    earlier = now - timedelta(minutes=90)
+    processing.update_windows(
+        [temperature_row(1, 'facility_1A_office', 30.0, created=earlier)],
+        [environment_row(1, 'facility_1A_office', 50, 1200, created=earlier)],
+        earlier
+    )
+    processing.update_windows(
+        [
+            temperature_row(2, 'facility_1A_office', 21.5, created=now - timedelta(minutes=1)),
+            temperature_row(3, 'facility_1A_office', 23.0, created=now),
+            temperature_row(4, 'facility_1A_office', 22.0, created=now)
+        ],
+        [environment_row(2, 'facility_1A_office', 12, 410, created=now)],
+        now
+    )
+    response = client.get('/processing/stats', query_string={'window': '1h'})
+    assert response.status_code == 200
+    stats = response.get_json()
+    # the readings from 90 minutes ago have expired
+    assert stats['window'] == '1h'
+    assert stats['count'] == 3
+    assert stats['max_temp'] == 23.0
+    assert stats['min_temp'] == 21.5
+    assert stats['avg_temp'] == 22.17
+    assert stats['max_pm2_5'] == 12
+    assert stats['max_co_2'] == 410
+    # readings in the same minute are merged into one max and one min entry
+    assert list(rolling.temp.max_queue) == [(to_minute(now), 23.0)]
+    assert len(rolling.temp.min_queue) == 2
+
+
+def test_unknown_window(client):
+    response = client.get('/processing/stats', query_string={'window': '1y'})
+    assert response.status_code == 400
+
+
+def test_loading_saved_sketches_does_not_count_readings_twice(processing):
+    processing.update_sketches([temperature_row(201, 'facility_1A_office', 19.0)], [], datetime.now())
+    key = ('temperature', '*', 'all')
+    total = processing.SKETCHES.digests[key].total
+    processing.load_sketches()
+    assert processing.SKETCHES.digests[key].total == total
+
+
+def test_environment_counted_before_cursors_is_skipped(processing, monkeypatch):
+    monkeypatch.setattr(processing, 'COUNTED_BEFORE', None)
+    updated = datetime.now().replace(microsecond=0) - timedelta(hours=1)
+    session = processing.DB_SESSION()
+    session.query(processing.Cursor).delete()
+    session.commit()
+    session.close()
+    # stats saved by a version without cursors
+    stats = dict(processing.query_db(), count=5, max_pm2_5=10, last_updated=updated.strftime(processing.DATETIME_FORMAT))
+    processing.update_snapshot(stats)
+    processing.load_cursors()
+    assert processing.CURSORS['temperature'] == 5
+
+    processing.process_batch([], [
+        environment_row(101, 'facility_1A_office', 900, 400, created=updated - timedelta(minutes=10)),
+        environment_row(102, 'facility_1A_office', 20, 400)
+    ])
+    assert processing.SNAPSHOT[0]['max_pm2_5'] == 20
+    assert processing.CURSORS['environment'] == 102
+
+
+def test_followers_report_the_leaders_job_runs(client, processing, monkeypatch):
+    processing.timed('populate_stats')(lambda: None)()
+    duration = processing.JOB_RUNS['populate_stats'][0]
+
+    # a worker that has not been elected, and has run no jobs
+    monkeypatch.setattr(processing.LEADER, 'elected', Event())
+    monkeypatch.setattr(processing, 'JOB_RUNS', dict())
+    response = client.get('/processing/health/detail')
+    assert response.status_code == 200
+    signals = response.get_json()['signals']
+    assert signals['job_duration_sec'] == duration
+    assert 0 <= signals['job_age_sec'] < 5
+
+
+def test_only_the_latest_transitions_are_restored_and_kept(processing):
+    old, recent = datetime.now() - timedelta(days=60), datetime.now()
+    session = processing.DB_SESSION()
+    session.query(processing.Alert).delete()
+    for rule, location, state, timestamp in [
+            ('co_2_high', 'lab', processing.FIRING, old), ('co_2_high', 'lab', 'resolved', old),
+            ('pm2_5_high', 'office', processing.FIRING, old),
+            ('co_2_high', 'lab', processing.FIRING, recent)]:
+        session.add(processing.Alert(rule, 'co_2', location, state, 1200, 1000, timestamp))
+    session.commit()
+    session.close()
+
+    assert sorted((alert['rule'], alert['location']) for alert in processing.firing_alerts()) == [
+        ('co_2_high', 'lab'), ('pm2_5_high', 'office')]
+    # the old transitions of the lab are superseded, the office alert is still firing
+    processing.compact_db()
+    session = processing.DB_SESSION()
+    kept = [(alert.rule, alert.location, alert.state) for alert in session.query(processing.Alert).order_by(processing.Alert.id_)]
+    session.query(processing.Alert).delete()
+    session.commit()
+    session.close()
+    assert kept == [('pm2_5_high', 'office', processing.FIRING), ('co_2_high', 'lab', processing.FIRING)]
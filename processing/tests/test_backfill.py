@@ -0,0 +1,124 @@
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from data import Base
+from sketch import TDigest, ALL_LOCATIONS, ALL_TIME
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from stats import Stats, Sketch, Cursor
+
+TEMPERATURE = [
+    {'id': 1, 'location': 'lab', 'temperature': 20.0, 'date_created': '2023-01-01T06:00:00Z'},
+    {'id': 2, 'location': 'lab', 'temperature': 22.0, 'date_created': '2023-01-01T18:00:00Z'},
+    {'id': 3, 'location': 'lab', 'temperature': 25.0, 'date_created': '2023-01-02T06:00:00Z'}
+]
+ENVIRONMENT = [
+    {'id': 1, 'location': 'lab', 'environment': {'pm2_5': 10, 'co_2': 500}, 'date_created': '2023-01-01T06:00:00Z'},
+    {'id': 2, 'location': 'lab', 'environment': {'pm2_5': 40, 'co_2': 900}, 'date_created': '2023-01-02T06:00:00Z'}
+]
+CHUNKS = [('2023-01-01T00:00:00Z', '2023-01-02T00:00:00Z'), ('2023-01-02T00:00:00Z', '2023-01-03T00:00:00Z')]
+
+
+def stub_storage(backfill, monkeypatch) -> list:
+    """Serves the rows of a chunk as one page, and records the chunks fetched"""
+    fetched = list()
+    def fetch_chunk(session, table: str, start: str, end: str):
+        fetched.append((table, start, end))
+        rows = TEMPERATURE if table == 'temperature' else ENVIRONMENT
+        yield [row for row in rows if start <= row['date_created'] < end]
+    monkeypatch.setattr(backfill, 'fetch_chunk', fetch_chunk)
+    return fetched
+
+
+def stats_session(database: str):
+    engine = create_engine(f"sqlite:///{database}")
+    Base.metadata.create_all(engine)
+    return sessionmaker(bind=engine)()
+
+
+def stats_rows(session) -> list:
+    return [(row.count, row.max_temp, row.min_temp, row.avg_temp, row.max_pm2_5, row.max_co_2, row.last_updated)
+        for row in session.query(Stats).order_by(Stats.last_updated)]
+
+
+def test_chunks_are_merged_into_cumulative_rows(backfill, monkeypatch, tmp_path):
+    stub_storage(backfill, monkeypatch)
+    partials = [backfill.aggregate_chunk(index, start, end) for index, (start, end) in enumerate(CHUNKS)]
+    session = stats_session(tmp_path / 'stats.sqlite')
+
+    backfill.merge_chunks(partials, session)
+    assert stats_rows(session) == [
+        (2, 22.0, 20.0, 21.0, 10, 500, datetime(2023, 1, 2)),
+        (3, 25.0, 20.0, 22.33, 40, 900, datetime(2023, 1, 3))
+    ]
+    assert {cursor.table_name: cursor.last_id for cursor in session.query(Cursor)} == {'temperature': 3, 'environment': 2}
+    # the digests of both chunks are merged into one per key
+    sketches = {(sketch.metric, sketch.bucket): TDigest.from_bytes(sketch.digest)
+        for sketch in session.query(Sketch).filter_by(location=ALL_LOCATIONS)}
+    assert len(sketches[('temperature', ALL_TIME)]) == 3
+    assert sketches[('temperature', ALL_TIME)].max == 25.0
+    assert len(sketches[('temperature', '2023-01-01T06:00:00Z')]) == 1
+    assert len(sketches[('co_2', ALL_TIME)]) == 2
+    session.close()
+
+
+def test_chunks_continue_from_the_row_before_the_range(backfill, monkeypatch, tmp_path):
+    stub_storage(backfill, monkeypatch)
+    session = stats_session(tmp_path / 'stats.sqlite')
+    session.add(Stats(count=10, temp_buffer=300.0, max_temp=35.0, min_temp=15.0, avg_temp=30.0,
+        max_pm2_5=5, max_co_2=450, last_updated=datetime(2023, 1, 1)))
+    # replaced, it was computed from the old history
+    session.add(Stats(count=1, temp_buffer=1.0, max_temp=1.0, min_temp=1.0, avg_temp=1.0,
+        max_pm2_5=1, max_co_2=1, last_updated=datetime(2023, 1, 2, 12)))
+    session.commit()
+
+    backfill.merge_chunks([backfill.aggregate_chunk(1, *CHUNKS[1])], session)
+    assert stats_rows(session) == [
+        (10, 35.0, 15.0, 30.0, 5, 450, datetime(2023, 1, 1)),
+        (11, 35.0, 15.0, 29.55, 40, 900, datetime(2023, 1, 3))
+    ]
+    # the all-time digests only cover this chunk, so they are not written
+    assert session.query(Sketch).filter_by(bucket=ALL_TIME).count() == 0
+    session.close()
+
+
+def test_all_time_sketches_are_kept_when_rows_follow_the_range(backfill, monkeypatch, tmp_path):
+    stub_storage(backfill, monkeypatch)
+    session = stats_session(tmp_path / 'stats.sqlite')
+    # live processing has already run past the range
+    session.add(Stats(count=50, temp_buffer=1000.0, max_temp=30.0, min_temp=10.0, avg_temp=20.0,
+        max_pm2_5=20, max_co_2=800, last_updated=datetime(2023, 1, 5)))
+    digest = TDigest()
+    for value in range(50):
+        digest.add(value)
+    session.add(Sketch('temperature', ALL_LOCATIONS, ALL_TIME, digest.to_bytes(), datetime(2023, 1, 5)))
+    session.commit()
+
+    backfill.merge_chunks([backfill.aggregate_chunk(0, *CHUNKS[0])], session)
+    kept = session.query(Sketch).filter_by(metric='temperature', location=ALL_LOCATIONS, bucket=ALL_TIME).one()
+    assert len(TDigest.from_bytes(kept.digest)) == 50
+    assert kept.last_updated == datetime(2023, 1, 5)
+    # hourly buckets of the range are still written
+    assert session.query(Sketch).filter_by(bucket='2023-01-01T06:00:00Z').count() > 0
+    session.close()
+
+
+def test_interrupted_backfill_resumes_after_the_completed_chunks(backfill, monkeypatch, tmp_path):
+    fetched = stub_storage(backfill, monkeypatch)
+    database, progress = tmp_path / 'stats.sqlite', tmp_path / 'stats.sqlite.backfill'
+    stats_session(database).close()
+    monkeypatch.setattr(backfill, 'DATA_URL', str(database))
+    # chunks are aggregated in this process, so the stub serves them
+    monkeypatch.setattr(backfill, 'ProcessPoolExecutor', ThreadPoolExecutor)
+    # the first day was done when the backfill stopped
+    backfill.save_progress(progress, backfill.aggregate_chunk(0, *CHUNKS[0]))
+    fetched.clear()
+
+    monkeypatch.setattr(sys, 'argv', ['backfill.py', '--start', '2023-01-01', '--end', '2023-01-03',
+        '--chunk', '1d', '--workers', '1', '--progress', str(progress)])
+    backfill.main()
+    assert fetched == [('temperature', *CHUNKS[1]), ('environment', *CHUNKS[1])]
+    session = stats_session(database)
+    assert [row[0] for row in stats_rows(session)] == [2, 3]
+    session.close()
+    assert not progress.exists()
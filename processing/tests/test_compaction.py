@@ -0,0 +1,42 @@
+from datetime import datetime, timedelta
+from data import Base
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from stats import Stats
+
+
+def stats_row(count: int, last_updated: datetime) -> Stats:
+    return Stats(count=count, temp_buffer=20.0 * count, max_temp=25.0, min_temp=15.0, avg_temp=20.0,
+        max_pm2_5=10, max_co_2=500, last_updated=last_updated)
+
+
+def test_compaction_keeps_the_newest_row_per_minute_then_per_hour(processing, monkeypatch, tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'stats.sqlite'}")
+    Base.metadata.create_all(engine)
+    monkeypatch.setattr(processing, 'DB_SESSION', sessionmaker(bind=engine))
+    retention = timedelta(hours=processing.HISTORY['minute_retention_hours'])
+    now = datetime.now()
+    old_hour = (now - retention - timedelta(hours=3)).replace(minute=0, second=0, microsecond=0)
+    recent_minute = (now - timedelta(minutes=10)).replace(second=0, microsecond=0)
+    # ids follow the order rows are written in, as they are by populate_stats()
+    seeded = [
+        stats_row(1, old_hour + timedelta(minutes=5)),
+        stats_row(2, old_hour + timedelta(minutes=20)),
+        stats_row(3, old_hour + timedelta(minutes=40, seconds=30)),
+        stats_row(4, old_hour + timedelta(hours=1, minutes=15)),
+        stats_row(5, recent_minute + timedelta(seconds=10)),
+        stats_row(6, recent_minute + timedelta(seconds=30, microseconds=500)),
+        stats_row(7, recent_minute + timedelta(minutes=1, seconds=5)),
+        stats_row(8, recent_minute + timedelta(minutes=1, seconds=50))
+    ]
+    session = processing.DB_SESSION()
+    session.add_all(seeded)
+    session.commit()
+    session.close()
+
+    processing.compact_db()
+    session = processing.DB_SESSION()
+    kept = [row.count for row in session.query(Stats).order_by(Stats.id_)]
+    session.close()
+    # the last row of each hour before the cutoff and of each minute after it
+    assert kept == [3, 4, 6, 8]
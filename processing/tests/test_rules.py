@@ -0,0 +1,80 @@
+from datetime import datetime, timedelta
+from rules import Rule, RuleEngine, FIRING, RESOLVED
+
+START = datetime(2022, 11, 1, 12, 0, 0)
+
+
+def environment(location: str, pm2_5: int, co_2: int, seconds: int) -> dict:
+    created = START + timedelta(seconds=seconds)
+    return {'location': location, 'environment': {'pm2_5': pm2_5, 'co_2': co_2}, 'date_created': created.isoformat() + 'Z'}
+
+
+def test_rule_fires_once_the_breach_lasts_its_duration():
+    engine = RuleEngine([Rule('pm2_5_high', 'pm2_5', '>', 35, duration_sec=300)])
+    assert engine.evaluate([], [environment('lab', 40, 400, 0), environment('lab', 50, 400, 299)], START) == []
+
+    transitions = engine.evaluate([], [environment('lab', 45, 400, 300)], START)
+    assert transitions == [{
+        'rule': 'pm2_5_high',
+        'metric': 'pm2_5',
+        'location': 'lab',
+        'state': FIRING,
+        'value': 45,
+        'threshold': 35,
+        'timestamp': START + timedelta(seconds=300)
+    }]
+    # still breaching, it does not fire again
+    assert engine.evaluate([], [environment('lab', 60, 400, 360)], START) == []
+    assert engine.active() == transitions
+
+
+def test_rule_resolves_on_the_first_clear_reading():
+    engine = RuleEngine([Rule('co_2_high', 'co_2', '>=', 1000)])
+    assert [alert['state'] for alert in engine.evaluate([], [environment('lab', 10, 1000, 0)], START)] == [FIRING]
+
+    transitions = engine.evaluate([], [environment('lab', 10, 999, 10), environment('lab', 10, 1200, 20)], START)
+    assert [(alert['state'], alert['value']) for alert in transitions] == [(RESOLVED, 999), (FIRING, 1200)]
+
+
+def test_a_clear_reading_restarts_the_duration():
+    engine = RuleEngine([Rule('pm2_5_high', 'pm2_5', '>', 35, duration_sec=300)])
+    readings = [environment('lab', 40, 400, 0), environment('lab', 20, 400, 200), environment('lab', 40, 400, 400)]
+    assert engine.evaluate([], readings, START) == []
+    assert engine.evaluate([], [environment('lab', 40, 400, 700)], START)[0]['state'] == FIRING
+
+
+def test_rules_are_indexed_by_location_and_metric():
+    scoped = Rule('lab_hot', 'temperature', '>', 25, scope='lab')
+    everywhere = Rule('hot', 'temperature', '>', 30)
+    co_2 = Rule('co_2_high', 'co_2', '>=', 1000)
+    engine = RuleEngine([scoped, everywhere, co_2])
+    assert engine.index == {('lab', 'temperature'): [scoped], ('*', 'temperature'): [everywhere], ('*', 'co_2'): [co_2]}
+    assert engine._match('lab', 'temperature') == [scoped, everywhere]
+    assert engine._match('office', 'temperature') == [everywhere]
+    assert engine._match('lab', 'pm2_5') == []
+
+    readings = [
+        {'location': 'lab', 'temperature': 28, 'date_created': START.isoformat() + 'Z'},
+        {'location': 'office', 'temperature': 28, 'date_created': START.isoformat() + 'Z'}
+    ]
+    transitions = engine.evaluate(readings, [], START)
+    assert [(alert['rule'], alert['location']) for alert in transitions] == [('lab_hot', 'lab')]
+
+
+def test_each_location_is_tracked_separately():
+    engine = RuleEngine([Rule('co_2_high', 'co_2', '>=', 1000)])
+    engine.evaluate([], [environment('lab', 10, 1100, 0), environment('office', 10, 1100, 0)], START)
+    transitions = engine.evaluate([], [environment('lab', 10, 500, 10)], START)
+    assert [(alert['location'], alert['state']) for alert in transitions] == [('lab', RESOLVED)]
+    assert [alert['location'] for alert in engine.active()] == ['office']
+
+
+def test_restored_alerts_resolve_without_firing_again():
+    engine = RuleEngine([Rule('co_2_high', 'co_2', '>=', 1000)])
+    engine.evaluate([], [environment('lab', 10, 1100, 0)], START)
+    saved = engine.active()
+
+    follower = RuleEngine([Rule('co_2_high', 'co_2', '>=', 1000)])
+    follower.restore(saved, replace=True)
+    assert follower.evaluate([], [environment('lab', 10, 1200, 10)], START) == []
+    assert [alert['state'] for alert in follower.evaluate([], [environment('lab', 10, 900, 20)], START)] == [RESOLVED]
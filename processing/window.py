@@ -0,0 +1,155 @@
+"""
+Rolling window statistics
+
+Maintains sliding max/min/avg over the last N minutes of telemetry.
+Readings are folded into per-minute buckets so memory is bounded by
+the window length, not by the number of readings.
+"""
+from collections import deque
+from datetime import datetime
+from operator import gt, lt
+from threading import Lock
+
+DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+UNITS = {'m': 1, 'h': 60, 'd': 1440}
+
+
+def parse_window(label: str) -> int:
+    """Converts a window label (eg. 30m, 1h, 7d) to minutes"""
+    try:
+        size = int(label[:-1]) * UNITS[label[-1]]
+    except (KeyError, ValueError, IndexError):
+        raise ValueError(f"Invalid window: {label}")
+    if size <= 0:
+        raise ValueError(f"Invalid window: {label}")
+
+    return size
+
+def to_minute(value: datetime) -> int:
+    return int(value.timestamp() // 60)
+
+
+class SlidingMetric:
+    """Sliding sum, count, max and min of one metric over per-minute buckets"""
+    def __init__(self, minutes: int) -> None:
+        self.minutes = minutes
+        self.buckets = deque()  # [minute, count, total]
+        self.max_queue = deque()  # (minute, value), values decreasing
+        self.min_queue = deque()  # (minute, value), values increasing
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, minute: int, value: float) -> None:
+        # late readings are folded into the newest bucket
+        if self.buckets and minute < self.buckets[-1][0]:
+            minute = self.buckets[-1][0]
+        if self.buckets and self.buckets[-1][0] == minute:
+            self.buckets[-1][1] += 1
+            self.buckets[-1][2] += value
+        else:
+            self.buckets.append([minute, 1, value])
+        self.count += 1
+        self.total += value
+
+        push(self.max_queue, minute, value, gt)
+        push(self.min_queue, minute, value, lt)
+
+    def expire(self, minute: int) -> None:
+        cutoff = minute - self.minutes
+        while self.buckets and self.buckets[0][0] <= cutoff:
+            _, count, total = self.buckets.popleft()
+            self.count -= count
+            self.total -= total
+        while self.max_queue and self.max_queue[0][0] <= cutoff:
+            self.max_queue.popleft()
+        while self.min_queue and self.min_queue[0][0] <= cutoff:
+            self.min_queue.popleft()
+        if not self.buckets:
+            self.count = 0
+            self.total = 0.0
+
+    @property
+    def max(self):
+        return self.max_queue[0][1] if self.max_queue else None
+
+    @property
+    def min(self):
+        return self.min_queue[0][1] if self.min_queue else None
+
+    @property
+    def avg(self):
+        return round(self.total / self.count, 2) if self.count else None
+
+
+def push(queue: deque, minute: int, value: float, better) -> None:
+    """Adds a value to a monotonic queue, keeping one entry per minute so it is bounded by the window length"""
+    if queue and queue[-1][0] == minute:
+        if not better(value, queue[-1][1]):
+            return
+        queue.pop()
+    while queue and not better(queue[-1][1], value):
+        queue.pop()
+    queue.append((minute, value))
+
+
+class RollingStats:
+    """Temperature and environment stats over one rolling window"""
+    def __init__(self, label: str) -> None:
+        self.label = label
+        self.minutes = parse_window(label)
+        self.temp = SlidingMetric(self.minutes)
+        self.pm2_5 = SlidingMetric(self.minutes)
+        self.co_2 = SlidingMetric(self.minutes)
+        self.last_updated = datetime.now()
+        # highest storage row id seen per table, so overlapping pulls are not counted twice
+        self.temp_id = 0
+        self.env_id = 0
+        self.lock = Lock()
+
+    def update(self, temp_packets: list, env_packets: list, timestamp: datetime) -> None:
+        with self.lock:
+            for packet in temp_packets:
+                if packet['id'] <= self.temp_id:
+                    continue
+                self.temp_id = packet['id']
+                minute = to_minute(packet_time(packet, timestamp))
+                self.temp.add(minute, float(packet['temperature']))
+            for packet in env_packets:
+                if packet['id'] <= self.env_id:
+                    continue
+                self.env_id = packet['id']
+                minute = to_minute(packet_time(packet, timestamp))
+                self.pm2_5.add(minute, packet['environment']['pm2_5'])
+                self.co_2.add(minute, packet['environment']['co_2'])
+            self.expire(timestamp)
+            self.last_updated = timestamp
+
+    def expire(self, timestamp: datetime) -> None:
+        minute = to_minute(timestamp)
+        for metric in (self.temp, self.pm2_5, self.co_2):
+            metric.expire(minute)
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            self.expire(datetime.now())
+            return {
+                'window': self.label,
+                'count': self.temp.count,
+                'max_temp': self.temp.max,
+                'min_temp': self.temp.min,
+                'avg_temp': self.temp.avg,
+                'max_pm2_5': self.pm2_5.max,
+                'max_co_2': self.co_2.max,
+                'last_updated': self.last_updated.strftime(DATETIME_FORMAT)
+            }
+
+
+def packet_time(packet: dict, default: datetime) -> datetime:
+    """Creation time of a storage row, falls back to the batch timestamp"""
+    value = packet.get('date_created')
+    if isinstance(value, datetime):
+        return value
+    try:
+        return datetime.fromisoformat(str(value).rstrip('Z'))
+    except ValueError:
+        return default
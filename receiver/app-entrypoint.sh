@@ -1,8 +1,5 @@
 #!/bin/bash
 set -e
-# wait for the server to be up
-if [ -n "$SERVER_HOST" ]; then
-    /usr/bin/wait-for-it "$SERVER_HOST:${SERVER_PORT:-9092}" -t 60
-fi
+# the broker connection is retried by the service, /ready reports when it is up
 # run the main container command
 exec "$@"
\ No newline at end of file
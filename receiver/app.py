@@ -9,18 +9,22 @@ Environment configuration
 SERVER_HOST (string):   URL of message broker service
 SERVER_PORT (integer):  port for message broker service
 DATA_TOPIC (string):    topic group assigned to data
+TRANSPORT (dict):       kafka, memory (in-process) or file (shared directory) message transport, and Kafka reconnect backoff
 """
 import connexion
 import logging
-import logging.config
+import logs
 import json
 import time
+import spec
 import yaml
 from connexion import NoContent
 from datetime import datetime
+from flask import Response
+from metrics import Registry
 from os import environ
-from pykafka import KafkaClient
-from pykafka.exceptions import SocketDisconnectedError, LeaderNotAvailable, KafkaException
+from threading import Lock
+from transport import TransportError, create_transport
 
 # Constants
 DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
@@ -38,7 +42,7 @@ else:
 # Logging config
 with open(log_conf_file, mode='r') as file:
     log_config = yaml.safe_load(file.read())
-    logging.config.dictConfig(log_config)
+    logs.configure(log_config)
 
 logger = logging.getLogger('receiver')
 
@@ -50,6 +54,14 @@ SERVER_HOST = app_config['server']['host']
 SERVER_PORT = app_config['server']['port']
 DATA_TOPIC = app_config['events']['topic']
 
+IN_FLIGHT = 0  # produce calls waiting on the broker
+IN_FLIGHT_LOCK = Lock()
+
+METRICS = Registry('receiver')
+METRICS.add(logs.DROPPED)
+PRODUCED = METRICS.counter('messages_produced_total', "Readings forwarded to the broker", ('type',))
+PRODUCE_SECONDS = METRICS.histogram('produce_seconds', "Time to produce a reading to the broker", ('type',))
+
 # Endpoints
 def root():
     logger.info("Received connection request from device")
@@ -59,6 +71,19 @@ def root():
 def health():
     return {"message": "OK"}, 200
 
+def ready():
+    checks = {"broker": TRANSPORT.ready}
+    if not all(checks.values()):
+        return {"message": "Not ready", "checks": checks}, 503
+    return {"message": "OK", "checks": checks}, 200
+
+def get_metrics():
+    return Response(METRICS.exposition(), mimetype='text/plain')
+
+def health_detail():
+    # produce calls are synchronous, so the queue is the requests waiting on the broker
+    return {"message": "OK", "signals": {"producer_queue": IN_FLIGHT}}, 200
+
 def temperature(body):
     location = body['location']
     trace = body['trace_id']
@@ -66,21 +91,18 @@ def temperature(body):
     msg = {
         'type': 'temperature', 
         'datetime': datetime.now().strftime(DATETIME_FORMAT), 
+        'ingest_ns': time.time_ns(), 
         'payload': body
     }
     msg_str = json.dumps(msg)
     
-    producer = topic.get_sync_producer()
     try:
-        producer.produce(msg_str.encode('utf-8'))
-    except (SocketDisconnectedError, LeaderNotAvailable) as e:
-        logger.warning(f"Restarting producer - ERROR: {e}")
-        producer = topic.get_sync_producer()
-        producer.stop()
-        producer.start()
-        producer.produce(msg_str.encode('utf-8'))
-
-    logger.info(f"Received temperature telemetry from device at {location} -- trace ID: {trace}")
+        send('temperature', msg_str)
+    except TransportError as e:
+        logger.warning("Broker unavailable, temperature telemetry from device at %s rejected -- trace ID: %s - %s", location, trace, e)
+        return {"message": "Broker unavailable"}, 503, {'Retry-After': '1'}
+
+    logger.info("Received temperature telemetry from device at %s -- trace ID: %s", location, trace)
     
     return NoContent, 201
 
@@ -92,51 +114,41 @@ def environment(body):
     msg = {
         'type': 'environment', 
         'datetime': datetime.now().strftime(DATETIME_FORMAT), 
+        'ingest_ns': time.time_ns(), 
         'payload': body
     }
     msg_str = json.dumps(msg)
 
-    producer = topic.get_sync_producer()
     try:
-        producer.produce(msg_str.encode('utf-8'))
-    except (SocketDisconnectedError, LeaderNotAvailable) as e:
-        logger.warning(f"Restarting producer - ERROR: {e}")
-        producer = topic.get_sync_producer()
-        producer.stop()
-        producer.start()
-        producer.produce(msg_str.encode('utf-8'))
-
-    logger.info(f"Received environment telemetry from device at {location} -- trace ID: {trace}")
+        send('environment', msg_str)
+    except TransportError as e:
+        logger.warning("Broker unavailable, environment telemetry from device at %s rejected -- trace ID: %s - %s", location, trace, e)
+        return {"message": "Broker unavailable"}, 503, {'Retry-After': '1'}
+
+    logger.info("Received environment telemetry from device at %s -- trace ID: %s", location, trace)
     
     return NoContent, 201
 
-# connect to kafka server
-def create_kafka_connection(max_retries: int, timeout: int):
-    count = 0
-    while count < max_retries:
-        try:
-            client = KafkaClient(hosts=f'{SERVER_HOST}:{SERVER_PORT}')
-            topic = client.topics[str.encode(DATA_TOPIC)]
-            logger.info(f"Client connected to Kafka server")
-
-            return topic
-
-        except KafkaException as e:
-            logger.error(f"Connection failed - {e} - Retries: ({count})")
-            time.sleep(timeout)
-            count += 1
-            continue
-
-    else:
-        logger.error(f"Connection failed - Unable to connect to kafka server. Max retries exceeded ({max_retries})")
-        raise SystemExit(1)
-
-topic = create_kafka_connection(max_retries=3, timeout=2)
+def send(msg_type: str, msg_str: str) -> None:
+    global IN_FLIGHT
+    with IN_FLIGHT_LOCK:
+        IN_FLIGHT += 1
+    try:
+        with PRODUCE_SECONDS.time(msg_type):
+            TRANSPORT.produce(msg_str.encode('utf-8'))
+        PRODUCED.inc(msg_type)
+    finally:
+        with IN_FLIGHT_LOCK:
+            IN_FLIGHT -= 1
+
+TRANSPORT = create_transport(app_config['transport'], app_config['server'], DATA_TOPIC)
 app = connexion.FlaskApp(__name__, specification_dir='openapi/')
-app.add_api('openapi.yml', base_path='/receiver', strict_validation=True, validate_responses=True)
+spec.add_api(app, 'openapi.yml', base_path='/receiver', strict_validation=True, validate_responses=True)
+METRICS.instrument(app.app)
 
 
 def main() -> None:
+    TRANSPORT.connect()
     app.run(port=8080, debug=False)
 
 
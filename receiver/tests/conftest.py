@@ -0,0 +1,42 @@
+"""
+Runs the service against the in-process message transport
+
+    cd receiver
+    python -m pytest tests
+"""
+import os
+import shutil
+import sys
+import pytest
+import yaml
+
+SERVICE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [SERVICE, os.path.join(os.path.dirname(SERVICE), 'common')]
+
+
+@pytest.fixture(scope='session')
+def receiver(tmp_path_factory):
+    directory = tmp_path_factory.mktemp('receiver')
+    with open(os.path.join(SERVICE, 'app_conf.yml'), mode='r') as file:
+        app_config = yaml.safe_load(file.read())
+    app_config['transport'] = {'type': 'memory'}
+    with open(directory / 'app_conf.yml', mode='w') as file:
+        yaml.safe_dump(app_config, file)
+    shutil.copy(os.path.join(SERVICE, 'log_conf.yml'), directory)
+
+    # config and log files are read from the working directory on import
+    cwd = os.getcwd()
+    os.environ['TARGET_ENV'] = 'test'
+    os.chdir(directory)
+    try:
+        import app
+    finally:
+        os.chdir(cwd)
+
+    app.TRANSPORT.connect()
+    return app
+
+
+@pytest.fixture()
+def client(receiver):
+    return receiver.app.app.test_client()
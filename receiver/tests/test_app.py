@@ -0,0 +1,82 @@
+import json
+import uuid
+from transport import TransportError
+
+
+def temperature_reading(**fields) -> dict:
+    reading = {
+        'trace_id': str(uuid.uuid4()),
+        'device_id': str(uuid.uuid4()),
+        'location': 'facility_1A_office',
+        'timestamp': '2022-12-31 12:34:56.000000',
+        'temperature': 21.7
+    }
+    reading.update(fields)
+    return reading
+
+
+def environment_reading(**fields) -> dict:
+    reading = {
+        'trace_id': str(uuid.uuid4()),
+        'device_id': str(uuid.uuid4()),
+        'location': 'facility_1A_office',
+        'timestamp': '2022-12-31 12:34:56.000000',
+        'environment': {'pm2_5': 12, 'co_2': 410}
+    }
+    reading.update(fields)
+    return reading
+
+
+def produced(receiver) -> dict:
+    return json.loads(receiver.TRANSPORT.log[-1])
+
+
+def test_temperature_is_forwarded(receiver, client):
+    reading = temperature_reading()
+    response = client.post('/receiver/temperature', json=reading)
+    assert response.status_code == 201
+    msg = produced(receiver)
+    assert msg['type'] == 'temperature'
+    assert msg['payload'] == reading
+    assert isinstance(msg['ingest_ns'], int)
+
+
+def test_environment_is_forwarded(receiver, client):
+    reading = environment_reading()
+    response = client.post('/receiver/environment', json=reading)
+    assert response.status_code == 201
+    msg = produced(receiver)
+    assert msg['type'] == 'environment'
+    assert msg['payload'] == reading
+
+
+def test_invalid_reading_is_rejected(receiver, client):
+    produced_before = len(receiver.TRANSPORT.log)
+    reading = temperature_reading()
+    del reading['temperature']
+    response = client.post('/receiver/temperature', json=reading)
+    assert response.status_code == 400
+    assert len(receiver.TRANSPORT.log) == produced_before
+
+
+def test_broker_unavailable(receiver, client, monkeypatch):
+    def produce(value: bytes) -> None:
+        raise TransportError("broker down")
+    monkeypatch.setattr(receiver.TRANSPORT, 'produce', produce)
+    response = client.post('/receiver/environment', json=environment_reading())
+    assert response.status_code == 503
+    assert response.get_json() == {"message": "Broker unavailable"}
+    assert response.headers['Retry-After'] == '1'
+
+
+def test_produced_metric(client):
+    client.post('/receiver/temperature', json=temperature_reading())
+    response = client.get('/receiver/metrics')
+    assert response.status_code == 200
+    assert 'receiver_messages_produced_total{type="temperature"}' in response.get_data(as_text=True)
+
+
+def test_ready(client):
+    response = client.get('/receiver/ready')
+    assert response.status_code == 200
+    assert response.get_json()['checks'] == {"broker": True}
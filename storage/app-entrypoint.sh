@@ -1,12 +1,5 @@
 #!/bin/bash
 set -e
-# wait for the database to be up
-if [ -n "$DB_HOST" ]; then
-    /usr/bin/wait-for-it "$DB_HOST:${DB_PORT:-3306}" -t 60
-fi
-# wait for the server to be up
-if [ -n "$SERVER_HOST" ]; then
-    /usr/bin/wait-for-it "$SERVER_HOST:${SERVER_PORT:-9092}" -t 60
-fi
+# broker and database connections are retried by the service, /ready reports when they are up
 # run the main container command
 exec "$@"
\ No newline at end of file
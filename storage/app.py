@@ -9,28 +9,40 @@ Environment configuration
 SERVER_HOST (string):   URL of message broker service
 SERVER_PORT (integer):  port for message broker service
 DATA_TOPIC (string):    topic group assigned to data
+TRANSPORT (dict):       kafka, memory (in-process) or file (shared directory) message transport, and Kafka reconnect backoff
+TRACING (dict):         fraction of readings traced by stage, and how long their stamps are kept
+HTTP (dict):            gunicorn workers and threads, and the lock file electing the consumer worker
+COMPRESSION (dict):     smallest response compressed, and gzip and zstd levels
 """
 import connexion
+import encoding
 import logging
-import logging.config
+import logs
 import json
 import time
+import spec
 import yaml
 from connexion import NoContent
-from data.base import Base, connect, create_temp, create_envr
-from data.readings import Temperature, Environment
+from data.base import Base, connect, create_temp, create_envr, create_trace, create_trace_index
+from data.readings import Temperature, Environment, Trace
 from datetime import datetime
+from flask import Response
+from leader import Leader, load_state, save_state
+from metrics import Registry
 from os import environ
-from pykafka import KafkaClient
-from pykafka.common import OffsetType
-from pykafka.exceptions import KafkaException, SocketDisconnectedError
-from sqlalchemy import and_
+from sqlalchemy import and_, text
+from sqlalchemy.exc import OperationalError, SQLAlchemyError
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
-from threading import Thread
+from threading import Event, Thread
+from tracing import TraceStore, INGEST, CONSUMED, COMMITTED, PIPELINE_BUCKETS, now_ns
+from transport import TransportError, create_transport
 
 # Constants
 DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+PAGE_LIMIT = 1000
+# how often the leader saves the consumer signals for the other workers
+SIGNALS_SAVE_SEC = 5
 
 # Environment config
 if 'TARGET_ENV' in environ and environ['TARGET_ENV'] == 'prod':
@@ -45,7 +57,7 @@ else:
 # Logging config
 with open(log_conf_file, mode='r') as file:
     log_config = yaml.safe_load(file.read())
-    logging.config.dictConfig(log_config)
+    logs.configure(log_config)
 
 logger = logging.getLogger('database')
 
@@ -62,6 +74,12 @@ DB_PASS = app_config['datastore']['password']
 DB_HOST = app_config['datastore']['host']
 DB_PORT = app_config['datastore']['port']
 DB_NAME = app_config['datastore']['db']
+DB_RETRY_SEC = app_config['datastore']['retry_sec']
+DB_MAX_RETRY_SEC = app_config['datastore']['max_retry_sec']
+
+TRACING = app_config['tracing']
+HTTP = app_config['http']
+COMPRESSION = app_config['compression']
 
 DB_ENGINE = create_engine(
     f"mysql+pymysql://{DB_USER}:{DB_PASS}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
@@ -69,6 +87,30 @@ DB_ENGINE = create_engine(
 Base.metadata.bind = DB_ENGINE
 DB_SESSION = sessionmaker(bind=DB_ENGINE)
 
+# set once the tables exist, the database is connected in the background
+DB_READY = Event()
+
+# message processor state, reported by the detailed health check
+CONSUMER = None
+CONSUMER_THREAD = None
+# cleared when the database fails to store a reading, set again once one is stored
+CONSUMER_HEALTHY = Event()
+CONSUMER_HEALTHY.set()
+# only the leader worker consumes messages, the others report the signals it saves
+LEADER = Leader(HTTP['leader_lock'])
+SIGNALS_FILE = f"{HTTP['leader_lock']}.signals.json"
+
+METRICS = Registry('storage')
+METRICS.add(logs.DROPPED)
+MESSAGES_CONSUMED = METRICS.counter('messages_consumed_total', "Messages consumed from the broker", ('type',))
+STORE_ERRORS = METRICS.counter('store_errors_total', "Readings the database failed to store", ('type', 'error'))
+INSERT_SECONDS = METRICS.histogram('insert_seconds', "Time to store one reading, including the commit", ('type',))
+STAGE_SECONDS = METRICS.histogram('stage_seconds', "Time readings spend in each pipeline stage", ('stage',), PIPELINE_BUCKETS)
+
+# picks the sampled readings, their stage stamps are stored in the trace table
+# so every worker hands them on to processing with their rows
+TRACES = TraceStore(TRACING['sample_rate'], capacity=0)
+
 # Endpoints
 def root() -> None:
     logger.info("Received connection request from processing server")
@@ -77,46 +119,84 @@ def root() -> None:
 def health():
     return {"message": "OK"}, 200
 
-def get_temperature(start_timestamp: str, end_timestamp: str) -> list:
+def ready():
+    checks = {"database": DB_READY.is_set()}
+    if not all(checks.values()):
+        return {"message": "Not ready", "checks": checks}, 503
+    return {"message": "OK", "checks": checks}, 200
+
+def get_metrics():
+    return Response(METRICS.exposition(), mimetype='text/plain')
+
+def health_detail():
+    consumer = consumer_signals()
+    signals = {
+        "consumer_alive": consumer['consumer_alive'], 
+        "consumer_healthy": consumer.get('consumer_healthy'),
+        "consumer_lag": consumer['consumer_lag'], 
+        "db_checkout_ms": db_checkout_ms(), 
+        "db_pool_in_use": DB_ENGINE.pool.checkedout()
+    }
+    return {"message": "OK", "signals": signals}, 200
+
+def get_temperature(start_timestamp: str = None, end_timestamp: str = None, after_id: int = None, limit: int = None) -> list:
+    filters = list()
+    if start_timestamp is not None and end_timestamp is not None:
+        start_timestamp_datetime = datetime.strptime(start_timestamp, DATETIME_FORMAT)
+        end_timestamp_datetime = datetime.strptime(end_timestamp, DATETIME_FORMAT)
+        filters.append(Temperature.date_created >= start_timestamp_datetime)
+        filters.append(Temperature.date_created < end_timestamp_datetime)
+    if after_id is not None:
+        # cursor based page of rows after the last row id seen by the caller
+        filters.append(Temperature.id_ > after_id)
+    if not filters:
+        return {"message": "start_timestamp and end_timestamp, or after_id are required"}, 400
+
     session = DB_SESSION()
-    start_timestamp_datetime = datetime.strptime(start_timestamp, DATETIME_FORMAT)
-    end_timestamp_datetime = datetime.strptime(end_timestamp, DATETIME_FORMAT)
-    readings = session.query(Temperature).filter(
-        and_(Temperature.date_created >= start_timestamp_datetime, 
-        Temperature.date_created < end_timestamp_datetime)
-        )
-    results_list = list()
-    for reading in readings:
-        results_list.append(reading.to_dict())
+    readings = session.query(Temperature).filter(and_(*filters)).order_by(Temperature.id_)
+    if after_id is not None:
+        readings = readings.limit(limit or PAGE_LIMIT)
+    after = start_timestamp if after_id is None else f"id {after_id}"
+
+    results_list = with_traces(session, [reading.to_dict() for reading in readings])
     
     session.close()
 
     if len(results_list) >= 1:
-        logger.info(f"Updated data sent for processing. Content length: {len(results_list)}")
-    logger.debug(f"Query for temperature after {start_timestamp_datetime} returns {len(results_list)}")
+        logger.info("Updated data sent for processing. Content length: %d", len(results_list))
+    logger.debug("Query for temperature after %s returns %d", after, len(results_list))
+
+    return encoding.rows_response(results_list)
 
-    return results_list, 200
 
+def get_environment(start_timestamp: str = None, end_timestamp: str = None, after_id: int = None, limit: int = None) -> list:
+    filters = list()
+    if start_timestamp is not None and end_timestamp is not None:
+        start_timestamp_datetime = datetime.strptime(start_timestamp, DATETIME_FORMAT)
+        end_timestamp_datetime = datetime.strptime(end_timestamp, DATETIME_FORMAT)
+        filters.append(Environment.date_created >= start_timestamp_datetime)
+        filters.append(Environment.date_created < end_timestamp_datetime)
+    if after_id is not None:
+        # cursor based page of rows after the last row id seen by the caller
+        filters.append(Environment.id_ > after_id)
+    if not filters:
+        return {"message": "start_timestamp and end_timestamp, or after_id are required"}, 400
 
-def get_environment(start_timestamp: str, end_timestamp: str) -> list:
     session = DB_SESSION()
-    start_timestamp_datetime = datetime.strptime(start_timestamp, DATETIME_FORMAT)
-    end_timestamp_datetime = datetime.strptime(end_timestamp, DATETIME_FORMAT)
-    readings = session.query(Environment).filter(
-        and_(Environment.date_created >= start_timestamp_datetime, 
-        Environment.date_created < end_timestamp_datetime)
-        )
-    results_list = list()
-    for reading in readings:
-        results_list.append(reading.to_dict())
+    readings = session.query(Environment).filter(and_(*filters)).order_by(Environment.id_)
+    if after_id is not None:
+        readings = readings.limit(limit or PAGE_LIMIT)
+    after = start_timestamp if after_id is None else f"id {after_id}"
+
+    results_list = with_traces(session, [reading.to_dict() for reading in readings])
     
     session.close()
 
     if len(results_list) >= 1:
-        logger.info(f"Updated data sent for processing. Content length: {len(results_list)}")
-    logger.debug(f"Query for environment after {start_timestamp_datetime} returns {len(results_list)}")
+        logger.info("Updated data sent for processing. Content length: %d", len(results_list))
+    logger.debug("Query for environment after %s returns %d", after, len(results_list))
 
-    return results_list, 200
+    return encoding.rows_response(results_list)
 
 # storage functions
 def temperature(body) -> None:
@@ -132,10 +212,12 @@ def temperature(body) -> None:
         body['trace_id']
     )
     session.add(temp)
-    session.commit()
-
-    session.close()
-    logger.info(f"Stored temperature data from device at {location} -- trace ID: {trace}")
+    try:
+        session.commit()
+    finally:
+        # rolls back a failed commit
+        session.close()
+    logger.info("Stored temperature data from device at %s -- trace ID: %s", location, trace)
     
     return NoContent, 201
 
@@ -153,90 +235,193 @@ def environment(body) -> None:
         body['trace_id']
     )
     session.add(envr)
-    session.commit()
-
-    session.close()
-    logger.info(f"Stored environment data from device at {location} -- trace ID: {trace}")
+    try:
+        session.commit()
+    finally:
+        session.close()
+    logger.info("Stored environment data from device at %s -- trace ID: %s", location, trace)
     
     return NoContent, 201
 
 # message processor
 def process_messages():
-    topic = connect_kafka_client(max_retries=3, timeout=2)
-
-    consumer = topic.get_simple_consumer(
-        consumer_group=b'telemetry', 
-        auto_offset_reset=OffsetType.LATEST, 
-        reset_offset_on_start=False
-    )
+    global CONSUMER
+    # messages are only taken off the broker once they can be stored
+    DB_READY.wait()
+    TRANSPORT.wait_ready()
+    consumer = CONSUMER = TRANSPORT.consumer(group='telemetry')
     
-    try:
-        for msg in consumer:
-            msg_str = msg.value.decode('utf-8')
-            msg = json.loads(msg_str)
-
-            payload = msg['payload']
-            if msg['type'] == 'temperature':
-                temperature(payload)
-                
-            if msg['type'] == 'environment':
-                environment(payload)
-                
-            consumer.commit_offsets()
-
-    except SocketDisconnectedError as e:
-        consumer.stop()
-        consumer.start()
-
-# Server connection
-def connect_kafka_client(max_retries: int, timeout: int):
-    count = 0
-    while count < max_retries:
+    while True:
         try:
-            client = KafkaClient(hosts=f'{SERVER_HOST}:{SERVER_PORT}')
-            topic = client.topics[str.encode(DATA_TOPIC)]
-            logger.info(f"Client connected to Kafka server")
-
-            return topic
+            for msg in consumer:
+                consumed = now_ns()
+                msg_str = msg.value.decode('utf-8')
+                msg = json.loads(msg_str)
+
+                payload = msg['payload']
+                stored = store(msg['type'], payload)
+                consumer.commit()
+                if stored:
+                    MESSAGES_CONSUMED.inc(msg['type'])
+                    trace_stages(payload.get('trace_id'), msg.get('ingest_ns'), consumed, now_ns())
+
+        except TransportError as e:
+            logger.warning("Restarting consumer - Error: %s", e)
+            consumer.restart()
+
+def store(msg_type: str, payload: dict) -> bool:
+    """Stores one reading, waiting for a lost database to come back. False if the database rejected it"""
+    while True:
+        try:
+            with INSERT_SECONDS.time(msg_type):
+                if msg_type == 'temperature':
+                    temperature(payload)
+
+                if msg_type == 'environment':
+                    environment(payload)
+
+        except OperationalError as e:
+            CONSUMER_HEALTHY.clear()
+            STORE_ERRORS.inc(msg_type, 'unavailable')
+            logger.error("Database unavailable, retrying in %ss -- trace ID: %s - Error: %s", DB_RETRY_SEC, payload.get('trace_id'), e)
+            time.sleep(DB_RETRY_SEC)
+
+        except SQLAlchemyError as e:
+            # retrying would not store it, so it is skipped rather than holding up the topic
+            CONSUMER_HEALTHY.clear()
+            STORE_ERRORS.inc(msg_type, 'rejected')
+            logger.error("Reading rejected by the database, skipped -- trace ID: %s - Error: %s", payload.get('trace_id'), e)
+            return False
+
+        else:
+            CONSUMER_HEALTHY.set()
+            return True
+
+def trace_stages(trace_id: str, ingest: int, consumed: int, committed: int) -> None:
+    # messages produced before the receiver stamped them have no ingest time
+    if ingest is not None:
+        STAGE_SECONDS.observe((consumed - ingest) / 1e9, 'broker_dwell')
+    STAGE_SECONDS.observe((committed - consumed) / 1e9, 'db_commit')
+    if trace_id is not None and TRACES.sampled(trace_id):
+        session = DB_SESSION()
+        try:
+            # a redelivered message replaces the stamps of its first delivery
+            session.merge(Trace(trace_id, ingest, consumed, committed))
+            session.commit()
+        except SQLAlchemyError as e:
+            logger.warning("Unable to store the stage stamps -- trace ID: %s - Error: %s", trace_id, e)
+        finally:
+            session.close()
 
-        except KafkaException as e:
-            logger.error(f"Connection failed - {e} - Retries ({count})")
-            time.sleep(timeout)
-            count += 1
+def prune_traces() -> int:
+    """Deletes the stage stamps of readings committed more than retention_sec ago"""
+    cutoff = now_ns() - TRACING['retention_sec'] * 10 ** 9
+    session = DB_SESSION()
+    try:
+        removed = session.query(Trace).filter(Trace.committed_ns < cutoff).delete(synchronize_session=False)
+        session.commit()
+    finally:
+        session.close()
+    return removed
+
+def expire_traces() -> None:
+    # the trace table only grows otherwise, one row per sampled reading
+    while True:
+        time.sleep(TRACING['prune_sec'])
+        try:
+            removed = prune_traces()
+            logger.debug("Pruned %s traces", removed)
+        except Exception as e:
+            logger.warning("Unable to prune traces - %s", e)
+
+def with_traces(session, rows: list) -> list:
+    """Adds the stage stamps of the sampled rows"""
+    sampled = [row['trace_id'] for row in rows if TRACES.sampled(row['trace_id'])]
+    if not sampled:
+        return rows
+    traces = {trace.trace_id: trace for trace in session.query(Trace).filter(Trace.trace_id.in_(sampled))}
+    for row in rows:
+        trace = traces.get(row['trace_id'])
+        if trace is None:
             continue
-
-    else:
-        logger.error(f"Connection failed - Unable to connect to kafka server. Max retries exceeded ({max_retries})")
-        raise SystemExit(1)
+        row['trace'] = {CONSUMED: trace.consumed_ns, COMMITTED: trace.committed_ns}
+        if trace.ingest_ns is not None:
+            row['trace'][INGEST] = trace.ingest_ns
+    return rows
+
+def consumer_signals() -> dict:
+    """Measured in the leader, the other workers report the signals it last saved"""
+    if LEADER.is_leader:
+        return measure_consumer()
+    # signals a stopped leader saved are not reported, eg. while another worker takes over
+    saved = load_state(SIGNALS_FILE, max_age_sec=3 * SIGNALS_SAVE_SEC)
+    return saved or {"consumer_alive": None, "consumer_healthy": None, "consumer_lag": None}
+
+def measure_consumer() -> dict:
+    return {"consumer_alive": consumer_alive(), "consumer_healthy": CONSUMER_HEALTHY.is_set(), "consumer_lag": consumer_lag()}
+
+def save_signals() -> None:
+    """Saves the consumer signals for the workers that follow the leader"""
+    while True:
+        try:
+            save_state(SIGNALS_FILE, measure_consumer())
+        except OSError as e:
+            logger.warning("Unable to save the consumer signals - %s", e)
+        time.sleep(SIGNALS_SAVE_SEC)
+
+def consumer_alive():
+    return CONSUMER_THREAD is not None and CONSUMER_THREAD.is_alive()
+
+def consumer_lag():
+    """Messages in the topic not yet consumed, or None before the consumer starts"""
+    if CONSUMER is None:
+        return None
+    try:
+        latest = TRANSPORT.latest_offsets()
+    except TransportError as e:
+        logger.warning("Unable to fetch latest offsets - %s", e)
+        return None
+    held = CONSUMER.held_offsets
+    # latest offsets are the next offset to be written
+    return sum(max(0, offset - 1 - held.get(partition, -1)) for partition, offset in latest.items())
 
 # Database utilities
+def db_checkout_ms() -> float:
+    # time to check out a connection and run a trivial query
+    started = time.perf_counter()
+    with DB_ENGINE.connect() as conn:
+        conn.execute(text('SELECT 1'))
+    return (time.perf_counter() - started) * 1000
+
 def init_db(database, connection, cursor):
     try:
         cursor.execute('''SHOW VARIABLES like 'version';''')
         version = cursor.fetchone()
-        logger.info(f"Connected to {database} database - MySQL {version[0]} {version[1]}")
+        logger.info("Connected to %s database - MySQL %s %s", database, version[0], version[1])
         # 
     except Exception as e:
         raise
 
 def _tables(database, connection, cursor):
     cursor.execute('''SHOW TABLES;''')
-    tables = cursor.fetchall()
-    try:
-        temp = tables[-1]
-        envr = tables[-2]
-        logger.info(f"{database} tables: {temp[0]}, {envr[0]}")
-        # 
-    except IndexError:
-        logger.info(f"Creating tables")
+    tables = [table[0] for table in cursor.fetchall()]
+    if tables:
+        logger.info("%s tables: %s", database, ', '.join(tables))
+    else:
+        logger.info("Creating tables")
         cursor.execute(create_temp)
         logger.info("Created table `temperature`")
         cursor.execute(create_envr)
         logger.info("Created table `environment`")
-        connection.commit()
-        # 
-    except Exception as e:
-        raise
+    # added after the readings tables, so it is created in existing databases too
+    if 'trace' not in tables:
+        cursor.execute(create_trace)
+        logger.info("Created table `trace`")
+    cursor.execute('''SHOW INDEX FROM trace WHERE Key_name = 'ix_trace_committed_ns';''')
+    if not cursor.fetchall():
+        cursor.execute(create_trace_index)
+        logger.info("Created index `ix_trace_committed_ns`")
+    connection.commit()
 
 # Database connection
 def connect_database(user: str, password: str, host: str, port: int, database: str):
@@ -252,17 +437,47 @@ def connect_database(user: str, password: str, host: str, port: int, database: s
         finally:
             crs.close()
 
+def init_database() -> None:
+    """Connects to the database and creates the tables, retrying until it is reachable"""
+    delay = DB_RETRY_SEC
+    retries = 0
+    while True:
+        try:
+            connect_database(user=DB_USER, password=DB_PASS, host=DB_HOST, port=DB_PORT, database=DB_NAME)
+        except Exception as e:
+            logger.warning("Unable to connect to database - %s - Retrying in %ss (%s)", e, delay, retries)
+            time.sleep(delay)
+            delay = min(delay * 2, DB_MAX_RETRY_SEC)
+            retries += 1
+            continue
+        DB_READY.set()
+        return
+
+
+TRANSPORT = create_transport(app_config['transport'], app_config['server'], DATA_TOPIC)
 
 app = connexion.FlaskApp(__name__, specification_dir='openapi/')
-app.add_api('openapi.yml', base_path='/storage', strict_validation=True, validate_responses=True)
+spec.add_api(app, 'openapi.yml', base_path='/storage', strict_validation=True, validate_responses=True)
+METRICS.instrument(app.app)
+encoding.compress(app.app, COMPRESSION)
+application = app.app
+
+def start_worker() -> None:
+    """Starts a worker, called by gunicorn after the fork, the leader also consumes messages"""
+    Thread(target=init_database, name='init-database', daemon=True).start()
+    LEADER.campaign(start_consumer)
+
+def start_consumer() -> None:
+    global CONSUMER_THREAD
+    TRANSPORT.connect()
+    t1 = CONSUMER_THREAD = Thread(target=process_messages, name='consumer', daemon=True)
+    t1.start()
+    Thread(target=save_signals, name='save-signals', daemon=True).start()
+    Thread(target=expire_traces, name='expire-traces', daemon=True).start()
 
 def main() -> None:
-    connect_database(user=DB_USER, password=DB_PASS, host=DB_HOST, port=DB_PORT, database=DB_NAME)
-    t1 = Thread(target=process_messages)
-    t1.daemon
-    t1.start()
+    start_worker()
     app.run(port=8090, debug=False)
 
-
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -39,6 +39,20 @@ create_envr = '''
     CONSTRAINT environment_pk PRIMARY KEY (id_))
     '''
 
+create_trace = '''
+    CREATE TABLE IF NOT EXISTS trace
+    (trace_id VARCHAR(250) NOT NULL,
+    ingest_ns BIGINT,
+    consumed_ns BIGINT NOT NULL,
+    committed_ns BIGINT NOT NULL,
+    CONSTRAINT trace_pk PRIMARY KEY (trace_id))
+    '''
+
+# traces are pruned by commit time
+create_trace_index = '''
+    CREATE INDEX ix_trace_committed_ns ON trace (committed_ns)
+    '''
+
 empty_temp = '''
     TRUNCATE TABLE temperature;
     '''
@@ -47,8 +61,12 @@ empty_envr = '''
     TRUNCATE TABLE environment;
     '''
 
+empty_trace = '''
+    TRUNCATE TABLE trace;
+    '''
+
 drop_all = '''
-    DROP TABLE temperature, environment;
+    DROP TABLE temperature, environment, trace;
     '''
 
 version = '''
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, Numeric, String, DateTime
+from sqlalchemy import BigInteger, Column, Integer, Numeric, String, DateTime
 from data.base import Base
 from datetime import datetime
 
@@ -68,4 +68,19 @@ class Environment(Base):
         dict['timestamp'] = self.timestamp
         dict['trace_id'] = self.trace_id
 
-        return dict
\ No newline at end of file
+        return dict
+
+class Trace(Base):
+    """Stage stamps of a sampled reading, in nanoseconds"""
+    __tablename__ = "trace"
+
+    trace_id = Column(String(250), primary_key=True)
+    ingest_ns = Column(BigInteger, nullable=True)
+    consumed_ns = Column(BigInteger, nullable=False)
+    committed_ns = Column(BigInteger, nullable=False, index=True)
+
+    def __init__(self, trace_id, ingest_ns, consumed_ns, committed_ns) -> None:
+        self.trace_id = trace_id
+        self.ingest_ns = ingest_ns
+        self.consumed_ns = consumed_ns
+        self.committed_ns = committed_ns
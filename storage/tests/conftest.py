@@ -0,0 +1,78 @@
+"""
+Runs the service against the in-process message transport and SQLite
+
+    cd storage
+    python -m pytest tests
+"""
+import json
+import os
+import shutil
+import sys
+import time
+import pytest
+import yaml
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+
+SERVICE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [SERVICE, os.path.join(os.path.dirname(SERVICE), 'common')]
+
+
+def wait_for(condition, timeout_sec: float = 5):
+    deadline = time.monotonic() + timeout_sec
+    while not condition():
+        if time.monotonic() > deadline:
+            raise TimeoutError("Condition not met")
+        time.sleep(0.01)
+
+
+@pytest.fixture(scope='session')
+def storage(tmp_path_factory):
+    directory = tmp_path_factory.mktemp('storage')
+    with open(os.path.join(SERVICE, 'app_conf.yml'), mode='r') as file:
+        app_config = yaml.safe_load(file.read())
+    app_config['transport'] = {'type': 'memory'}
+    app_config['tracing']['sample_rate'] = 1.0
+    app_config['http']['leader_lock'] = str(directory / 'storage.leader')
+    with open(directory / 'app_conf.yml', mode='w') as file:
+        yaml.safe_dump(app_config, file)
+    shutil.copy(os.path.join(SERVICE, 'log_conf.yml'), directory)
+
+    # config and log files are read from the working directory on import
+    cwd = os.getcwd()
+    os.environ['TARGET_ENV'] = 'test'
+    os.chdir(directory)
+    try:
+        import app
+    finally:
+        os.chdir(cwd)
+
+    # the tables are created by the ORM rather than by init_database, which needs MySQL
+    # pooled like the MySQL engine, for the pool signals of the detailed health check
+    app.DB_ENGINE = create_engine(f"sqlite:///{directory / 'telemetry.db'}", poolclass=QueuePool, connect_args={'check_same_thread': False})
+    app.Base.metadata.create_all(app.DB_ENGINE)
+    app.DB_SESSION = sessionmaker(bind=app.DB_ENGINE)
+    app.DB_READY.set()
+    app.start_consumer()
+    wait_for(lambda: app.CONSUMER is not None)
+    return app
+
+
+@pytest.fixture()
+def client(storage):
+    return storage.app.app.test_client()
+
+
+@pytest.fixture()
+def produce(storage):
+    """Sends a reading to the consumer the way the receiver does"""
+    def produce(kind: str, payload: dict) -> None:
+        msg = {
+            'type': kind,
+            'datetime': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'ingest_ns': time.time_ns(),
+            'payload': payload
+        }
+        storage.TRANSPORT.produce(json.dumps(msg).encode('utf-8'))
+    return produce
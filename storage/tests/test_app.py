@@ -0,0 +1,185 @@
+import os
+import uuid
+import msgpack
+from conftest import wait_for
+
+COLUMNS = 'application/vnd.openatmos.columns+json'
+
+
+def temperature(location: str) -> dict:
+    return {
+        'device_id': str(uuid.uuid4()),
+        'location': location,
+        'temperature': 21.5,
+        'timestamp': '2022-11-01T12:00:00Z',
+        'trace_id': str(uuid.uuid4())
+    }
+
+
+def environment(location: str) -> dict:
+    return {
+        'device_id': str(uuid.uuid4()),
+        'environment': {'pm2_5': 12, 'co_2': 410},
+        'location': location,
+        'timestamp': '2022-11-01T12:00:00Z',
+        'trace_id': str(uuid.uuid4())
+    }
+
+
+def read_back(client, table: str, trace_id: str, traced: bool = False) -> list:
+    # the stamps of a sampled row are stored once the row is committed
+    rows = list()
+    def stored() -> bool:
+        response = client.get(f'/storage/{table}', query_string={'after_id': 0})
+        assert response.status_code == 200
+        rows[:] = [row for row in response.get_json() if row['trace_id'] == trace_id and (not traced or 'trace' in row)]
+        return bool(rows)
+    wait_for(stored)
+    return rows
+
+
+def test_consumed_temperature_is_read_back_with_its_trace(client, produce):
+    payload = temperature('Vancouver')
+    produce('temperature', payload)
+    row, = read_back(client, 'temperature', payload['trace_id'], traced=True)
+    assert row['location'] == 'Vancouver'
+    assert row['temperature'] == 21.5
+    assert row['date_created'].endswith('Z')
+    assert set(row['trace']) == {'ingest', 'consumed', 'committed'}
+    assert row['trace']['ingest'] <= row['trace']['consumed'] <= row['trace']['committed']
+
+
+def test_consumed_environment_is_read_back(client, produce):
+    payload = environment('Burnaby')
+    produce('environment', payload)
+    row, = read_back(client, 'environment', payload['trace_id'])
+    assert row['environment'] == {'pm2_5': 12, 'co_2': 410}
+
+
+def consumed_total(client) -> float:
+    for line in client.get('/storage/metrics').get_data(as_text=True).splitlines():
+        if line.startswith('storage_messages_consumed_total{type="temperature"}'):
+            return float(line.split()[-1])
+    return 0
+
+
+def test_consumed_messages_are_counted(client, produce):
+    before = consumed_total(client)
+    payload = temperature('Surrey')
+    produce('temperature', payload)
+    read_back(client, 'temperature', payload['trace_id'])
+    wait_for(lambda: consumed_total(client) > before)
+
+
+def test_read_requires_a_range_or_cursor(client):
+    response = client.get('/storage/temperature')
+    assert response.status_code == 400
+
+
+def test_read_as_columns(client, produce):
+    payload = temperature('Richmond')
+    produce('temperature', payload)
+    read_back(client, 'temperature', payload['trace_id'])
+    response = client.get('/storage/temperature', query_string={'after_id': 0}, headers={'Accept': COLUMNS})
+    assert response.status_code == 200
+    assert response.mimetype == COLUMNS
+    body = response.get_json()
+    assert body['count'] == len(body['columns']['id'])
+    assert payload['trace_id'] in body['columns']['trace_id']
+
+
+def test_read_as_msgpack(client, produce):
+    payload = temperature('Delta')
+    produce('temperature', payload)
+    read_back(client, 'temperature', payload['trace_id'])
+    response = client.get('/storage/temperature', query_string={'after_id': 0}, headers={'Accept': 'application/msgpack'})
+    assert response.status_code == 200
+    rows = msgpack.unpackb(response.get_data())
+    assert payload['trace_id'] in [row['trace_id'] for row in rows]
+
+
+def test_gzip_compressed_read(client, produce):
+    for location in ('Langley', 'Coquitlam', 'Abbotsford', 'Chilliwack', 'Mission'):
+        produce('temperature', temperature(location))
+    payload = temperature('Hope')
+    produce('temperature', payload)
+    read_back(client, 'temperature', payload['trace_id'])
+    response = client.get('/storage/temperature', query_string={'after_id': 0}, headers={'Accept-Encoding': 'gzip'})
+    assert response.status_code == 200
+    assert response.headers['Content-Encoding'] == 'gzip'
+
+
+def test_trace_is_stored_for_every_worker(client, produce, storage):
+    payload = temperature('Burnaby')
+    produce('temperature', payload)
+    row, = read_back(client, 'temperature', payload['trace_id'], traced=True)
+    session = storage.DB_SESSION()
+    trace = session.query(storage.Trace).get(payload['trace_id'])
+    session.close()
+    assert (trace.ingest_ns, trace.consumed_ns, trace.committed_ns) == \
+        (row['trace']['ingest'], row['trace']['consumed'], row['trace']['committed'])
+
+
+def test_followers_report_the_consumer_signals_the_leader_saved(client, storage):
+    # the tests start the consumer without electing the worker, so it reads the saved signals
+    assert not storage.LEADER.is_leader
+    wait_for(lambda: os.path.exists(storage.SIGNALS_FILE))
+    response = client.get('/storage/health/detail')
+    assert response.status_code == 200
+    signals = response.get_json()['signals']
+    assert signals['consumer_alive'] is True
+    assert signals['consumer_lag'] is not None
+
+
+def test_traces_older_than_the_retention_are_pruned(storage):
+    now = storage.now_ns()
+    retention = storage.TRACING['retention_sec'] * 10 ** 9
+    old, recent = str(uuid.uuid4()), str(uuid.uuid4())
+    session = storage.DB_SESSION()
+    session.add(storage.Trace(old, now - retention - 10 ** 9, now - retention - 10 ** 9, now - retention - 10 ** 9))
+    session.add(storage.Trace(recent, now - 10 ** 9, now - 10 ** 9, now - 10 ** 9))
+    session.commit()
+    session.close()
+
+    assert storage.prune_traces() >= 1
+    session = storage.DB_SESSION()
+    kept = {trace.trace_id for trace in session.query(storage.Trace).filter(storage.Trace.trace_id.in_([old, recent]))}
+    oldest = session.query(storage.Trace).order_by(storage.Trace.committed_ns).first()
+    session.close()
+    assert kept == {recent}
+    assert oldest.committed_ns >= now - retention
+
+
+
+def test_reading_the_database_rejects_is_skipped(client, produce, storage):
+    rejected = environment('Coquitlam')
+    rejected['environment']['pm2_5'] = None
+    produce('environment', rejected)
+    wait_for(lambda: not storage.CONSUMER_HEALTHY.is_set())
+    assert storage.measure_consumer()['consumer_healthy'] is False
+
+    # the consumer is still running, and healthy again once a reading is stored
+    payload = environment('Coquitlam')
+    produce('environment', payload)
+    read_back(client, 'environment', payload['trace_id'])
+    assert storage.consumer_alive()
+    wait_for(storage.CONSUMER_HEALTHY.is_set)
+    rows = client.get('/storage/environment', query_string={'after_id': 0}).get_json()
+    assert rejected['trace_id'] not in [row['trace_id'] for row in rows]
+
+
+def test_reading_is_stored_once_the_database_is_back(client, produce, storage, monkeypatch):
+    failures = [storage.OperationalError('INSERT', {}, Exception("server has gone away"))]
+    insert = storage.temperature
+    def failing_insert(body) -> None:
+        if failures:
+            raise failures.pop()
+        insert(body)
+    monkeypatch.setattr(storage, 'temperature', failing_insert)
+    monkeypatch.setattr(storage, 'DB_RETRY_SEC', 0.01)
+
+    payload = temperature('Delta')
+    produce('temperature', payload)
+    row, = read_back(client, 'temperature', payload['trace_id'])
+    assert row['location'] == 'Delta'
+    assert not failures
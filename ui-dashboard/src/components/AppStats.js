@@ -20,9 +20,41 @@ export default function AppStats() {
             })
     }
     useEffect(() => {
-		const interval = setInterval(() => getStats(), 2000); // Update every 2 seconds
-		return() => clearInterval(interval);
-    }, [getStats]);
+        let interval = null;
+        const startPolling = () => {
+            if (interval === null) {
+                interval = setInterval(() => getStats(), 2000); // Update every 2 seconds
+            }
+        }
+        if (!window.EventSource) {
+            startPolling();
+            return() => clearInterval(interval);
+        }
+        // Pushed updates, falls back to polling if the stream is unavailable
+        const source = new EventSource(`http://api-lxvdev.westus3.cloudapp.azure.com/processing/stats/stream`);
+        // A stream that is buffered or keeps reconnecting never errors out, so it is given up on after a timeout
+        const timeout = setTimeout(() => {
+            source.close();
+            startPolling();
+        }, 10000);
+        source.addEventListener('stats', (event) => {
+            clearTimeout(timeout);
+            console.log("Received Stats")
+            setStats(JSON.parse(event.data));
+            setIsLoaded(true);
+        });
+        source.onerror = () => {
+            if (source.readyState === EventSource.CLOSED) {
+                clearTimeout(timeout);
+                startPolling();
+            }
+        }
+        return() => {
+            clearTimeout(timeout);
+            source.close();
+            clearInterval(interval);
+        }
+    }, []);
 
     if (error){
         return (<div className={"error"}>Error found when fetching from API</div>)